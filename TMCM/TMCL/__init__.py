@@ -1,3 +1,14 @@
 
 from device import *
+from asyncdevice import *
+from bus import *
+from shared import *
+from fleet import *
+from gateway import Gateway, GatewayPort, RemoteDevice
+from retry import RetryPolicy
 
+from snapshot import *
+from config import *
+from movequeue import *
+from assembler import *
+from tracing import *
@@ -0,0 +1,190 @@
+
+import re
+from collections import namedtuple
+
+import codec
+from consts import *
+from error import *
+
+
+# operand order of every instruction in TMCL source, as in the TMCL-IDE
+OPERANDS = { 'ROR'   : ('motor', 'value'),
+             'ROL'   : ('motor', 'value'),
+             'MST'   : ('motor',),
+             'MVP'   : ('type', 'motor', 'value'),
+             'SAP'   : ('type', 'motor', 'value'),
+             'GAP'   : ('type', 'motor'),
+             'STAP'  : ('type', 'motor'),
+             'RSAP'  : ('type', 'motor'),
+             'SGP'   : ('type', 'motor', 'value'),
+             'GGP'   : ('type', 'motor'),
+             'STGP'  : ('type', 'motor'),
+             'RSGP'  : ('type', 'motor'),
+             'RFS'   : ('type', 'motor'),
+             'SIO'   : ('type', 'motor', 'value'),
+             'GIO'   : ('type', 'motor'),
+             'CALC'  : ('type', 'value'),
+             'COMP'  : ('value',),
+             'JC'    : ('type', 'value'),
+             'JA'    : ('value',),
+             'CSUB'  : ('value',),
+             'RSUB'  : (),
+             'EI'    : ('type',),
+             'DI'    : ('type',),
+             'WAIT'  : ('type', 'motor', 'value'),
+             'STOP'  : (),
+             'SCO'   : ('type', 'motor', 'value'),
+             'GCO'   : ('type', 'motor'),
+             'CCO'   : ('type', 'motor'),
+             'CALCX' : ('type',),
+             'AAP'   : ('type', 'motor'),
+             'AGP'   : ('type', 'motor'),
+             'VECT'  : ('type', 'value'),
+             'RETI'  : (),
+             'ACO'   : ('type', 'motor')
+           }
+
+# symbolic type operands
+TYPE_NAMES = { 'MVP'   : CMD_MVP_TYPES,
+               'RFS'   : CMD_RFS_TYPES,
+               'CALC'  : CMD_CALC_TYPES,
+               'CALCX' : CMD_CALCX_TYPES,
+               'JC'    : CMD_JC_TYPES,
+               'WAIT'  : CMD_WAIT_TYPES
+             }
+
+# instructions whose value is a program address (a label)
+JUMPS = ('JC', 'JA', 'CSUB', 'VECT')
+
+Instruction = namedtuple('Instruction', ['command', 'type', 'motor', 'value', 'line'])
+
+LABEL = re.compile(r'^([A-Za-z_]\w*)\s*:')
+NUMBER = re.compile(r'^[-+]?(0x[0-9a-fA-F]+|\$[0-9a-fA-F]+|\d+)$')
+
+
+
+def parseNumber(token):
+    """Decimal, 0x.. or $.. hex integer"""
+    if '$' in token or 'x' in token:
+        return int(token.replace('$', '').replace('0x', '', 1), 16)
+    return int(token, 10)
+
+
+class Program(object):
+    """
+    A TMCL program for standalone execution on the module
+
+        prog = Program()
+        prog.label('loop')
+        prog.MVP('ABS', 0, 51200)
+        prog.WAIT('POS', 0, 0)
+        prog.MVP('ABS', 0, 0)
+        prog.WAIT('POS', 0, 0)
+        prog.JA('loop')
+
+    or, the same from TMCL source:
+
+        prog = Program.parse('''
+            loop:   MVP ABS, 0, 51200
+                    WAIT POS, 0, 0
+                    MVP ABS, 0, 0
+                    WAIT POS, 0, 0
+                    JA loop
+        ''')
+
+    Operands follow OPERANDS, types may be given by name (TYPE_NAMES),
+    jump targets by label. assemble() resolves the labels and returns
+    the request tuples, telegrams() the encoded telegrams.
+    """
+
+    def __init__(self):
+        self.instructions = []
+        self.labels = {}
+
+    def __len__(self):
+        return len(self.instructions)
+
+    def __getattr__(self, name):
+        if name not in OPERANDS:
+            raise AttributeError(name)
+        return lambda *operands: self.add(name, *operands)
+
+    def label(self, name, line=None):
+        """Mark the address of the next instruction as name"""
+        if name in self.labels:
+            raise TMCLAssemblerError(line or len(self.instructions), "duplicate label {}".format(name))
+        self.labels[name] = len(self.instructions)
+        return self
+
+    def add(self, command, *operands, **kwargs):
+        """Append instruction command with operands in source order"""
+        line = kwargs.get('line') or len(self.instructions) + 1
+        command = command.upper()
+        if command not in OPERANDS:
+            raise TMCLAssemblerError(line, "unknown instruction {}".format(command))
+        names = OPERANDS[command]
+        if len(operands) != len(names):
+            raise TMCLAssemblerError(line, "{} takes {} operands ({}), got {}".format(
+                command, len(names), ", ".join(names), len(operands)))
+        fields = dict(type=0, motor=0, value=0)
+        fields.update(zip(names, operands))
+        t = fields['type']
+        if command in TYPE_NAMES and isinstance(t, basestring):
+            if t.upper() not in TYPE_NAMES[command]:
+                raise TMCLAssemblerError(line, "{}: unknown type {}".format(command, t))
+            t = TYPE_NAMES[command][t.upper()]
+        for kind, v in (('type', t), ('motor', fields['motor'])):
+            if not isinstance(v, (int, long)) or not 0 <= v < 256:
+                raise TMCLAssemblerError(line, "{}: {} {!r} is not a byte".format(command, kind, v))
+        value = fields['value']
+        if isinstance(value, basestring):
+            if command not in JUMPS:
+                raise TMCLAssemblerError(line, "{}: value {} is not a number".format(command, value))
+        elif not -2**31 <= value < 2**31:
+            raise TMCLAssemblerError(line, "{}: value {} out of range".format(command, value))
+        self.instructions.append(Instruction(command, t, fields['motor'], value, line))
+        return self
+
+    @classmethod
+    def parse(cls, source):
+        """Program from TMCL source: one instruction per line, 'name:' labels, // comments"""
+        program = cls()
+        for n, line in enumerate(source.splitlines(), 1):
+            line = line.split('//')[0].strip()
+            match = LABEL.match(line)
+            while match:
+                program.label(match.group(1), line=n)
+                line = line[match.end():].strip()
+                match = LABEL.match(line)
+            if not line:
+                continue
+            parts = line.split(None, 1)
+            operands = [op.strip() for op in parts[1].split(',')] if len(parts) > 1 else []
+            if '' in operands:
+                raise TMCLAssemblerError(n, "empty operand")
+            program.add(parts[0], *[parseNumber(op) if NUMBER.match(op) else op
+                                    for op in operands], line=n)
+        return program
+
+    def assemble(self, address=1, origin=0):
+        """Resolve labels for a program loaded at origin, return request tuples"""
+        requests = []
+        for ins in self.instructions:
+            value = ins.value
+            if isinstance(value, basestring):
+                if value not in self.labels:
+                    raise TMCLAssemblerError(ins.line, "undefined label {}".format(value))
+                value = origin + self.labels[value]
+            requests.append((address, NUMBER_COMMANDS[ins.command], ins.type, ins.motor, value))
+        return requests
+
+    def telegrams(self, address=1, origin=0):
+        """The assembled program as one string of telegrams"""
+        return codec.encodeMany(self.assemble(address, origin))
+
+
+def assemble(program, address=1, origin=0):
+    """Request tuples of a Program or of TMCL source"""
+    if isinstance(program, basestring):
+        program = Program.parse(program)
+    return program.assemble(address, origin)
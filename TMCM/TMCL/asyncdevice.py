@@ -0,0 +1,217 @@
+
+import threading
+import time
+from collections import deque
+
+import codec
+from consts import *
+from cache import MISS
+from device import Device, resolveReply, traceRequests
+from error import *
+from framing import FrameParser
+from futures import Future
+from tracing import TraceEvent, RECV, monotonic
+
+
+IDLE_PAUSE = 0.01   # seconds, longest pause of the reader when reads return at once
+
+
+
+def gather(futures, timeout=None):
+    """Wait for all futures and return their results in order"""
+    return [f.result(timeout) for f in futures]
+
+
+
+class AsyncDevice(Device):
+    """
+    Device whose commands return a Future instead of blocking
+
+    Requests are written as soon as a command is called, a single
+    reader thread decodes the in-order replies and resolves the pending
+    futures. Many commands (and many modules, one AsyncDevice each) can
+    be in flight at the same time:
+
+        dev = AsyncDevice("/dev/ttyACM0")
+        pos = gather([dev.gap(mn, 1) for mn in range(3)])
+
+    Python 2 has no asyncio, the futures are thread-safe and can be
+    waited on with result(timeout) or chained with add_done_callback.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(AsyncDevice, self).__init__(*args, **kwargs)
+        self._lock = threading.Lock()
+        self._waiting = deque()
+        self._held = {}  # command -> replies matched, not resolved yet
+        self._closed = False
+        self._reader = threading.Thread(target=self._read_frames, name="TMCL-reader")
+        self._reader.daemon = True
+        self._reader.start()
+
+    def _submit(self, requests):
+        """Write requests at once, return one Future per raw Reply"""
+        if self._closed:
+            raise TMCLError("AsyncDevice", "device is closed")
+        futures = [Future() for _ in requests]
+        req = codec.encodeMany(requests)
+        with self._lock:
+            if self.tracer is not None:
+                traceRequests(self.tracer, requests, req)
+            start = time.time()
+            # nothing is queued if the write fails, the reader resolves
+            # the futures only once the lock is released
+            self._ser.write(req)
+            self._waiting.extend((f, r[1], start) for f, r in zip(futures, requests))
+            self._metrics.sent(len(req), len(requests))
+        return futures
+
+    def _read_frames(self):
+        """
+        Reader thread: match incoming replies to waiting futures
+
+        The stream is parsed with a FrameParser, the bytes skipped in
+        front of a reply tell how many waiting requests lost theirs. If
+        nothing arrives for the port timeout after the oldest waiting
+        request was written, it fails with TMCLTimeoutError and buffered
+        bytes are dropped. A port that returns nothing at once (timeout
+        0 or None) is polled with pauses growing up to IDLE_PAUSE.
+        """
+        n = codec.COMMAND_STRING_LENGTH
+        parser = FrameParser()
+        progress = time.time()
+        idle = 0.0
+        while not self._closed:
+            before = time.time()
+            try:
+                data = self._ser.read(max(n - len(parser), 1))
+            except Exception as e:
+                self._fail_waiting(TMCLError("AsyncDevice", "read failed: {}".format(e)))
+                return
+            now = time.time()
+            if data:
+                progress = now
+                idle = 0.0
+                parser.feed(data)
+                with self._lock:
+                    self._metrics.received(len(data))
+            found = parser.next()
+            while found is not None:
+                self._resolve(*found)
+                found = parser.next()
+            timeout = getattr(self._ser, 'timeout', None)
+            if not data and timeout is not None:
+                with self._lock:
+                    # only a read begun after the request was written tells it got no reply
+                    expired = (self._waiting and self._waiting[0][2] <= before and
+                               now - max(progress, self._waiting[0][2]) > timeout)
+                    if expired:
+                        future, cn, start = self._waiting.popleft()
+                        error = TMCLTimeoutError(COMMAND_NUMBERS.get(cn), "no reply")
+                        done = self._unlocated(cn) + [(future, cn, now - start, error)]
+                        for _, cn, elapsed, result in done:
+                            self._metrics.record(cn, elapsed, result)
+                        self._metrics.resynced(0, parser.drop())
+                if expired:
+                    progress = now
+                    self._settle(done)
+            if not data and now - before < IDLE_PAUSE:
+                idle = min(max(2 * idle, 0.0005), IDLE_PAUSE)
+                time.sleep(idle)
+        self._fail_waiting(TMCLError("AsyncDevice", "device is closed"))
+
+    def _resolve(self, rep, frame, skipped):
+        """
+        Match rep to the waiting request it answers, fail those whose
+        replies were lost
+
+        The reply goes to the first waiting request of its command at or
+        after the position the skipped bytes point to. A reply lost
+        without skipped bytes to show where (requests passed over, or
+        one that times out) may have been any earlier one of the same
+        command, as in Device._resync: a reply is held until no request
+        of its command waits any more, and fails with the held ones of
+        its command if one of them turns out lost.
+        """
+        n = codec.COMMAND_STRING_LENGTH
+        now = time.time()
+        done = []
+        with self._lock:
+            if skipped:
+                self._metrics.resynced(1, skipped)
+            missing = int(round(skipped / float(n)))
+            waiting = self._waiting
+            for i in xrange(min(missing, len(waiting)), len(waiting)):
+                if waiting[i][1] == rep.command_number:
+                    for k in xrange(i):
+                        future, cn, start = waiting.popleft()
+                        if k >= missing:
+                            done.extend(self._unlocated(cn))
+                        error = TMCLLengthError(COMMAND_NUMBERS.get(cn), "reply lost")
+                        done.append((future, cn, now - start, error))
+                    future, cn, start = waiting.popleft()
+                    self._held.setdefault(cn, []).append((future, cn, now - start, rep))
+                    if not any(w[1] == cn for w in waiting):
+                        done.extend(self._held.pop(cn))
+                    break
+            # otherwise an unsolicited reply
+            for _, cn, elapsed, result in done:
+                self._metrics.record(cn, elapsed, result)
+        if self.tracer is not None:
+            self.tracer(TraceEvent(RECV, monotonic(), frame, rep))
+        self._settle(done)
+
+    def _unlocated(self, cn):
+        """Fail the held replies of command cn, one of them was not theirs"""
+        return [(future, cn, elapsed, TMCLLengthError(COMMAND_NUMBERS.get(cn),
+                                                      "reply lost, can not tell which"))
+                for future, cn, elapsed, _ in self._held.pop(cn, [])]
+
+    @staticmethod
+    def _settle(done):
+        for future, _, _, result in done:
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    def _fail_waiting(self, exception):
+        with self._lock:
+            waiting, self._waiting = self._waiting, deque()
+            held, self._held = self._held, {}
+        for replies in held.itervalues():
+            for future, _, _, _ in replies:
+                future.set_exception(exception)
+        for future, _, _ in waiting:
+            future.set_exception(exception)
+
+    def _exchange(self, requests):
+        """Blocking exchange on top of the reader thread"""
+        futures = self._submit(requests)
+        return [f.exception() or f.result() for f in futures]
+
+    def _command(self, c, request, returns=True):
+        """Send request for command c, return a Future of its value"""
+        future = Future()
+        cache = self.cache
+        if cache is not None:
+            value = cache.lookup(request)
+            if value is not MISS:
+                future.set_result(value if returns else None)
+                return future
+
+        def done(f):
+            rep = f.exception() or f.result()
+            resolveReply(future, c, rep, returns)
+            if cache is not None and future.exception() is None:
+                cache.remember(request, rep.value)
+
+        self._submit([request])[0].add_done_callback(done)
+        return future
+
+    def close(self):
+        """Stop the reader thread and close the port"""
+        self._closed = True
+        self._ser.close()
+        self._reader.join(1.0)
+        self._fail_waiting(TMCLError("AsyncDevice", "device is closed"))
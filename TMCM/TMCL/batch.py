@@ -0,0 +1,93 @@
+
+import numpy as np
+
+import codec
+from error import *
+
+
+REQUEST_DTYPE = np.dtype([(k, np.uint8) for k in codec.Request._fields[:4]] +
+                         [('value', np.int32), ('checksum', np.uint8)])
+REPLY_DTYPE = np.dtype([(k, np.uint8) for k in codec.Reply._fields[:4]] +
+                       [('value', np.int32), ('checksum', np.uint8)])
+
+
+
+def asFrames(data):
+    """
+    View data as an (N, 9) uint8 array of telegrams:
+    data can be a string/bytearray buffer or any array-like of bytes
+    """
+    if isinstance(data, (str, bytearray, buffer)):
+        frames = np.frombuffer(data, dtype=np.uint8)
+    else:
+        frames = np.asarray(data, dtype=np.uint8)
+    if frames.size % codec.COMMAND_STRING_LENGTH:
+        raise TMCLError("Buffer length ({} bytes) is not a multiple of {} bytes".format(frames.size, codec.COMMAND_STRING_LENGTH))
+    return frames.reshape(-1, codec.COMMAND_STRING_LENGTH)
+
+
+def checksumFrames(frames):
+    """Calculate the checksum byte of every telegram in an (N, 9) array"""
+    return frames[:, :8].sum(axis=1, dtype=np.uint8)
+
+
+def decodeBytesFrames(frames):
+    """Decode the signed 32-bit big-endian value field of every telegram"""
+    value = np.ascontiguousarray(frames[:, 4:8]).view('>i4')
+    return value.reshape(-1).astype(np.int32)
+
+
+
+def decodeRequestFrames(data):
+    """Decode requests using decodeFrames"""
+    return decodeFrames(data, REQUEST_DTYPE)
+
+def decodeReplyFrames(data):
+    """Decode replies using decodeFrames"""
+    return decodeFrames(data, REPLY_DTYPE)
+
+
+def decodeFrames(data, dtype):
+    """
+    Decode a batch of telegrams:
+    View data as (N, 9) frames
+    Validate all checksums at once
+    Fill a structured array of the given dtype
+    Return the structured array and a boolean mask of bad frames
+    """
+    frames = asFrames(data)
+    result = np.empty(len(frames), dtype=dtype)
+    for i, k in enumerate(dtype.names[:4]):
+        result[k] = frames[:, i]
+    result['value'] = decodeBytesFrames(frames)
+    result['checksum'] = frames[:, 8]
+    bad = checksumFrames(frames) != frames[:, 8]
+    return result, bad
+
+
+
+def encodeRequestFrames(m_address, n_command, n_type, n_motor, value):
+    """Encode requests using encodeFrames"""
+    return encodeFrames([m_address, n_command, n_type, n_motor], value)
+
+def encodeReplyFrames(r_address, m_address, status, n_command, value):
+    """Encode replies using encodeFrames"""
+    return encodeFrames([r_address, m_address, status, n_command], value)
+
+
+def encodeFrames(parameters, value):
+    """
+    Encode a batch of telegrams from column arrays:
+    Broadcast the four parameter columns and the value column
+    Convert values to 32-bit big-endian bytes
+    Calculate all checksums at once
+    Return an (N, 9) uint8 array, use .tostring() for the wire format
+    """
+    columns = np.broadcast_arrays(*[np.asarray(p, dtype=np.int64) for p in parameters + [value]])
+    frames = np.empty((columns[0].size, codec.COMMAND_STRING_LENGTH), dtype=np.uint8)
+    for i, p in enumerate(columns[:4]):
+        frames[:, i] = p.reshape(-1) & 0xFF
+    value = (columns[4].reshape(-1) & 0xFFFFFFFF).astype('>u4')
+    frames[:, 4:8] = value.view(np.uint8).reshape(-1, 4)
+    frames[:, 8] = checksumFrames(frames)
+    return frames
@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+
+"""
+Benchmark suite for the codec, query round trips and snapshots
+
+    python bench.py --output results.json
+    python bench.py --compare baseline.json --tolerance 0.15
+
+Round trips run against a PtySimulator, so no hardware is needed. Each
+benchmark reports the best of --repeat runs in operations per second.
+With --compare every benchmark slower than (1 - tolerance) times its
+baseline is flagged and the exit status is 1.
+"""
+
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+from timeit import default_timer
+
+import capture
+import codec
+import device
+import snapshot
+import simulator
+
+try:
+    import batch
+    import telemetry
+except ImportError:
+    batch = telemetry = None
+
+
+BENCHMARKS = []
+
+
+
+def benchmark(name, operations):
+    """Register fn(setup) as benchmark name doing operations per call"""
+    def register(fn):
+        BENCHMARKS.append((name, operations, fn))
+        return fn
+    return register
+
+
+def measure(fn, operations, repeat):
+    """Best of repeat runs of fn, in operations per second"""
+    best = None
+    for _ in xrange(repeat):
+        start = default_timer()
+        fn()
+        elapsed = default_timer() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return {'ops_per_second': operations / best, 'seconds': best, 'operations': operations}
+
+
+
+class Setup(object):
+    """Shared fixtures: a simulated module on a pty and a Device on it"""
+
+    def __init__(self, baudrate):
+        self.server = simulator.PtySimulator(baudrate=baudrate)
+        self.device = device.Device(self.server.port)
+        self.requests = [(1, 6, pn, mn, 0) for mn in xrange(3) for pn in (1, 3, 4, 140)] * 100
+        self.frames = codec.encodeMany(self.requests)
+
+    def close(self):
+        self.device._ser.close()
+        self.server.close()
+
+
+
+@benchmark('codec.encodeRequestCommand', 10000)
+def bench_encode(setup):
+    encode = codec.encodeRequestCommand
+    for _ in xrange(10000):
+        encode(1, 6, 140, 2, -12345)
+
+@benchmark('codec.packRequestCommand', 10000)
+def bench_pack(setup):
+    pack = codec.packRequestCommand
+    for _ in xrange(10000):
+        pack(1, 6, 140, 2, -12345)
+
+@benchmark('codec.decodeReplyCommand', 10000)
+def bench_decode(setup):
+    decode = codec.decodeReplyCommand
+    frame = setup.frames[:9]
+    for _ in xrange(10000):
+        decode(frame)
+
+@benchmark('codec.unpackReplyCommand', 10000)
+def bench_unpack(setup):
+    unpack = codec.unpackReplyCommand
+    frame = setup.frames[:9]
+    for _ in xrange(10000):
+        unpack(frame)
+
+@benchmark('codec.encodeMany', 12000)
+def bench_encode_many(setup):
+    for _ in xrange(10):
+        codec.encodeMany(setup.requests)
+
+@benchmark('batch.decodeReplyFrames', 120000)
+def bench_batch_decode(setup):
+    for _ in xrange(100):
+        batch.decodeReplyFrames(setup.frames)
+
+@benchmark('device.gap', 200)
+def bench_gap(setup):
+    gap = setup.device.gap
+    for _ in xrange(200):
+        gap(0, 1)
+
+@benchmark('device.sap', 200)
+def bench_sap(setup):
+    sap = setup.device.sap
+    for i in xrange(200):
+        sap(0, 4, i)
+
+@benchmark('capture.device.gap', 200)
+def bench_gap_capture(setup):
+    fd, path = tempfile.mkstemp(suffix='.tmclcap')
+    os.close(fd)
+    setup.device.tracer = capture.CaptureWriter(path)
+    try:
+        bench_gap(setup)
+    finally:
+        setup.device.tracer.close()
+        setup.device.tracer = None
+        os.remove(path)
+
+@benchmark('device.pipeline.gap', 200)
+def bench_pipeline_gap(setup):
+    with setup.device.pipeline() as p:
+        for _ in xrange(200):
+            p.gap(0, 1)
+
+@benchmark('snapshot.get_parameters', 1)
+def bench_get_parameters(setup):
+    snapshot.SnapshotEngine(setup.device, global_parameters=[]).take().check()
+
+@benchmark('snapshot.get_globals', 1)
+def bench_get_globals(setup):
+    snapshot.SnapshotEngine(setup.device, axis_parameters=[]).take().check()
+
+@benchmark('fanout.ror_mst', 6)
+def bench_fanout(setup):
+    for mn in xrange(setup.device.num_motors):
+        setup.device.ror(mn, 100)
+    for mn in xrange(setup.device.num_motors):
+        setup.device.mst(mn)
+
+@benchmark('fanout.ror_mst.pipeline', 6)
+def bench_fanout_pipeline(setup):
+    with setup.device.pipeline() as p:
+        for mn in xrange(setup.device.num_motors):
+            p.ror(mn, 100)
+        for mn in xrange(setup.device.num_motors):
+            p.mst(mn)
+
+@benchmark('telemetry.sample', 100)
+def bench_telemetry(setup):
+    sampler = setup.device.stream(capacity=64)
+    for _ in xrange(100):
+        sampler.sample()
+
+
+
+def run(names=None, repeat=5, baudrate=10**7):
+    """Run the selected benchmarks, return the results document"""
+    setup = Setup(baudrate)
+    results = {}
+    try:
+        for name, operations, fn in BENCHMARKS:
+            if names and not any(name.startswith(n) for n in names):
+                continue
+            if name.startswith(('batch.', 'telemetry.')) and batch is None:
+                continue
+            results[name] = measure(lambda: fn(setup), operations, repeat)
+    finally:
+        setup.close()
+    return {'meta': {'python': platform.python_version(), 'platform': platform.platform(),
+                     'time': time.time(), 'repeat': repeat, 'baudrate': baudrate},
+            'results': results}
+
+
+def compare(results, baseline, tolerance=0.1):
+    """
+    Compare two results documents, return a list of
+    (name, baseline ops/s, ops/s, ratio, regressed)
+    """
+    report = []
+    for name, base in sorted(baseline['results'].iteritems()):
+        if name not in results['results']:
+            continue
+        new = results['results'][name]['ops_per_second']
+        ratio = new / base['ops_per_second']
+        report.append((name, base['ops_per_second'], new, ratio, ratio < 1.0 - tolerance))
+    return report
+
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="TMCL benchmark suite")
+    parser.add_argument('names', nargs='*', help="only run benchmarks starting with these names")
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--baudrate', type=int, default=10**7, help="simulated link speed")
+    parser.add_argument('--output', help="write results as JSON to this file")
+    parser.add_argument('--compare', help="baseline JSON file to compare against")
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help="allowed relative slowdown before flagging a regression")
+    args = parser.parse_args(argv)
+
+    results = run(args.names, repeat=args.repeat, baudrate=args.baudrate)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if not args.compare:
+        for name, r in sorted(results['results'].iteritems()):
+            print "{:<30} {:>14.1f} ops/s".format(name, r['ops_per_second'])
+        return 0
+
+    with open(args.compare) as f:
+        baseline = json.load(f)
+    regressed = False
+    for name, base, new, ratio, slower in compare(results, baseline, args.tolerance):
+        regressed = regressed or slower
+        print "{:<30} {:>14.1f} {:>14.1f} ops/s {:>7.2f}x{}".format(
+            name, base, new, ratio, "  REGRESSION" if slower else "")
+    return 1 if regressed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,163 @@
+
+import threading
+import time
+from collections import OrderedDict, deque
+
+from device import Device
+from error import *
+from futures import Future
+
+
+
+class FairQueue(object):
+    """
+    Priority queue that round-robins between keys of equal priority
+
+    Lower priority values are served first. Within one priority level
+    every key (e.g. a module address) gets one item in turn, so a
+    chatty key can not starve the others.
+    """
+
+    def __init__(self):
+        self._levels = {}
+        self._len = 0
+
+    def __len__(self):
+        return self._len
+
+    def put(self, key, item, priority=0):
+        level = self._levels.setdefault(priority, OrderedDict())
+        level.setdefault(key, deque()).append(item)
+        self._len += 1
+
+    def pop(self):
+        """Remove and return the next (key, item)"""
+        for priority in sorted(self._levels):
+            level = self._levels[priority]
+            if not level:
+                continue
+            key, items = level.popitem(last=False)
+            item = items.popleft()
+            if items:
+                level[key] = items  # back to the end of the rotation
+            self._len -= 1
+            return key, item
+        raise IndexError("pop from an empty FairQueue")
+
+
+
+class Bus(object):
+    """
+    RS485 bus shared by several TMCL modules
+
+    The bus owns the port and an I/O thread. device(address) hands out
+    Device views that behave like a Device with that module address,
+    their requests are scheduled through one FairQueue:
+
+        bus = Bus("/dev/ttyUSB0")
+        x, y = bus.device(1), bus.device(2, priority=-1)
+        x.mvp(0, 'ABS', 1000)
+        print bus.occupancy()
+
+    Replies are checked against the module address and the host
+    address (global parameter (0, 76), 2 by default).
+    """
+
+    def __init__(self, port="/dev/ttyACM0", host_address=2, debug=False):
+        self._link = Device(port, debug=debug)
+        self.host_address = host_address
+        self._cond = threading.Condition()
+        self._queue = FairQueue()
+        self._closed = False
+        self.reset_occupancy()
+        self._thread = threading.Thread(target=self._serve, name="TMCL-bus")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def device(self, address, priority=0, **kwargs):
+        """Return a Device view of the module with the given address"""
+        return BusDevice(self, address, priority=priority, **kwargs)
+
+    def submit(self, address, requests, priority=0):
+        """Queue requests for one module, return a Future of the replies"""
+        future = Future()
+        with self._cond:
+            if self._closed:
+                raise TMCLError("Bus", "bus is closed")
+            self._queue.put(address, (requests, future), priority)
+            self._cond.notify()
+        return future
+
+    def _serve(self):
+        """I/O thread: run one job at a time in FairQueue order"""
+        while True:
+            with self._cond:
+                while not self._queue and not self._closed:
+                    self._cond.wait()
+                if not self._queue:
+                    return
+                address, (requests, future) = self._queue.pop()
+            start = time.time()
+            try:
+                replies = self._link._exchange(requests)
+            except Exception as e:
+                future.set_exception(e)
+                continue
+            finally:
+                busy = time.time() - start
+                with self._cond:
+                    stats = self._occupancy.setdefault(address, [0, 0.0])
+                    stats[0] += len(requests)
+                    stats[1] += busy
+            future.set_result([self._check(address, rep) for rep in replies])
+
+    def _check(self, address, rep):
+        """Turn a reply that is not meant for us into a TMCLError"""
+        if isinstance(rep, TMCLError):
+            return rep
+        if rep.module_address != address or rep.reply_address != self.host_address:
+            return TMCLError("Bus", "reply from module {} to {}, expected module {} to {}".format(
+                rep.module_address, rep.reply_address, address, self.host_address))
+        return rep
+
+    def occupancy(self):
+        """
+        Bus usage per module address since the last reset:
+        telegrams exchanged, seconds the bus was busy, and share of the
+        elapsed time
+        """
+        with self._cond:
+            elapsed = max(time.time() - self._since, 1e-9)
+            return dict((address, {'telegrams': n, 'busy': busy, 'share': busy / elapsed})
+                        for address, (n, busy) in self._occupancy.iteritems())
+
+    def reset_occupancy(self):
+        with self._cond:
+            self._since = time.time()
+            self._occupancy = {}
+
+    def stats(self):
+        """Link statistics of the bus port, see Device.stats"""
+        return self._link.stats()
+
+    def close(self):
+        """Finish the queued jobs, stop the I/O thread and close the port"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join()
+        self._link._ser.close()
+
+
+
+class BusDevice(Device):
+    """Device view of one module on a Bus"""
+
+    def __init__(self, bus, address, priority=0, **kwargs):
+        super(BusDevice, self).__init__(port=None, address=address, **kwargs)
+        self._bus = bus
+        self.priority = priority
+
+    def _exchange(self, requests):
+        """Schedule requests on the bus and wait for the replies"""
+        return self._bus.submit(self.address, requests, self.priority).result()
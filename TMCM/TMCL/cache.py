@@ -0,0 +1,99 @@
+
+from consts import *
+
+
+GAP, SAP, RSAP = NUMBER_COMMANDS['GAP'], NUMBER_COMMANDS['SAP'], NUMBER_COMMANDS['RSAP']
+GGP, SGP, RSGP = NUMBER_COMMANDS['GGP'], NUMBER_COMMANDS['SGP'], NUMBER_COMMANDS['RSGP']
+
+MISS = object()
+
+
+
+def defaultVolatility():
+    """
+    Volatility class of every axis (int key) and global ((bank, n) key)
+    parameter: read-only parameters and the LIVE_* lists are V_LIVE,
+    everything else is V_STATIC
+    """
+    volatility = {}
+    for table, live in ((AXIS_PARAMETER, LIVE_AXIS_PARAMETERS),
+                        (GLOBAL_PARAMETER, LIVE_GLOBAL_PARAMETERS)):
+        for key, (_, _, access) in table.iteritems():
+            volatile = not access & T_W or key in live
+            volatility[key] = V_LIVE if volatile else V_STATIC
+    return volatility
+
+
+
+class ParameterCache(object):
+    """
+    Cache for GAP/GGP reads of V_STATIC parameters
+
+    Works on request tuples (address, command, type, motor|bank, value):
+    lookup() answers reads of static parameters, remember() records
+    the outcome of a successful command: GAP/GGP results and SAP/SGP
+    values are stored, RSAP/RSGP drop the restored entry. V_LIVE
+    parameters always pass through. Pass volatility={key: V_LIVE, ...}
+    to override the defaultVolatility() class of single parameters.
+    """
+
+    def __init__(self, volatility=None):
+        self.volatility = defaultVolatility()
+        self.volatility.update(volatility or {})
+        self._values = {}
+        self.reset_stats()
+
+    def _key(self, request):
+        """Cache key of a request, None if the request is not cacheable"""
+        _, cn, t, m, _ = request
+        if cn in (GAP, SAP, RSAP):
+            pn = t
+        elif cn in (GGP, SGP, RSGP):
+            pn = (m, t)
+        else:
+            return None
+        if self.volatility.get(pn, V_LIVE) == V_LIVE:
+            return None
+        return (cn in (GGP, SGP, RSGP), m, t)
+
+    def lookup(self, request):
+        """Cached value of a GAP/GGP request, MISS if it has to be sent"""
+        cn = request[1]
+        if cn != GAP and cn != GGP:
+            return MISS
+        key = self._key(request)
+        if key is None:
+            self.passes += 1
+            return MISS
+        value = self._values.get(key, MISS)
+        if value is MISS:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def remember(self, request, value):
+        """Update the cache after request succeeded with reply value"""
+        key = self._key(request)
+        if key is None:
+            return
+        cn = request[1]
+        if cn == GAP or cn == GGP:
+            self._values[key] = value
+        elif cn == SAP or cn == SGP:
+            self._values[key] = int(request[4])
+        else:
+            self._values.pop(key, None)
+
+    def clear(self):
+        """Forget all cached values"""
+        self._values.clear()
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'passes': self.passes,
+                'size': len(self._values)}
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+        self.passes = 0
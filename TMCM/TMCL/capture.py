@@ -0,0 +1,248 @@
+
+import mmap
+import struct
+import threading
+import time
+from collections import deque, namedtuple
+
+import codec
+from error import *
+from tracing import SEND, RECV, monotonic
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+# file header, then fixed size records:
+# monotonic timestamp, direction, frame length, frame (zero padded)
+MAGIC = "TMCLCAP\x01"
+RECORD_STRUCT = struct.Struct('<dBB9s')
+RECORD_SIZE = RECORD_STRUCT.size
+
+DIRECTIONS = {SEND: 0, RECV: 1}
+DIRECTION_NAMES = dict((v, k) for k, v in DIRECTIONS.iteritems())
+
+if np is not None:
+    RECORD_DTYPE = np.dtype([('timestamp', '<f8'), ('direction', 'u1'),
+                             ('length', 'u1'), ('frame', 'u1', (9,))])
+
+Record = namedtuple('Record', ['direction', 'timestamp', 'frame'])
+
+
+
+class CaptureWriter(object):
+    """
+    Tracer appending every telegram to a binary capture file
+
+        dev = Device(port, tracer=CaptureWriter("session.tmclcap"))
+
+    Records are packed into a buffer and written in blocks of
+    buffer_records, so capturing stays cheap under full polling load.
+    Call flush() or close() to write out the rest.
+    """
+
+    def __init__(self, path, buffer_records=256):
+        self.path = path
+        self.buffer_records = buffer_records
+        self._lock = threading.Lock()
+        self._buffer = []
+        self._file = open(path, 'ab')
+        if self._file.tell() == 0:
+            self._file.write(MAGIC)
+        self.records = 0
+
+    def __call__(self, event):
+        record = RECORD_STRUCT.pack(event.timestamp, DIRECTIONS[event.direction],
+                                    len(event.frame), event.frame)
+        with self._lock:
+            self._buffer.append(record)
+            self.records += 1
+            if len(self._buffer) >= self.buffer_records:
+                self._write()
+
+    def _write(self):
+        self._file.write("".join(self._buffer))
+        self._buffer = []
+
+    def flush(self):
+        with self._lock:
+            self._write()
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            if not self._file.closed:
+                self._write()
+                self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+
+class CaptureFile(object):
+    """
+    Memory-mapped capture file
+
+        cap = CaptureFile("session.tmclcap")
+        for record in cap:
+            print record.direction, record.timestamp, hexString(record.frame)
+        arr = cap.array()          # numpy structured array of all records
+
+    A partially written last record is ignored.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise TMCLError("capture", "{} is not a TMCL capture file".format(path))
+            f.seek(0, 2)
+            size = f.tell()
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size else None
+        self._count = (size - len(MAGIC)) // RECORD_SIZE
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self._count
+        if not 0 <= i < self._count:
+            raise IndexError(i)
+        timestamp, direction, length, frame = RECORD_STRUCT.unpack_from(
+            self._map, len(MAGIC) + i * RECORD_SIZE)
+        return Record(DIRECTION_NAMES[direction], timestamp, frame[:length])
+
+    def __iter__(self):
+        for i in xrange(self._count):
+            yield self[i]
+
+    def array(self):
+        """All records as a RECORD_DTYPE structured array (a copy)"""
+        if np is None:
+            raise TMCLError("capture", "numpy not available")
+        if not self._count:
+            return np.zeros(0, dtype=RECORD_DTYPE)
+        return np.frombuffer(self._map, dtype=RECORD_DTYPE, count=self._count,
+                             offset=len(MAGIC)).copy()
+
+    def frames(self, direction):
+        """The complete frames of one direction as an (N, 9) uint8 array"""
+        records = self.array()
+        records = records[(records['direction'] == DIRECTIONS[direction]) &
+                          (records['length'] == codec.COMMAND_STRING_LENGTH)]
+        return records['frame']
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+
+
+class ReplaySerial(object):
+    """
+    Serial-like port answering from a recorded session
+
+        dev = Device(port=ReplaySerial("session.tmclcap", speed=10.0))
+
+    Every write is matched against the next recorded requests, the
+    recorded replies that follow are returned with their recorded
+    delays divided by speed (speed=None: instantly). With strict, a
+    request that differs from the recording raises a TMCLError. A read
+    beyond the recorded replies returns short, like a timeout.
+    """
+
+    def __init__(self, capture, speed=1.0, strict=True):
+        if isinstance(capture, basestring):
+            capture = CaptureFile(capture)
+        self.records = list(capture)
+        self.speed = speed
+        self.strict = strict
+        self.is_open = True
+        self.timeout = None
+        self.position = 0
+        self._lock = threading.Lock()
+        self._pending = deque()
+        self._ready = ""
+
+    @property
+    def remaining(self):
+        """Recorded records not replayed yet"""
+        return len(self.records) - self.position
+
+    def write(self, data):
+        n = codec.COMMAND_STRING_LENGTH
+        now = monotonic()
+        with self._lock:
+            start = None
+            sent = 0
+            frames = len(data) // n
+            while self.position < len(self.records):
+                record = self.records[self.position]
+                if record.direction == SEND:
+                    if sent == frames:
+                        break
+                    frame = str(data[sent*n:sent*n+n])
+                    if self.strict and record.frame != frame:
+                        raise TMCLError("replay", "request #{} is {}, recorded {}".format(
+                            self.position, codec.hexString(frame), codec.hexString(record.frame)))
+                    if start is None:
+                        start = record.timestamp
+                    sent += 1
+                elif start is not None:
+                    delay = (record.timestamp - start) / self.speed if self.speed else 0.0
+                    self._pending.append((now + delay, record.frame))
+                self.position += 1
+        return len(data)
+
+    def _collect(self):
+        now = monotonic()
+        while self._pending and self._pending[0][0] <= now:
+            self._ready += self._pending.popleft()[1]
+
+    def read(self, size=1):
+        deadline = None if self.timeout is None else monotonic() + self.timeout
+        while True:
+            with self._lock:
+                self._collect()
+                if len(self._ready) >= size or not self._pending:
+                    break
+                wake = self._pending[0][0]
+            if deadline is not None:
+                if monotonic() >= deadline:
+                    break
+                wake = min(wake, deadline)
+            time.sleep(max(wake - monotonic(), 0))
+        with self._lock:
+            data, self._ready = self._ready[:size], self._ready[size:]
+        return data
+
+    @property
+    def in_waiting(self):
+        with self._lock:
+            self._collect()
+            return len(self._ready)
+
+    def reset_input_buffer(self):
+        with self._lock:
+            self._pending.clear()
+            self._ready = ""
+
+    def reset_output_buffer(self):
+        pass
+
+    def flush(self):
+        pass
+
+    def open(self):
+        self.is_open = True
+
+    def close(self):
+        self.is_open = False
@@ -1,5 +1,6 @@
 
-from collections import OrderedDict
+import struct
+from collections import OrderedDict, namedtuple
 
 from error import *
 
@@ -8,6 +9,15 @@ COMMAND_STRING_LENGTH = 9
 REQUEST_KEYS = ['module-address', 'command-number', 'type-number', 'motor-number']
 REPLY_KEYS = ['reply-address', 'module-address', 'status', 'command-number']
 
+Request = namedtuple('Request', ['module_address', 'command_number', 'type_number',
+                                 'motor_number', 'value', 'checksum'])
+Reply = namedtuple('Reply', ['reply_address', 'module_address', 'status',
+                             'command_number', 'value', 'checksum'])
+
+# precompiled layouts for the fast path: 4 header bytes, value, checksum
+FRAME_STRUCT = struct.Struct('>BBBBIB')
+VALUE_STRUCT = struct.Struct('>i')
+
 
 
 def byte(n):
@@ -96,9 +106,9 @@ def decodeCommand(cmd_string, keys):
     """
     byte_array = bytearray(cmd_string)
     if len(byte_array) != COMMAND_STRING_LENGTH:
-        raise TMCLError("Command-string length ({} bytes) does not equal {} bytes".format(len(byte_array), COMMAND_STRING_LENGTH))
+        raise TMCLLengthError("Command-string length ({} bytes) does not equal {} bytes".format(len(byte_array), COMMAND_STRING_LENGTH))
     if byte_array[8] != checksum(byte_array[:8]):
-        raise TMCLError("Checksum error in command {}: {} != {}".format(cmd_string, byte_array[8], checksum(byte_array[:8])))
+        raise TMCLChecksumError("Checksum error in command {}: {} != {}".format(cmd_string, byte_array[8], checksum(byte_array[:8])))
 
     result = OrderedDict()
     for i, k in enumerate(keys):
@@ -111,6 +121,69 @@ def decodeCommand(cmd_string, keys):
 
 
 
+def packCommand(p0, p1, p2, p3, value):
+    """
+    Encode a command string with the precompiled FRAME_STRUCT:
+    Byte-for-byte identical to encodeCommand([p0, p1, p2, p3], value)
+    """
+    p0 = int(p0) & 0xFF
+    p1 = int(p1) & 0xFF
+    p2 = int(p2) & 0xFF
+    p3 = int(p3) & 0xFF
+    v = int(value) & 0xFFFFFFFF
+    chsum = (p0 + p1 + p2 + p3 + (v & 0xFF) + ((v >> 8) & 0xFF) +
+             ((v >> 16) & 0xFF) + (v >> 24)) & 0xFF
+    return FRAME_STRUCT.pack(p0, p1, p2, p3, v, chsum)
+
+packRequestCommand = packCommand
+packReplyCommand = packCommand
+
+
+def encodeMany(requests):
+    """
+    Encode an iterable of request tuples
+    (m_address, n_command, n_type, n_motor, value)
+    into one contiguous string of 9-byte telegrams
+    """
+    requests = list(requests)
+    buf = bytearray(COMMAND_STRING_LENGTH * len(requests))
+    pack_into = FRAME_STRUCT.pack_into
+    for i, (p0, p1, p2, p3, value) in enumerate(requests):
+        p0 = int(p0) & 0xFF
+        p1 = int(p1) & 0xFF
+        p2 = int(p2) & 0xFF
+        p3 = int(p3) & 0xFF
+        v = int(value) & 0xFFFFFFFF
+        chsum = (p0 + p1 + p2 + p3 + (v & 0xFF) + ((v >> 8) & 0xFF) +
+                 ((v >> 16) & 0xFF) + (v >> 24)) & 0xFF
+        pack_into(buf, i * COMMAND_STRING_LENGTH, p0, p1, p2, p3, v, chsum)
+    return str(buf)
+
+
+def unpackCommand(cmd_string, record):
+    """
+    Decode a command string into a record (Request or Reply):
+    Same checks as decodeCommand, but without building an OrderedDict
+    """
+    byte_array = bytearray(cmd_string)
+    if len(byte_array) != COMMAND_STRING_LENGTH:
+        raise TMCLLengthError("Command-string length ({} bytes) does not equal {} bytes".format(len(byte_array), COMMAND_STRING_LENGTH))
+    chsum = sum(byte_array[:8]) & 0xFF
+    if byte_array[8] != chsum:
+        raise TMCLChecksumError("Checksum error in command {}: {} != {}".format(cmd_string, byte_array[8], chsum))
+    return record(byte_array[0], byte_array[1], byte_array[2], byte_array[3],
+                  VALUE_STRUCT.unpack_from(byte_array, 4)[0], byte_array[8])
+
+def unpackRequestCommand(cmd_string):
+    """Decode a request into a Request record using unpackCommand"""
+    return unpackCommand(cmd_string, Request)
+
+def unpackReplyCommand(cmd_string):
+    """Decode a reply into a Reply record using unpackCommand"""
+    return unpackCommand(cmd_string, Reply)
+
+
+
 def hexString(cmd):
     """Convert encoded command string to human-readable string of hex values"""
     s = ['{:x}'.format(i).rjust(2) for i in list(bytearray(cmd))]
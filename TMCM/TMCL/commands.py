@@ -0,0 +1,277 @@
+
+from collections import namedtuple
+from itertools import chain
+
+from consts import *
+from error import *
+
+
+# ranges with at most this many values become a frozenset lookup
+MAX_SET_SIZE = 4096
+
+CommandSpec = namedtuple('CommandSpec', ['name', 'number', 'motor', 'type', 'value', 'returns'])
+ParameterSpec = namedtuple('ParameterSpec', ['key', 'name', 'valid', 'access'])
+
+
+
+class Interval(object):
+    """Validator for values in range(low, high)"""
+
+    __slots__ = ['low', 'high']
+
+    def __init__(self, low, high):
+        self.low = low
+        self.high = high
+
+    def __contains__(self, value):
+        return self.low <= value < self.high
+
+    def __str__(self):
+        return "range({}, {})".format(self.low, self.high)
+
+
+class AllowedSet(object):
+    """Validator for values in any of several ranges, as precomputed set"""
+
+    __slots__ = ['values', 'ranges']
+
+    def __init__(self, ranges):
+        self.values = frozenset(chain(*[xrange(low, high) for low, high in ranges]))
+        self.ranges = ranges
+
+    def __contains__(self, value):
+        return value in self.values
+
+    def __str__(self):
+        return " + ".join("range({}, {})".format(low, high) for low, high in self.ranges)
+
+
+class AnyInterval(object):
+    """Validator for values in any of several large ranges"""
+
+    __slots__ = ['intervals']
+
+    def __init__(self, ranges):
+        self.intervals = [Interval(low, high) for low, high in ranges]
+
+    def __contains__(self, value):
+        for interval in self.intervals:
+            if interval.low <= value < interval.high:
+                return True
+        return False
+
+    def __str__(self):
+        return " + ".join(str(i) for i in self.intervals)
+
+
+def compileRanges(ranges):
+    """Precompile a consts TR_* range list into the fastest validator"""
+    if len(ranges) == 1:
+        return Interval(*ranges[0])
+    if sum(high - low for low, high in ranges) <= MAX_SET_SIZE:
+        return AllowedSet(ranges)
+    return AnyInterval(ranges)
+
+
+def compileParameters(table):
+    """ParameterSpec for every entry of AXIS_PARAMETER / GLOBAL_PARAMETER"""
+    return dict((key, ParameterSpec(key, name, compileRanges(ranges), access))
+                for key, (name, ranges, access) in table.iteritems())
+
+
+AXIS_SPECS = compileParameters(AXIS_PARAMETER)
+GLOBAL_SPECS = compileParameters(GLOBAL_PARAMETER)
+
+
+
+# --- field checkers ---------------------------------------------------------
+# motor(dev, c, motor) -> motor/bank byte
+# type(dev, c, n_type, m) -> type byte
+# value(dev, c, value, t, m) -> value
+
+def fixed(n):
+    """Checker that ignores its input and returns n"""
+    def check(dev, c, x, *fields):
+        return n
+    return check
+
+zero = fixed(0)
+
+
+def motor(dev, c, m):
+    mn = int(m)
+    if not 0 <= mn < dev.num_motors:
+        raise TMCLRangeError(c, "motor number", mn, dev.num_motors)
+    return mn
+
+def motorOrAll(dev, c, m):
+    mn = int(m)
+    if not (0 <= mn < dev.num_motors or mn == 0xFF):
+        raise TMCLRangeError(c, "motor number", mn, dev.num_motors)
+    return mn
+
+def bank(dev, c, b):
+    bn = int(b)
+    if not 0 <= bn < dev.num_banks:
+        raise TMCLRangeError(c, "bank number", bn, dev.num_banks)
+    return bn
+
+def ioBank(dev, c, b):
+    bn = int(b)
+    if not 0 <= bn < len(dev.max_output):
+        raise TMCLRangeError(c, "bank number", bn, len(dev.max_output))
+    return bn
+
+
+def typeOf(types):
+    """Checker mapping a type name of types (e.g. CMD_MVP_TYPES) to its number"""
+    def check(dev, c, t, m):
+        t = str(t)
+        if t not in types:
+            raise TMCLKeyError(c, "type", t, types)
+        return types[t]
+    return check
+
+def coordinate(dev, c, t, m):
+    coord_n = int(t)
+    if not 0 <= coord_n < dev.max_coordinate:
+        raise TMCLRangeError(c, "coordinate number", coord_n, dev.max_coordinate)
+    return coord_n
+
+def port(dev, c, t, m):
+    outp = int(t)
+    if not 0 <= outp < dev.max_output[m]:
+        raise TMCLRangeError(c, "output number @ bank{}".format(m), outp, dev.max_output[m])
+    return outp
+
+def axisParameter(dev, c, t, m):
+    pn = int(t)
+    if pn not in AXIS_SPECS:
+        raise TMCLKeyError(c, "parameter number", pn, AXIS_PARAMETER)
+    return pn
+
+def globalParameter(dev, c, t, m):
+    pn = int(t)
+    if (m, pn) not in GLOBAL_SPECS:
+        raise TMCLKeyError(c, "parameter number @ bank{}".format(m), pn, GLOBAL_PARAMETER)
+    return pn
+
+
+def runType(dev, c, t, m):
+    return int(bool(t))
+
+
+def velocity(dev, c, v, t, m):
+    v = int(v)
+    if not 0 <= v < dev.max_velocity:
+        raise TMCLRangeError(c, "velocity", v, dev.max_velocity)
+    return v
+
+def boolean(dev, c, v, t, m):
+    return int(bool(v))
+
+MVP_ABS, MVP_REL, MVP_COORD = CMD_MVP_TYPES['ABS'], CMD_MVP_TYPES['REL'], CMD_MVP_TYPES['COORD']
+
+def moveTarget(dev, c, v, t, m):
+    v = int(v)
+    if t == MVP_ABS and not -dev.max_position <= v < dev.max_position:
+        raise TMCLRangeError(c, "ABS: value", v, -dev.max_position, dev.max_position)
+    # pass 'REL' because we dont know the current pos here
+    if t == MVP_COORD and not 0 <= v < dev.max_coordinate:
+        raise TMCLRangeError(c, "COORD: value", v, dev.max_coordinate)
+    return v
+
+def position(dev, c, v, t, m):
+    pos = int(v)
+    if not -dev.max_position <= pos < dev.max_position:
+        raise TMCLRangeError(c, "position", pos, -dev.max_position, dev.max_position)
+    if m == 0xFF and pos != 0:
+        raise TMCLError(c, "special function requires pos == 0")
+    return pos
+
+def programAddress(dev, c, v, t, m):
+    address = int(v)
+    if not 0 <= address < 2**16:
+        raise TMCLRangeError(c, "program address", address, 2**16)
+    return address
+
+def axisValue(dev, c, v, t, m):
+    v = int(v)
+    spec = AXIS_SPECS[t]
+    if v not in spec.valid:
+        raise TMCLMissingElement(c, "parameter", repr(spec.name), str(spec.valid))
+    return v
+
+def globalValue(dev, c, v, t, m):
+    v = int(v)
+    spec = GLOBAL_SPECS[(m, t)]
+    if v not in spec.valid:
+        raise TMCLMissingElement(c, "parameter", repr(spec.name), str(spec.valid))
+    return v
+
+
+
+def command(name, check_motor, check_type, check_value, returns):
+    number = NUMBER_COMMANDS.get(name, NUMBER_CONTROL_COMMANDS.get(name))
+    return CommandSpec(name, number, check_motor, check_type, check_value, returns)
+
+COMMANDS = dict((spec.name, spec) for spec in [
+    #       name    motor/bank   type                      value       returns
+    command('ROR',  motor,       zero,                     velocity,   False),
+    command('ROL',  motor,       zero,                     velocity,   False),
+    command('MST',  motor,       zero,                     zero,       False),
+    command('MVP',  motor,       typeOf(CMD_MVP_TYPES),    moveTarget, False),
+    command('RFS',  motor,       typeOf(CMD_RFS_TYPES),    zero,       True),
+    command('CCO',  motor,       coordinate,               zero,       False),
+    command('SCO',  motorOrAll,  coordinate,               position,   False),
+    command('GCO',  motorOrAll,  coordinate,               zero,       True),
+    command('SIO',  fixed(2),    port,                     boolean,    False),
+    command('GIO',  ioBank,      port,                     zero,       True),
+    command('SAP',  motor,       axisParameter,            axisValue,  False),
+    command('GAP',  motor,       axisParameter,            zero,       True),
+    command('STAP', motor,       axisParameter,            zero,       False),
+    command('RSAP', motor,       axisParameter,            zero,       False),
+    command('SGP',  bank,        globalParameter,          globalValue, False),
+    command('GGP',  bank,        globalParameter,          zero,       True),
+    command('STGP', bank,        globalParameter,          zero,       False),
+    command('RSGP', bank,        globalParameter,          zero,       False),
+    command('STOP_APP',       zero, zero,      zero,           False),
+    command('RUN_APP',        zero, runType,   programAddress, False),
+    command('STEP_APP',       zero, zero,      zero,           False),
+    command('RESET_APP',      zero, zero,      zero,           False),
+    command('DOWNLOAD_START', zero, zero,      programAddress, False),
+    command('DOWNLOAD_END',   zero, zero,      zero,           False),
+    command('APP_STATUS',     zero, zero,      zero,           True),
+])
+
+
+
+def buildRequest(dev, c, n_type, motor, value=0):
+    """Validate the fields of command c for dev and return (request, returns)"""
+    spec = COMMANDS[c]
+    m = spec.motor(dev, c, motor)
+    t = spec.type(dev, c, n_type, m)
+    v = spec.value(dev, c, value, t, m)
+    return (dev.address, spec.number, t, m, v), spec.returns
+
+
+def buildRequests(dev, c, calls):
+    """
+    Validate a batch of (n_type, motor, value) fields of command c.
+    Return the request tuples, or raise a TMCLBatchError listing every
+    invalid call by index.
+    """
+    spec = COMMANDS[c]
+    check_motor, check_type, check_value = spec.motor, spec.type, spec.value
+    address, number = dev.address, spec.number
+    requests, errors = [], []
+    for i, (n_type, mn, value) in enumerate(calls):
+        try:
+            m = check_motor(dev, c, mn)
+            t = check_type(dev, c, n_type, m)
+            requests.append((address, number, t, m, check_value(dev, c, value, t, m)))
+        except TMCLError as e:
+            errors.append((i, e))
+    if errors:
+        raise TMCLBatchError(c, errors)
+    return requests
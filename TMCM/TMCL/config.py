@@ -0,0 +1,118 @@
+
+from consts import *
+from error import *
+
+
+AXIS_NAMES = dict((name, pn) for pn, (name, _, _) in AXIS_PARAMETER.iteritems())
+GLOBAL_NAMES = dict((name, key) for key, (name, _, _) in GLOBAL_PARAMETER.iteritems())
+
+
+
+def configKey(key):
+    """
+    Normalize a configuration key to ('axis', motor, parameter) or
+    ('global', bank, parameter), parameters may be given by name
+    """
+    if len(key) == 3 and key[0] == 'axis':
+        kind, mn, pn = key
+        if isinstance(pn, basestring):
+            if pn not in AXIS_NAMES:
+                raise TMCLKeyError("config", "axis parameter", pn, AXIS_NAMES)
+            pn = AXIS_NAMES[pn]
+        return ('axis', mn, pn)
+    if len(key) == 2 and key[0] == 'global' and isinstance(key[1], basestring):
+        if key[1] not in GLOBAL_NAMES:
+            raise TMCLKeyError("config", "global parameter", key[1], GLOBAL_NAMES)
+        return ('global',) + GLOBAL_NAMES[key[1]]
+    if len(key) == 3 and key[0] == 'global':
+        return key
+    raise TMCLError("config", "invalid key {!r}".format(key))
+
+
+def axisConfig(motors, parameters):
+    """Configuration setting the same {parameter: value} on every motor"""
+    return dict((('axis', mn, pn), value) for mn in motors for pn, value in parameters.iteritems())
+
+
+
+class ConfigReport(object):
+    """
+    Outcome of Device.apply_config
+
+    changes maps every key that differed to (current, desired), stored
+    lists the keys written to EEPROM, unchanged the keys already at
+    their desired value and errors the keys whose read or write failed.
+    With dry_run nothing was written.
+    """
+
+    def __init__(self, dry_run):
+        self.dry_run = dry_run
+        self.changes = {}
+        self.unchanged = []
+        self.stored = []
+        self.errors = {}
+
+    def __len__(self):
+        return len(self.changes)
+
+    def check(self):
+        """Raise the error of the first failed key, if any"""
+        if self.errors:
+            raise self.errors[min(self.errors)]
+
+    def __str__(self):
+        lines = ["{} {} {}: {} -> {}".format(kind, n, AXIS_PARAMETER[pn][0] if kind == 'axis'
+                                          else GLOBAL_PARAMETER[(n, pn)][0], old, new)
+                 for (kind, n, pn), (old, new) in sorted(self.changes.iteritems())]
+        lines.append("{} changed{}, {} unchanged, {} stored, {} errors".format(
+            len(self.changes), " (dry run)" if self.dry_run else "",
+            len(self.unchanged), len(self.stored), len(self.errors)))
+        return "\n".join(lines)
+
+
+
+def applyConfig(device, desired, store=False, dry_run=False):
+    """
+    Bring the parameters of device to desired, see Device.apply_config
+    """
+    desired = dict((configKey(key), int(value)) for key, value in desired.iteritems())
+    keys = sorted(desired)
+    # validate everything before touching the module
+    device.validate('SAP', [(pn, mn, desired[(kind, mn, pn)]) for kind, mn, pn in keys if kind == 'axis'])
+    device.validate('SGP', [(pn, bank, desired[(kind, bank, pn)]) for kind, bank, pn in keys if kind == 'global'])
+
+    report = ConfigReport(dry_run)
+    with device.pipeline() as p:
+        reads = [p.gap(n, pn) if kind == 'axis' else p.ggp(n, pn) for kind, n, pn in keys]
+    changed = []
+    for key, future in zip(keys, reads):
+        error = future.exception()
+        if error is not None:
+            report.errors[key] = error
+        elif future.result() == desired[key]:
+            report.unchanged.append(key)
+        else:
+            report.changes[key] = (future.result(), desired[key])
+            changed.append(key)
+    if dry_run or not changed:
+        return report
+
+    stores = []
+    with device.pipeline() as p:
+        writes = [p.sap(n, pn, desired[(kind, n, pn)]) if kind == 'axis'
+                  else p.sgp(n, pn, desired[(kind, n, pn)]) for kind, n, pn in changed]
+        if store:
+            for kind, n, pn in changed:
+                access = AXIS_PARAMETER[pn][2] if kind == 'axis' else GLOBAL_PARAMETER[(n, pn)][2]
+                if access & T_E:
+                    stores.append(((kind, n, pn), p.stap(n, pn) if kind == 'axis' else p.stgp(n, pn)))
+    for key, future in zip(changed, writes):
+        if future.exception() is not None:
+            report.errors[key] = future.exception()
+            del report.changes[key]
+    for key, future in stores:
+        if future.exception() is not None:
+            report.errors.setdefault(key, future.exception())
+        elif key in report.changes:
+            report.stored.append(key)
+    return report
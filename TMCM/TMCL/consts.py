@@ -10,6 +10,7 @@ STATUSCODES = { 100 : "Succesfully executed, no error",
               }
 
 STAT_OK = 100
+STAT_LOADED = 101
 
 COMMAND_NUMBERS = {  1 : "ROR",    2 : "ROL",    3 : "MST",
                      4 : "MVP",    5 : "SAP",    6 : "GAP",
@@ -27,6 +28,21 @@ COMMAND_NUMBERS = {  1 : "ROR",    2 : "ROL",    3 : "MST",
 
 NUMBER_COMMANDS = {v:k for k, v in COMMAND_NUMBERS.iteritems()}
 
+# direct mode only, control the TMCL program (standalone mode)
+CONTROL_COMMAND_NUMBERS = { 128 : "STOP_APP",        129 : "RUN_APP",
+                            130 : "STEP_APP",        131 : "RESET_APP",
+                            132 : "DOWNLOAD_START",  133 : "DOWNLOAD_END",
+                            135 : "APP_STATUS"
+                          }
+
+NUMBER_CONTROL_COMMANDS = {v:k for k, v in CONTROL_COMMAND_NUMBERS.iteritems()}
+
+APPLICATION_STATUS = { 0 : "STOP",
+                       1 : "RUN",
+                       2 : "STEP",
+                       3 : "RESET"
+                     }
+
 INTERRUPT_VECTORS = {   0 : "Timer 0",
                         1 : "Timer 1",
                         2 : "Timer 2",
@@ -50,6 +66,39 @@ CMD_RFS_TYPES = { 'START'  : 0,
                   'STATUS' : 2
                 }
 
+CMD_CALC_TYPES = { 'ADD'  : 0,
+                   'SUB'  : 1,
+                   'MUL'  : 2,
+                   'DIV'  : 3,
+                   'MOD'  : 4,
+                   'AND'  : 5,
+                   'OR'   : 6,
+                   'XOR'  : 7,
+                   'NOT'  : 8,
+                   'LOAD' : 9
+                 }
+
+CMD_CALCX_TYPES = dict(CMD_CALC_TYPES, SWAP=10)
+
+CMD_JC_TYPES = { 'ZE'  : 0,
+                 'NZ'  : 1,
+                 'EQ'  : 2,
+                 'NE'  : 3,
+                 'GT'  : 4,
+                 'GE'  : 5,
+                 'LT'  : 6,
+                 'LE'  : 7,
+                 'ETO' : 8,
+                 'EAL' : 9
+               }
+
+CMD_WAIT_TYPES = { 'TICKS' : 0,
+                   'POS'   : 1,
+                   'REFSW' : 2,
+                   'LIMSW' : 3,
+                   'RFS'   : 4
+                 }
+
 
 TR_24s = [(-2**23+1, 2**23)]
 TR_32u = [(0, 2**32)]
@@ -172,3 +221,28 @@ for b, p, a in zip([2]*256, range(256), ([T_RWE]*56) + ([T_RW]*200)):
     GLOBAL_PARAMETER[(2, p)] = ("general purpose reg#{0:0>3d}".format(p), TR_32s, a)
 
 
+
+
+# volatility classes: live parameters change without SAP/SGP (motion,
+# measurements, TMCL programs), static ones only when written
+V_STATIC = 0
+V_LIVE = 1
+
+LIVE_AXIS_PARAMETERS = [0, 1, 2, 3, 180]
+LIVE_GLOBAL_PARAMETERS = [(0, 128), (0, 129), (0, 130), (0, 132)] + [(2, p) for p in range(256)]
+
+# values of global parameter (0, 65) RS485 baud rate
+BAUD_RATES = {  0 : 9600,
+                1 : 14400,
+                2 : 19200,
+                3 : 28800,
+                4 : 38400,
+                5 : 57600,
+                6 : 76800,
+                7 : 115200,
+                8 : 230400,
+                9 : 250000,
+               10 : 500000,
+               11 : 1000000
+             }
+BAUD_RATE_NUMBERS = dict((v, k) for k, v in BAUD_RATES.iteritems())
@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+
+"""
+Daemon keeping a TMCL module open for local clients
+
+    python daemon.py /dev/ttyACM0 --cache &
+    tmcl gap 0 1
+
+The port is opened once and served over a UNIX socket to tmcl.py and
+tmcl.Client, which send one JSON request per line and get one JSON
+reply per line. Stop it with SIGTERM, ^C or "tmcl shutdown".
+"""
+
+import argparse
+import json
+import os
+import signal
+import socket
+import stat
+import sys
+import threading
+import time
+import SocketServer
+
+from consts import *
+from error import *
+from shared import SharedDevice
+from snapshot import SnapshotEngine
+from tmcl import defaultSocket
+
+
+# Device methods clients may call
+DEVICE_METHODS = ('ror', 'rol', 'mst', 'mvp', 'rfs', 'cco', 'sco', 'gco', 'sio', 'gio',
+                  'sap', 'gap', 'sgp', 'ggp', 'stap', 'rsap', 'stgp', 'rsgp',
+                  'wait_until_reached', 'wait_until_idle', 'apply_config',
+                  'run_program', 'stop_program', 'step_program', 'reset_program',
+                  'program_status', 'stats', 'reset_stats', 'reconnect')
+
+
+
+def removeStale(path):
+    """Remove the socket at path if no daemon answers on it"""
+    if not os.path.exists(path):
+        return
+    if not stat.S_ISSOCK(os.stat(path).st_mode):
+        raise TMCLError("daemon", "{} exists and is not a socket".format(path))
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(path)
+    except socket.error:
+        os.unlink(path)
+    else:
+        raise TMCLError("daemon", "a daemon is already running on {}".format(path))
+    finally:
+        probe.close()
+
+
+
+class _Server(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+
+class _Handler(SocketServer.StreamRequestHandler):
+    """One client connection, requests are served in order until EOF"""
+
+    def handle(self):
+        for line in iter(self.rfile.readline, ''):
+            try:
+                request = json.loads(line)
+            except ValueError:
+                reply = {'error': 'ValueError', 'message': "invalid request {!r}".format(line)}
+            else:
+                reply = self.server.tmcl.handle(request)
+            self.wfile.write(json.dumps(reply) + "\n")
+            if self.server.tmcl.stopping:
+                self.server.shutdown()
+                return
+
+
+
+class Daemon(object):
+    """
+    Serve a device to local clients over a UNIX socket
+
+        daemon = Daemon(SharedDevice("/dev/ttyACM0"), "/tmp/tmcl.sock")
+        daemon.serve_forever()
+
+    Requests are {"method": .., "args": [..], "kwargs": {..}}, replies
+    {"result": ..} or {"error": exception name, "message": ..}. Methods
+    are the DEVICE_METHODS plus ping, snapshot and shutdown. Every
+    client connection has its own thread, so the device must be thread
+    safe: a SharedDevice. A stale socket file is replaced, the socket
+    gets mode (owner only by default).
+    """
+
+    def __init__(self, device, path=None, mode=0600):
+        self.device = device
+        self.path = path or defaultSocket()
+        self.started = time.time()
+        self.requests = 0
+        self.stopping = False
+        self._lock = threading.Lock()
+        self._thread = None
+        removeStale(self.path)
+        self._server = _Server(self.path, _Handler)
+        self._server.tmcl = self
+        os.chmod(self.path, mode)
+
+    def handle(self, request):
+        """Reply to one decoded request"""
+        with self._lock:
+            self.requests += 1
+        try:
+            method = request['method']
+            args = request.get('args', [])
+            kwargs = dict((str(k), v) for k, v in request.get('kwargs', {}).iteritems())
+            if method in DEVICE_METHODS:
+                result = getattr(self.device, method)(*args, **kwargs)
+            elif method in ('ping', 'snapshot', 'shutdown'):
+                result = getattr(self, method)(*args, **kwargs)
+            else:
+                raise TMCLError("daemon", "unknown method {}".format(method))
+            if method == 'apply_config':
+                result = str(result)
+        except Exception as e:
+            return {'error': type(e).__name__, 'message': str(e)}
+        return {'result': result}
+
+    def ping(self):
+        """Daemon status"""
+        return {'pid': os.getpid(), 'socket': self.path, 'requests': self.requests,
+                'uptime': time.time() - self.started}
+
+    def snapshot(self, motors=None, banks=None):
+        """All parameter values as rows (kind, motor or bank, number, name, value)"""
+        engine = SnapshotEngine(self.device, motors=motors, banks=banks)
+        snapshot = engine.take()
+        def rows(items):
+            return [(kind, n, pn, (AXIS_PARAMETER[pn] if kind == 'axis'
+                                   else GLOBAL_PARAMETER[(n, pn)])[0], value)
+                    for (kind, n, pn), value in sorted(items)]
+        return {'values': rows(snapshot.values.iteritems()),
+                'errors': rows((key, str(e)) for key, e in snapshot.errors.iteritems())}
+
+    def shutdown(self):
+        """Stop serving once this request is answered"""
+        self.stopping = True
+
+    def serve_forever(self):
+        self._server.serve_forever()
+
+    def start(self):
+        """Serve in a background thread"""
+        self._thread = threading.Thread(target=self.serve_forever, name="TMCL-daemon")
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def close(self):
+        """Stop serving, remove the socket and close the device"""
+        if self._thread is not None:
+            self._server.shutdown()
+            self._thread.join()
+        self._server.server_close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self.device.close()
+
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Keep a TMCL module open for tmcl clients")
+    parser.add_argument('port', help="serial port or pyserial URL")
+    parser.add_argument('--socket', help="socket path (default: $TMCL_SOCKET or /tmp/tmcl-<uid>.sock)")
+    parser.add_argument('--mode', default='600', help="octal permissions of the socket")
+    parser.add_argument('--cache', action='store_true', help="cache parameter reads")
+    parser.add_argument('--debug', action='store_true', help="trace telegrams to stderr")
+    parser.add_argument('--timeout', type=float, default=None,
+                        help="seconds to wait for a reply from the module")
+    parser.add_argument('--queue-timeout', type=float, default=None,
+                        help="fail requests queued longer than this many seconds")
+    args = parser.parse_args(argv)
+
+    device = SharedDevice(args.port, cache=args.cache, debug=args.debug,
+                          timeout=args.timeout, queue_timeout=args.queue_timeout)
+    daemon = Daemon(device, args.socket, mode=int(args.mode, 8))
+
+    def terminate(signum, frame):
+        raise SystemExit(0)
+    signal.signal(signal.SIGTERM, terminate)
+    sys.stderr.write("TMCL daemon on {} serving {}\n".format(args.port, daemon.path))
+    try:
+        daemon.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        daemon.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
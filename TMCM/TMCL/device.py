@@ -1,58 +1,439 @@
 
+import sys
+import time
+
 import serial
 
 import codec
+from assembler import assemble
 from consts import *
 from error import *
+from framing import FrameParser, plausibleReply
+from futures import Future
+from cache import ParameterCache, MISS
+from commands import COMMANDS, buildRequest, buildRequests
+from config import applyConfig
+from link import tuneLink
+from metrics import Metrics
+from motion import waitFor
+from retry import RetryPolicy
+from tracing import StderrTracer, TraceEvent, SEND, RECV, monotonic
+
 
+DEFAULT_TIMEOUT = 1.0   # seconds, read timeout of ports opened by name
 
 
 class Device(object):
-    """Abstraction of a Device that understands TMCL via a serial port"""
+    """
+    Abstraction of a Device that understands TMCL via a serial port
+
+    baudrate, timeout and write_timeout are passed to the port (pyserial
+    defaults, but a port opened by name gets a DEFAULT_TIMEOUT so that
+    a lost reply can not block forever), pause leaves at least that
+    many seconds between a reply and the next request. retry is a
+    RetryPolicy (True for the default one) resending commands and
+    pipelines whose replies were lost, as far as that is safe.
+
+    Replies are read back in one go. If one does not decode, the reply
+    stream is realigned (see _resync), so a lost or stray byte costs
+    the replies it hit instead of every later one.
+    """
 
     def __init__(self, port="/dev/ttyACM0", debug=False,
                  num_motors=3, num_banks=4, max_output=(4, 3, 5),
-                 max_velocity=2048, max_coordinate=21, max_position=2**23):
+                 max_velocity=2048, max_coordinate=21, max_position=2**23,
+                 address=0x01, cache=False, tracer=None,
+                 baudrate=None, timeout=None, write_timeout=None, pause=0.0, retry=None):
         self._port = port
-        self._debug = debug
-        self._ser = serial.Serial(port)
+        link = dict((name, value) for name, value in (('baudrate', baudrate), ('timeout', timeout),
+                                                      ('write_timeout', write_timeout))
+                    if value is not None)
+        if isinstance(port, basestring):
+            link.setdefault('timeout', DEFAULT_TIMEOUT)
+            self._ser = serial.serial_for_url(port, **link)
+        else:
+            self._ser = port  # an open serial-like object
+            for name, value in link.iteritems():
+                setattr(self._ser, name, value)
+        self.pause = pause
+        self._last_exchange = 0.0
+        self._resync_pending = False
         self.num_motors = num_motors
         self.num_banks = num_banks
         self.max_output = max_output
         self.max_velocity = max_velocity
         self.max_coordinate = max_coordinate
         self.max_position = max_position
+        self.address = address
+        if cache is True:
+            cache = ParameterCache()
+        self.cache = cache or None
+        if retry is True:
+            retry = RetryPolicy()
+        self.retry = retry or None
+        self._metrics = Metrics()
+        if tracer is None and debug:
+            tracer = StderrTracer()
+        self.tracer = tracer
 
     def _query(self, request):
         """Encode and send a query. Recieve, decode, and return reply"""
-        req = codec.encodeRequestCommand(*request)
-        if self._debug:
-            print "send to TMCL: ", codec.hexString(req), codec.decodeRequestCommand(req)
+        if self.retry is not None:
+            rep = self.retry.exchange(self, [request])[0]
+        else:
+            rep = self._exchange([request])[0]
+        if isinstance(rep, TMCLError):
+            raise rep
+        return rep.status, rep.value
+
+    def _exchange(self, requests):
+        """
+        Encode a list of queries and send them in one write.
+        Recieve and decode the replies, which arrive in order.
+        A reply that can not be decoded is returned as its TMCLError.
+        """
+        n = codec.COMMAND_STRING_LENGTH
+        req = codec.encodeMany(requests)
+        tracer = self.tracer
+        if tracer is not None:
+            traceRequests(tracer, requests, req)
+        metrics = self._metrics
+        if self.pause:
+            wait = self._last_exchange + self.pause - time.time()
+            if wait > 0:
+                time.sleep(wait)
+        if self._resync_pending:
+            self._flush()
+        start = time.time()
         self._ser.write(req)
-        rep = codec.decodeReplyCommand(self._ser.read(9))
-        if self._debug:
-            tmp = rep.values()[:-1]
-            tmp = codec.encodeReplyCommand(*tmp)
-            print "got from TMCL:", codec.hexString(tmp), rep
-        return rep['status'], rep['value']
-
-    def _pn_checkrange(self, parameter_number, value, prefix):
-        """Check if value is valid for given parameter_number"""
-        pn = int(parameter_number)
-        v = int(value)
-        DICT = AXIS_PARAMETER if type(pn) == int else GLOBAL_PARAMETER
-        if not pn in DICT:
-            raise TMCLKeyError(prefix, "parameter number", pn, DICT)
-        name, ranges, _ = DICT[parameter_number]
-        NOTINRANGE = False
-        for (l, h) in ranges:
-            if not (l <= v < h):
-                NOTINRANGE = True
-        if NOTINRANGE:
-            raise TMCLMissingElement(prefix, "parameter", repr(name),
-                                      " + ".join(["range({}, {})".format(l, h)
-                                      for l, h in ranges]))
-        return pn, v
+        rep_string = self._ser.read(n * len(requests))
+        frames = [rep_string[i*n:i*n+n] for i in xrange(len(requests))]
+        replies = []
+        failed = False
+        for frame in frames:
+            try:
+                replies.append(codec.unpackReplyCommand(frame))
+            except TMCLError as e:
+                replies.append(e)
+                failed = True
+        received = len(rep_string)
+        if failed:
+            frames, replies, received = self._resync(requests, frames, replies)
+        self._last_exchange = time.time()
+        # a batch shares its round trip: every reply counts its share
+        elapsed = (self._last_exchange - start) / len(requests)
+        if tracer is not None:
+            timestamp = monotonic()
+        metrics.sent(len(req), len(requests))
+        metrics.received(received)
+        for request, frame, rep in zip(requests, frames, replies):
+            if tracer is not None:
+                tracer(TraceEvent(RECV, timestamp, frame, rep))
+            metrics.record(request[1], elapsed, rep)
+        return replies
+
+    def _resync(self, requests, frames, replies):
+        """
+        Realign the replies to requests after a reply failed to decode
+
+        The bytes read so far and as many more as arrive within the
+        port timeout are scanned with a FrameParser for replies of the
+        requested module and command. The bytes skipped in front of
+        a reply tell how many replies were lost, each lost or missing
+        reply keeps its frame and decoding error (or gets a
+        TMCLLengthError / TMCLTimeoutError), the others are matched as
+        usual. A reply lost without skipped bytes to show where (noticed
+        by the command of the next reply, or missing at the end) may
+        have been any earlier one of the same command, those fail too
+        rather than be matched to the wrong request. If the stream
+        could not be accounted for, the input is flushed before the
+        next exchange. Every reply path goes through here, the Gateway
+        forwards its messages as exchanges too. Returns frames, replies
+        and the number of bytes read.
+        """
+        n = codec.COMMAND_STRING_LENGTH
+        count = len(requests)
+        parser = FrameParser()
+        parser.feed("".join(frames))
+        received = len(parser)
+        addresses = set((request[0], request[1]) for request in requests)
+        accept = lambda rep: plausibleReply(rep) and (rep.module_address, rep.command_number) in addresses
+        frames = list(frames)
+        realigned = [None] * count
+        unlocated = {}  # (address, command) -> last reply lost without skipped bytes
+        index = 0
+        while index < count:
+            found = parser.next(accept)
+            if found is None:
+                if received > 2 * n * (count + 1):
+                    break  # noise, give up
+                more = self._ser.read(max(n * (count - index) - len(parser), 1))
+                if not more:
+                    break
+                received += len(more)
+                parser.feed(more)
+                continue
+            rep, frame, skipped = found
+            located = min(index + int(round(skipped / float(n))), count - 1)
+            slot = located
+            if tuple(requests[slot][:2]) != (rep.module_address, rep.command_number):
+                slot = next((i for i in xrange(index, count)
+                             if tuple(requests[i][:2]) == (rep.module_address, rep.command_number)), None)
+                if slot is None:
+                    continue  # a stray reply, not to any request left
+            for i in xrange(located, slot):
+                unlocated[tuple(requests[i][:2])] = i
+            for i in xrange(index, slot):
+                realigned[i] = replies[i] if isinstance(replies[i], TMCLError) else \
+                    TMCLLengthError(COMMAND_NUMBERS.get(requests[i][1]), "reply lost")
+            realigned[slot] = rep
+            frames[slot] = frame
+            index = slot + 1
+        for i in xrange(index, count):
+            unlocated[tuple(requests[i][:2])] = i
+        for i in xrange(index):
+            # a reply lost without a trace may have been any earlier one of the same command
+            if i < unlocated.get(tuple(requests[i][:2]), -1) and not isinstance(realigned[i], TMCLError):
+                realigned[i] = TMCLLengthError(COMMAND_NUMBERS.get(requests[i][1]),
+                                               "reply lost, can not tell which")
+        for i in xrange(index, count):
+            realigned[i] = replies[i] if isinstance(replies[i], TMCLError) else \
+                TMCLTimeoutError(COMMAND_NUMBERS.get(requests[i][1]), "no reply")
+        self._resync_pending = index < count or len(parser) > 0
+        parser.drop()
+        self._metrics.resynced(parser.resyncs, parser.stray)
+        return frames, realigned, received
+
+    def _flush(self):
+        """Discard whatever is left of earlier replies"""
+        reset = getattr(self._ser, 'reset_input_buffer', None)
+        if reset is not None:
+            reset()
+        self._resync_pending = False
+
+    def _command(self, c, request, returns=True):
+        """Query request for command c, check the status, return value"""
+        cache = self.cache
+        if cache is not None:
+            value = cache.lookup(request)
+            if value is not MISS:
+                return value if returns else None
+        status, value = self._query(request)
+        if status != STAT_OK:
+            raise TMCLStatusError(c, STATUSCODES.get(status, status))
+        if cache is not None:
+            cache.remember(request, value)
+        return value if returns else None
+
+    def stats(self):
+        """
+        Link statistics since the last reset_stats(): bytes written and
+        read, telegrams and telegrams per second, checksum errors,
+        timeouts, non-OK statuses by code and round trip latency
+        histograms per command (a pipelined batch of n telegrams counts
+        1/n of its round trip for each)
+        """
+        return self._metrics.snapshot()
+
+    def reset_stats(self):
+        self._metrics.reset()
+
+    def reconnect(self):
+        """Close and reopen the serial port, forget all cached parameters"""
+        self._ser.close()
+        self._ser.open()
+        if self.cache is not None:
+            self.cache.clear()
+
+    def link_settings(self):
+        """Current baudrate, read and write timeout of the port, and pause"""
+        return {'baudrate': getattr(self._ser, 'baudrate', None),
+                'timeout': getattr(self._ser, 'timeout', None),
+                'write_timeout': getattr(self._ser, 'write_timeout', None),
+                'pause': self.pause}
+
+    def configure_link(self, **settings):
+        """
+        Change link settings of the host side, only those given:
+        baudrate, timeout / write_timeout (seconds, None blocks) and
+        pause (seconds left between a reply and the next request)
+        """
+        for name, value in settings.iteritems():
+            if name == 'pause':
+                self.pause = value
+            elif name in ('baudrate', 'timeout', 'write_timeout'):
+                setattr(self._ser, name, value)
+            else:
+                raise TMCLKeyError("configure_link", "link setting", name, self.link_settings())
+
+    def tune_link(self, **kwargs):
+        """
+        Step module and host to the fastest reliable baud rate and
+        telegram pause time, see link.tuneLink
+        """
+        return tuneLink(self, **kwargs)
+
+    def pipeline(self, max_pending=None):
+        """
+        Return a Pipeline that queues commands instead of sending them.
+
+        with device.pipeline() as p:
+            pos = [p.gap(mn, 1) for mn in range(3)]
+        print [f.result() for f in pos]
+
+        All queued requests are written back-to-back when the block is
+        left (or p.execute() is called), every command gets a Future.
+        """
+        return Pipeline(self, max_pending=max_pending)
+
+    def wait_until_reached(self, motors=None, timeout=None, clock=None):
+        """
+        Block until motors (a motor number or a list, default all)
+        reached their target position, return {motor: actual position}.
+        Polls adaptively, see motion.waitFor.
+        """
+        return waitFor(self, motors, False, timeout, clock)
+
+    def wait_until_idle(self, motors=None, timeout=None, clock=None):
+        """
+        Block until motors stand still, i.e. reached their target or
+        were stopped, return {motor: actual position}.
+        """
+        return waitFor(self, motors, True, timeout, clock)
+
+    def stream(self, params=None, motors=None, rate=None, capacity=4096, background=False):
+        """
+        Poll axis parameters params (default: actual position, speed,
+        load value and current) of motors at rate samples per second,
+        or as fast as possible. Samples go into a NumPy ring buffer
+        holding the last capacity of them.
+
+        for timestamp, row in device.stream([1, 3], rate=100):
+            ...
+
+        Return the telemetry.Sampler, iterate it to sample in this
+        thread or pass background=True to sample in its own thread.
+        """
+        import telemetry
+        if params is None:
+            params = telemetry.DEFAULT_TELEMETRY
+        sampler = telemetry.Sampler(self, params, motors, rate, capacity)
+        return sampler.start() if background else sampler
+
+    def apply_config(self, desired, store=False, dry_run=False):
+        """
+        Bring axis and global parameters to desired, a dict keyed
+        ('axis', motor, parameter) / ('global', bank, parameter) like a
+        Snapshot (parameters may also be given by name):
+
+        report = device.apply_config({('axis', 0, 4): 1000, ('global', 0, 77): 1},
+                                     store=True)
+        print report
+
+        All values are validated first, the current values are read in
+        one pipelined batch and only the differing ones are written,
+        with store also stored to EEPROM (a value already set in RAM is
+        not stored again). Return a config.ConfigReport, with dry_run
+        nothing is written.
+        """
+        return applyConfig(self, desired, store, dry_run)
+
+    def download(self, program, origin=0, chunk=32):
+        """
+        Stop the TMCL program and load program (an assembler.Program or
+        TMCL source) into the module's program memory at origin. The
+        instructions are sent pipelined, chunk at a time, and must be
+        answered with STAT_LOADED. Return the number of instructions.
+        """
+        requests = assemble(program, self.address, origin)
+        self._control('STOP_APP', 0, 0)
+        self._control('DOWNLOAD_START', 0, 0, origin)
+        try:
+            for i in xrange(0, len(requests), chunk):
+                replies = self._exchange(requests[i:i+chunk])
+                for request, rep in zip(requests[i:i+chunk], replies):
+                    if isinstance(rep, TMCLError):
+                        raise rep
+                    if rep.status != STAT_LOADED:
+                        raise TMCLStatusError(COMMAND_NUMBERS[request[1]],
+                                              STATUSCODES.get(rep.status, rep.status))
+        except Exception:
+            exc_type, exc_value, traceback = sys.exc_info()
+            try:
+                self._control('DOWNLOAD_END', 0, 0)
+            except TMCLError:
+                pass  # the download error is the one to report
+            raise exc_type, exc_value, traceback
+        else:
+            self._control('DOWNLOAD_END', 0, 0)
+        return len(requests)
+
+    def run_program(self, address=None):
+        """
+        Start the TMCL program at address, or where it stopped.
+        A running program changes parameters, so the cache is cleared.
+        """
+        if self.cache is not None:
+            self.cache.clear()
+        if address is None:
+            return self._dispatch('RUN_APP', 0, 0)
+        return self._dispatch('RUN_APP', 1, 0, address)
+
+    def stop_program(self):
+        return self._dispatch('STOP_APP', 0, 0)
+
+    def step_program(self):
+        """Execute the next instruction of the TMCL program"""
+        return self._dispatch('STEP_APP', 0, 0)
+
+    def reset_program(self):
+        """Stop the TMCL program and set the program counter to 0"""
+        return self._dispatch('RESET_APP', 0, 0)
+
+    def program_status(self):
+        """
+        (status, program counter) of the TMCL program in one exchange,
+        status is a name of APPLICATION_STATUS
+        """
+        with self.pipeline() as p:
+            status, counter = p.ggp(0, 128), p.ggp(0, 130)
+        status = status.result()
+        return APPLICATION_STATUS.get(status, status), counter.result()
+
+    def _dispatch(self, c, n_type, motor, value=0):
+        """Validate command c with its CommandSpec, send it, return value"""
+        request, returns = buildRequest(self, c, n_type, motor, value)
+        return self._command(c, request, returns)
+
+    def _control(self, c, n_type, motor, value=0):
+        """_dispatch that waits for the reply, also where commands return Futures"""
+        with self.pipeline() as p:
+            future = p._dispatch(c, n_type, motor, value)
+        return future.result()
+
+    def validate(self, c, calls):
+        """
+        Validate a batch of (type, motor|bank, value) fields of command c
+        at once, e.g. validate('SAP', [(4, 0, 1000), (5, 0, 500)]).
+        Return the request tuples or raise a TMCLBatchError naming every
+        invalid call.
+        """
+        return buildRequests(self, c, calls)
+
+    def dispatch_many(self, c, calls):
+        """
+        Validate all (type, motor|bank, value) calls of command c first,
+        then send them in one pipelined exchange. Return their values,
+        raise a TMCLBatchError for invalid calls or failed replies.
+        """
+        requests = buildRequests(self, c, calls)
+        returns = COMMANDS[c].returns
+        with self.pipeline() as p:
+            futures = [p._command(c, request, returns) for request in requests]
+        errors = [(i, f.exception()) for i, f in enumerate(futures) if f.exception() is not None]
+        if errors:
+            raise TMCLBatchError(c, errors)
+        return [f.result() for f in futures]
 
     def ror(self, motor_number, velocity):
         """
@@ -65,18 +446,7 @@ class Device(object):
 
         TMCL-Mnemonic: ROR <motor number>, <velocity>
         """
-        c = 'ROR'
-        cn = NUMBER_COMMANDS[c]
-        mn = int(motor_number)
-        v = int(velocity)
-        if not 0 <= mn < self.num_motors:
-            raise TMCLRangeError(c, "motor number", mn, self.num_motors)
-        if not 0 <= v < self.max_velocity:
-            raise TMCLRangeError(c, "velocity", v, self.max_velocity)
-        status, _ = self._query((0x01, cn, 0x00, mn, v))
-        if status != STAT_OK:
-            raise TMCLStatusError(c, STATUSCODES[status])
-        return None
+        return self._dispatch('ROR', 0, motor_number, velocity)
 
     def rol(self, motor_number, velocity):
         """
@@ -90,18 +460,7 @@ class Device(object):
 
         TMCL-Mnemonic: ROL <motor number>, <velocity>
         """
-        c = 'ROL'
-        cn = NUMBER_COMMANDS[c]
-        mn = int(motor_number)
-        v = int(velocity)
-        if not 0 <= mn < self.num_motors:
-            raise TMCLRangeError(c, "motor number", mn, self.num_motors)
-        if not 0 <= v < self.max_velocity:
-            raise TMCLRangeError(c, "velocity", v, self.max_velocity)
-        status, _ = self._query((0x01, cn, 0x00, mn, v))
-        if status != STAT_OK:
-            raise TMCLStatusError(c, STATUSCODES[status])
-        return None
+        return self._dispatch('ROL', 0, motor_number, velocity)
 
     def mst(self, motor_number):
         """
@@ -113,15 +472,7 @@ class Device(object):
 
         TMCL-Mnemonic: MST <motor number>
         """
-        c = 'MST'
-        cn = NUMBER_COMMANDS[c]
-        mn = int(motor_number)
-        if not 0 <= mn < self.num_motors:
-            raise TMCLRangeError(c, "motor number", mn, self.num_motors)
-        status, _ = self._query((0x01, cn, 0x00, mn, 0x00))
-        if status != STAT_OK:
-            raise TMCLStatusError(c, STATUSCODES[status])
-        return None
+        return self._dispatch('MST', 0, motor_number)
 
     def mvp(self, motor_number, cmdtype, value):
         """
@@ -151,25 +502,7 @@ class Device(object):
         TMCL-Mnemonic: MVP <ABS|REL|COORD>, <motor number>,
                            <position|offset|coordinate number>
         """
-        c = 'MVP'
-        cn = NUMBER_COMMANDS[c]
-        mn = int(motor_number)
-        t = str(cmdtype)
-        v = int(value)
-        if not 0 <= mn < self.num_motors:
-            raise TMCLRangeError(c, "motor number", mn, self.num_motors)
-        if t not in CMD_MVP_TYPES:
-            raise TMCLKeyError(c, "type", t, CMD_MVP_TYPES)
-        if t == 'ABS' and not -self.max_position <= v < self.max_position:
-            raise TMCLRangeError(c, t + ": value", v, -self.max_position, self.max_position)
-        # pass 'REL' because we dont know the current pos here
-        if t == 'COORD' and not 0 <= v < self.max_coordinate:
-            raise TMCLRangeError(c, t + ": value", v, self.max_coordinate)
-        t = codec.byte(CMD_MVP_TYPES[t])
-        status, value = self._query((0x01, cn, t, mn, v))
-        if status != STAT_OK:
-            raise TMCLStatusError(c, STATUSCODES[status])
-        return None
+        return self._dispatch('MVP', cmdtype, motor_number, value)
 
     def rfs(self, motor_number, cmdtype):
         """
@@ -195,19 +528,7 @@ class Device(object):
 
         TMCL-Mnemonic: RFS <START|STOP|STATUS>, <motor number>
         """
-        c = 'RFS'
-        cn = NUMBER_COMMANDS[c]
-        mn = int(motor_number)
-        t = str(cmdtype)
-        if not 0 <= mn < self.num_motors:
-            raise TMCLRangeError(c, "motor number", mn, self.num_motors)
-        if t not in CMD_RFS_TYPES:
-            raise TMCLKeyError(c, "type", t, CMD_RFS_TYPES)
-        t = codec.byte(CMD_RFS_TYPES[t])
-        status, value = self._query((0x01, cn, t, mn, 0x0000))
-        if status != STAT_OK:
-            raise TMCLStatusError(c, STATUSCODES[status])
-        return value if t == CMD_RFS_TYPES['STATUS'] else 0
+        return self._dispatch('RFS', cmdtype, motor_number)
 
     def cco(self, motor_number, coordinate_number):
         """
@@ -225,18 +546,7 @@ class Device(object):
 
         TMCL-Mnemonic: CCO <coordinate number>, <motor number>
         """
-        c = 'CCO'
-        cn = NUMBER_COMMANDS[c]
-        mn = int(motor_number)
-        coord_n = int(coordinate_number)
-        if not 0 <= mn < self.num_motors:
-            raise TMCLRangeError(c, "motor number", mn, self.num_motors)
-        if not 0 <= coord_n < self.max_coordinate:
-            raise TMCLRangeError(c, "coordinate number", coord_n, self.max_coordinate)
-        status, _ = self._query((0x01, cn, coord_n, mn, 0x0000))
-        if status != STAT_OK:
-            raise TMCLStatusError(c, STATUSCODES[status])
-        return None
+        return self._dispatch('CCO', coordinate_number, motor_number)
 
     def sco(self, motor_number, coordinate_number, position):
         """
@@ -255,23 +565,7 @@ class Device(object):
 
         TMCL-Mnemonic: SCO <coordinate number>, <motor number>, <position>
         """
-        c = 'SCO'
-        cn = NUMBER_COMMANDS[c]
-        mn = int(motor_number)
-        coord_n = int(coordinate_number)
-        pos = int(position)
-        if not 0 <= coord_n < self.max_coordinate:
-            raise TMCLRangeError(c, "coordinate number", coord_n, self.max_coordinate)
-        if not -self.max_position <= pos < self.max_position:
-            raise TMCLRangeError(c, "position", pos, -self.max_position, self.max_position)
-        if not 0 <= mn < self.num_motors:
-            raise TMCLRangeError(c, "motor number", mn, self.num_motors)
-        elif not (mn == 0xFF and pos == 0):
-            raise TMCLError(c, "special function requires pos == 0")
-        status, _ = self._query((0x01, cn, coord_n, mn, pos))
-        if status != STAT_OK:
-            raise TMCLStatusError(c, STATUSCODES[status])
-        return None
+        return self._dispatch('SCO', coordinate_number, motor_number, position)
 
     def gco(self, motor_number, coordinate_number):
         """
@@ -293,18 +587,7 @@ class Device(object):
 
         TMCL-Mnemonic: GCO <coordinate number>, <motor number>
         """
-        c = 'GCO'
-        cn = NUMBER_COMMANDS[c]
-        mn = int(motor_number)
-        coord_n = int(coordinate_number)
-        if not 0 <= coord_n < self.max_coordinate:
-            raise TMCLRangeError(c, "coordinate number", coord_n, self.max_coordinate)
-        if not (0 <= mn < self.num_motors or mn == 0xFF):
-            raise TMCLRangeError(c, "motor number", mn, self.num_motors)
-        status, value = self._query((0x01, cn, coord_n, mn, 0))
-        if status != STAT_OK:
-            raise TMCLStatusError(c, STATUSCODES[status])
-        return value
+        return self._dispatch('GCO', coordinate_number, motor_number)
 
     def sio(self, port_number, state):
         """
@@ -317,17 +600,7 @@ class Device(object):
 
         TMCL-Mnemonic: SIO <port number>, <bank number>, <value>
         """
-        c = 'SIO'
-        cn = NUMBER_COMMANDS[c]
-        outp = int(port_number)
-        bank = 0x02
-        s = bool(state)
-        if not 0 <= outp < self.max_output[bank]:
-            raise TMCLRangeError(c, "output number", outp, self.max_output[bank])
-        status, _ = self._query((0x01, cn, outp, bank, s))
-        if status != STAT_OK:
-            raise TMCLStatusError(c, STATUSCODES[status])
-        return None
+        return self._dispatch('SIO', port_number, 2, state)
 
     def gio(self, port_number, bank_number):
         """
@@ -345,25 +618,7 @@ class Device(object):
 
         TMCL-Mnemonic: GIO <port number>, <bank number>
         """
-        c = 'GIO'
-        cn = NUMBER_COMMANDS[c]
-        outp = int(port_number)
-        bank = int(bank_number)
-        if bank == 0:
-            if not (0 <= outp < self.max_output[bank]):
-                raise TMCLRangeError(c, "output number @ bank{}".format(bank), outp, self.max_output[bank])
-        elif bank == 1:
-            if not (0 <= outp < self.max_output[bank]):
-                raise TMCLRangeError(c, "output number @ bank{}".format(bank), outp, self.max_output[bank])
-        elif bank == 2:
-            if not (0 <= outp < self.max_output[bank]):
-                raise TMCLRangeError(c, "output number @ bank{}".format(bank), outp, self.max_output[bank])
-        else:
-            raise TMCLRangeError(c, "bank number", bank, len(self.max_output))
-        status, value = self._query((0x01, cn, outp, bank, 0x0000))
-        if status != STAT_OK:
-            raise TMCLStatusError(c, STATUSCODES[status])
-        return value
+        return self._dispatch('GIO', port_number, bank_number)
 
     def sap(self, motor_number, parameter_number, value):
         """
@@ -379,18 +634,7 @@ class Device(object):
 
         TMCL-Mnemonic: SAP <parameter number>, <motor number>, <value>
         """
-        c = 'SAP'
-        cn = NUMBER_COMMANDS[c]
-        mn = int(motor_number)
-        pn = int(parameter_number)
-        v = int(value)
-        if not 0 <= mn < self.num_motors:
-            raise TMCLRangeError(c, "motor number", mn, self.num_motors)
-        pn, v = self._pn_checkrange(pn, v, c)
-        status, value = self._query((0x01, cn, pn, mn, v))
-        if status != STAT_OK:
-            raise TMCLStatusError(c, STATUSCODES[status])
-        return None
+        return self._dispatch('SAP', parameter_number, motor_number, value)
 
     def gap(self, motor_number, parameter_number):
         """
@@ -408,18 +652,7 @@ class Device(object):
 
         TMCL-Mnemonic: GAP <parameter number>, <motor number>
         """
-        c = 'GAP'
-        cn = NUMBER_COMMANDS[c]
-        mn = int(motor_number)
-        pn = int(parameter_number)
-        if not 0 <= mn < self.num_motors:
-            raise TMCLRangeError(c, "motor number", mn, self.num_motors)
-        if pn not in AXIS_PARAMETER:
-            raise TMCLKeyError(c, "parameter number", pn, AXIS_PARAMETER)
-        status, value = self._query((0x01, cn, pn, mn, 0x0000))
-        if status != STAT_OK:
-            raise TMCLStatusError(c, STATUSCODES[status])
-        return value
+        return self._dispatch('GAP', parameter_number, motor_number)
 
     def sgp(self, bank_number, parameter_number, value):
         """
@@ -444,18 +677,7 @@ class Device(object):
 
         TMCL-Mnemonic: SGP <parameter number>, <bank number>, <value>
         """
-        c = 'SGP'
-        cn = NUMBER_COMMANDS[c]
-        bn = int(bank_number)
-        pn = int(parameter_number)
-        v = int(value)
-        if not 0 <= bn < self.num_banks:
-            raise TMCLRangeError(c, "bank number", bn, self.num_banks)
-        pn, v = self._pn_checkrange((bn, pn), v, c)
-        status, value = self._query((0x01, cn, pn, bn, v))
-        if status != STAT_OK:
-            raise TMCLStatusError(c, STATUSCODES[status])
-        return None
+        return self._dispatch('SGP', parameter_number, bank_number, value)
 
     def ggp(self, bank_number, parameter_number):
         """
@@ -476,18 +698,7 @@ class Device(object):
 
         TMCL-Mnemonic: GGP <parameter number>, <bank number>
         """
-        c = 'GGP'
-        cn = NUMBER_COMMANDS[c]
-        bn = int(bank_number)
-        pn = int(parameter_number)
-        if not 0 <= bn < self.num_banks:
-            raise TMCLRangeError(c, "bank number", bn, self.num_banks)
-        if not (bn, pn) in GLOBAL_PARAMETER:
-            raise TMCLKeyError(c, "parameter number @ bank{}".format(bn), pn, AXIS_PARAMETER)
-        status, value = self._query((0x01, cn, pn, bn, 0x0000))
-        if status != STAT_OK:
-            raise TMCLStatusError(c, STATUSCODES[status])
-        return value
+        return self._dispatch('GGP', parameter_number, bank_number)
 
     def stap(self, motor_number, parameter_number):
         """
@@ -501,43 +712,146 @@ class Device(object):
 
         TMCL-Mnemonic: STAP <parameter number>, <motor number>
         """
-        c = 'STAP'
-        cn = NUMBER_COMMANDS[c]
-        mn = int(motor_number)
-        pn = int(parameter_number)
-        if not 0 <= mn < self.num_motors:
-            raise TMCLRangeError(c, "motor number", mn, self.num_motors)
-        if not pn in AXIS_PARAMETER:
-            raise TMCLKeyError(c, "parameter number", pn, AXIS_PARAMETER)
-        status, _ = self._query((0x01, cn, pn, mn, 0x0000))
-        if status != STAT_OK:
-            raise TMCLStatusError(c, STATUSCODES[status])
-        return None
+        return self._dispatch('STAP', parameter_number, motor_number)
 
-    def rsap(self):
+    def rsap(self, motor_number, parameter_number):
         """
+        tmcl_rsap(self, motor_number, parameter_number) --> None
+
         Restore Axis Parameter:
         -----------------------
+        For all configuration-related axis parameters, non-volatile
+        memory locations are provided. By default, most parameters are
+        automatically restored after power up. A single parameter that
+        has been changed before can be reset by this instruction also.
 
-        Not yet implemented
+        TMCL-Mnemonic: RSAP <parameter number>, <motor number>
         """
-        raise NotImplementedError("yet!")
+        return self._dispatch('RSAP', parameter_number, motor_number)
 
-    def stgp(self):
+    def stgp(self, bank_number, parameter_number):
         """
+        tmcl_stgp(self, bank_number, parameter_number) --> None
+
         Store Global Parameter:
         -----------------------
+        This command is used to store TMCL user variables permanently
+        in the EEPROM of the module. Some global parameters are located
+        in RAM memory, so without storing modifications are lost at
+        power down. This instruction enables enduring storing.
 
-        Not yet implemented
+        TMCL-Mnemonic: STGP <parameter number>, <bank number>
         """
-        raise NotImplementedError("yet!")
+        return self._dispatch('STGP', parameter_number, bank_number)
 
-    def rsgp(self):
+    def rsgp(self, bank_number, parameter_number):
         """
+        tmcl_rsgp(self, bank_number, parameter_number) --> None
+
         Restore Global Parameter:
         -------------------------
+        With this command the contents of a TMCL user variable can be
+        restored from the EEPROM. For all configuration-related axis
+        parameters, non-volatile memory locations are provided. By
+        default, most parameters are automatically restored after
+        power up. A single parameter that has been changed before can
+        be reset by this instruction.
 
-        Not yet implemented
+        TMCL-Mnemonic: RSGP <parameter number>, <bank number>
         """
-        raise NotImplementedError("yet!")
+        return self._dispatch('RSGP', parameter_number, bank_number)
+
+
+
 
+def traceRequests(tracer, requests, req):
+    """Pass a TraceEvent for every request of the encoded batch req to tracer"""
+    n = codec.COMMAND_STRING_LENGTH
+    timestamp = monotonic()
+    for i, request in enumerate(requests):
+        frame = req[i*n:i*n+n]
+        # the fields as encoded: bytes masked, value as signed 32 bits
+        tracer(TraceEvent(SEND, timestamp, frame, codec.unpackRequestCommand(frame)))
+
+
+def resolveReply(future, c, rep, returns=True):
+    """Resolve the future of command c with a Reply (or TMCLError)"""
+    if isinstance(rep, TMCLError):
+        future.set_exception(rep)
+    elif rep.status != STAT_OK:
+        future.set_exception(TMCLStatusError(c, STATUSCODES.get(rep.status, rep.status)))
+    else:
+        future.set_result(rep.value if returns else None)
+
+
+
+class Pipeline(Device):
+    """
+    Queue the commands of a Device and send them in one buffered write
+
+    Every command method returns a Future. The futures are resolved in
+    order when execute() is called, errors and non-OK statuses are set
+    as exceptions on the future of the command they belong to.
+    """
+
+    def __init__(self, device, max_pending=None):
+        self._device = device
+        self._max_pending = max_pending
+        self._pending = []
+
+    def __getattr__(self, name):
+        return getattr(self._device, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.execute()
+        else:
+            self.cancel()
+        return False
+
+    def __len__(self):
+        return len(self._pending)
+
+    def _command(self, c, request, returns=True):
+        """Queue request for command c and return its Future"""
+        future = Future()
+        if self.cache is not None:
+            value = self.cache.lookup(request)
+            if value is not MISS:
+                future.set_result(value if returns else None)
+                return future
+        self._pending.append((c, request, returns, future))
+        if self._max_pending is not None and len(self._pending) >= self._max_pending:
+            self.execute()
+        return future
+
+    def execute(self):
+        """Send all queued requests and resolve their futures"""
+        pending, self._pending = self._pending, []
+        if not pending:
+            return []
+        requests = [request for _, request, _, _ in pending]
+        try:
+            if self.retry is not None:
+                replies = self.retry.exchange(self._device, requests)
+            else:
+                replies = self._device._exchange(requests)
+        except Exception as e:
+            for _, _, _, future in pending:
+                future.set_exception(e)
+            raise
+        cache = self.cache
+        for (c, request, returns, future), rep in zip(pending, replies):
+            resolveReply(future, c, rep, returns)
+            if cache is not None and future.exception() is None:
+                cache.remember(request, rep.value)
+        return [future for _, _, _, future in pending]
+
+    def cancel(self):
+        """Drop all queued requests, their futures fail"""
+        pending, self._pending = self._pending, []
+        for c, _, _, future in pending:
+            future.set_exception(TMCLError(c, "cancelled"))
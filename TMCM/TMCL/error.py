@@ -14,6 +14,38 @@ class TMCLError(Exception):
             return "{}: {}".format(self.command, self.message)
 
 
+class TMCLChecksumError(TMCLError):
+    """TMCL exception for telegrams with a wrong checksum"""
+
+
+class TMCLLengthError(TMCLError):
+    """TMCL exception for telegrams of wrong length (e.g. a short read)"""
+
+
+class TMCLTimeoutError(TMCLError):
+    """TMCL exception for operations that did not finish in time"""
+
+
+class TMCLGatewayError(TMCLError):
+    """TMCL exception for batches a gateway refused or could not run"""
+
+
+class TMCLAssemblerError(TMCLError):
+    """TMCL exception for invalid TMCL program source"""
+
+    def __init__(self, line, message):
+        super(TMCLAssemblerError, self).__init__("line {}".format(line), message)
+        self.line = line
+
+
+class TMCLRemoteError(TMCLError):
+    """TMCL exception raised in a daemon, reported to its client"""
+
+    def __init__(self, command, kind, message):
+        super(TMCLRemoteError, self).__init__(command, "{}: {}".format(kind, message))
+        self.kind = kind
+
+
 class TMCLStatusError(TMCLError):
     """TMCL exception for non-OK statuses"""
 
@@ -23,6 +55,15 @@ class TMCLStatusError(TMCLError):
         self.status = status
 
 
+class TMCLBatchError(TMCLError):
+    """TMCL exception collecting the (index, error) pairs of a batch"""
+
+    def __init__(self, command, errors):
+        message = "; ".join("#{}: {}".format(i, e) for i, e in errors)
+        super(TMCLBatchError, self).__init__(command, message)
+        self.errors = errors
+
+
 class TMCLMissingElement(TMCLError):
     """Base TMCL exception for missing elements in containers"""
 
@@ -0,0 +1,198 @@
+
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from Queue import Queue
+
+from device import Device
+from error import *
+from futures import Future
+
+
+DeviceResult = namedtuple('DeviceResult', ['port', 'value', 'error', 'elapsed'])
+
+
+
+class FleetReport(object):
+    """
+    Results of one fleet-wide operation, by port
+
+    results holds a DeviceResult (value or error, and seconds taken) for
+    every port in the order of the fleet, elapsed the wall time of the
+    whole operation.
+    """
+
+    def __init__(self, results, elapsed):
+        self.results = results
+        self.elapsed = elapsed
+
+    def __getitem__(self, port):
+        return self.results[port]
+
+    def __iter__(self):
+        return iter(self.results.itervalues())
+
+    def __len__(self):
+        return len(self.results)
+
+    @property
+    def ok(self):
+        return [r.port for r in self if r.error is None]
+
+    @property
+    def failed(self):
+        return [r.port for r in self if r.error is not None]
+
+    def values(self):
+        """{port: value} of the devices that succeeded"""
+        return OrderedDict((r.port, r.value) for r in self if r.error is None)
+
+    def errors(self):
+        """{port: exception} of the devices that failed"""
+        return OrderedDict((r.port, r.error) for r in self if r.error is not None)
+
+    def check(self):
+        """Raise a TMCLBatchError naming every failed port, if any"""
+        errors = self.errors().items()
+        if errors:
+            raise TMCLBatchError("Fleet", errors)
+
+    def summary(self):
+        """Counts, wall time and the slowest device"""
+        slowest = max(self, key=lambda r: r.elapsed) if self.results else None
+        return {'devices': len(self), 'ok': len(self.ok), 'failed': len(self.failed),
+                'elapsed': self.elapsed,
+                'slowest': slowest and (slowest.port, slowest.elapsed),
+                'device_seconds': sum(r.elapsed for r in self)}
+
+
+
+class _Member(object):
+    """One port of a Fleet: its device, job queue and worker threads"""
+
+    def __init__(self, fleet, port, concurrency):
+        self.fleet = fleet
+        self.port = port
+        self.device = None
+        self.jobs = Queue()
+        self.lock = threading.Lock()
+        self.workers = [threading.Thread(target=self.work, name="TMCL-fleet-{}".format(port))
+                        for _ in xrange(concurrency)]
+        for worker in self.workers:
+            worker.daemon = True
+            worker.start()
+
+    def open(self):
+        with self.lock:
+            if self.device is None:
+                self.device = self.fleet.factory(self.port, **self.fleet.kwargs)
+            return self.device
+
+    def work(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                return
+            fn, args, kwargs, future = job
+            start = time.time()
+            try:
+                value = fn(self.open(), *args, **kwargs)
+            except Exception as e:
+                result = DeviceResult(self.port, None, e, time.time() - start)
+            else:
+                result = DeviceResult(self.port, value, None, time.time() - start)
+            future.set_result(result)
+
+    def close(self):
+        for _ in self.workers:
+            self.jobs.put(None)
+        for worker in self.workers:
+            worker.join()
+        device = self.device
+        self.device = None
+        if device is not None:
+            close = getattr(device, 'close', None)
+            if close is None:
+                close = getattr(getattr(device, '_ser', None), 'close', None)
+            if close is not None:
+                close()
+
+
+
+class Fleet(object):
+    """
+    Run operations on many TMCL modules, each on its own port, in parallel
+
+        fleet = Fleet(["/dev/ttyACM0", "/dev/ttyACM1"], progress=report)
+        rep = fleet.run(lambda dev: dev.gap(0, 1))
+        print rep.values(), rep.errors(), rep.summary()
+
+    Every port has its own worker threads, so an operation takes the
+    time of the slowest device rather than the sum over all of them.
+    factory(port, **kwargs) opens the device (a Device by default) in
+    its worker on first use, an error there is reported for that port
+    only. concurrency limits the jobs run at the same time per device:
+    a number, or a {port: number} dict; keep 1 unless the device is
+    thread-safe (SharedDevice). progress(result, done, total) is called
+    as every device finishes. Threads fit because the work is waiting
+    on serial I/O, which releases the GIL.
+    """
+
+    def __init__(self, ports, factory=Device, concurrency=1, progress=None, **kwargs):
+        self.factory = factory
+        self.kwargs = kwargs
+        self.progress = progress
+        self._members = OrderedDict()
+        for port in ports:
+            n = concurrency.get(port, 1) if isinstance(concurrency, dict) else concurrency
+            self._members[port] = _Member(self, port, n)
+
+    @property
+    def ports(self):
+        return self._members.keys()
+
+    def device(self, port):
+        """The (opened) device on port"""
+        return self._members[port].open()
+
+    def submit(self, fn, *args, **kwargs):
+        """Queue fn(device, *args, **kwargs) on every device, return {port: Future}"""
+        ports = kwargs.pop('ports', None) or self.ports
+        futures = OrderedDict()
+        for port in ports:
+            futures[port] = Future()
+            self._members[port].jobs.put((fn, args, kwargs, futures[port]))
+        return futures
+
+    def iter_run(self, fn, *args, **kwargs):
+        """Run fn on every device, yield the DeviceResults as they finish"""
+        futures = self.submit(fn, *args, **kwargs)
+        finished = Queue()
+        for future in futures.itervalues():
+            future.add_done_callback(finished.put)
+        for done in xrange(1, len(futures) + 1):
+            result = finished.get().result()
+            if self.progress is not None:
+                self.progress(result, done, len(futures))
+            yield result
+
+    def run(self, fn, *args, **kwargs):
+        """
+        Run fn(device, *args, **kwargs) on every device (or on the
+        ports= given), wait for all and return a FleetReport
+        """
+        start = time.time()
+        results = dict((r.port, r) for r in self.iter_run(fn, *args, **kwargs))
+        ordered = OrderedDict((port, results[port]) for port in self.ports if port in results)
+        return FleetReport(ordered, time.time() - start)
+
+    def close(self):
+        """Stop the workers and close every opened device"""
+        for member in self._members.itervalues():
+            member.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,76 @@
+
+from codec import COMMAND_STRING_LENGTH, VALUE_STRUCT, Reply
+from consts import *
+from error import *
+
+
+
+def plausibleReply(rep):
+    """True for replies with a known status code"""
+    return rep.status in STATUSCODES
+
+
+
+class FrameParser(object):
+    """
+    Incremental parser of a reply byte stream
+
+        parser = FrameParser()
+        parser.feed(port.read(64))
+        found = parser.next()     # (Reply, frame, skipped) or None
+
+    A frame is taken where the checksum matches and accept(reply) is
+    true (plausibleReply by default), otherwise the window slides on by
+    one byte. A lost or stray byte so costs the replies it hits and the
+    stream realigns on the next good one. skipped counts the bytes
+    discarded in front of the frame, resyncs and stray the frames
+    found after a skip and the bytes discarded in total.
+    """
+
+    def __init__(self):
+        self._buffer = bytearray()
+        self._skipped = 0
+        self.frames = 0
+        self.resyncs = 0
+        self.stray = 0
+
+    def __len__(self):
+        """Bytes buffered but not parsed yet"""
+        return len(self._buffer)
+
+    def feed(self, data):
+        self._buffer += data
+
+    def next(self, accept=plausibleReply):
+        """The next acceptable frame as (Reply, frame, skipped), or None"""
+        buf = self._buffer
+        n = COMMAND_STRING_LENGTH
+        start = 0
+        while len(buf) - start >= n:
+            if sum(buf[start:start+8]) & 0xFF == buf[start+8]:
+                rep = Reply(buf[start], buf[start+1], buf[start+2], buf[start+3],
+                            VALUE_STRUCT.unpack_from(buf, start+4)[0], buf[start+8])
+                if accept is None or accept(rep):
+                    frame = str(buf[start:start+n])
+                    skipped = self._skipped + start
+                    del buf[:start+n]
+                    self._skipped = 0
+                    self.frames += 1
+                    self.stray += start
+                    if skipped:
+                        self.resyncs += 1
+                    return rep, frame, skipped
+            start += 1
+        # no frame can start before start any more
+        del buf[:start]
+        self._skipped += start
+        self.stray += start
+        return None
+
+    def drop(self):
+        """Discard the buffered bytes, return how many there were"""
+        n = len(self._buffer)
+        self._buffer = bytearray()
+        self._skipped = 0
+        self.stray += n
+        return n
@@ -0,0 +1,57 @@
+
+import threading
+
+from error import *
+
+
+
+class Future(object):
+    """Placeholder for the outcome of a TMCL command that is not done yet"""
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._result = None
+        self._exception = None
+        self._callbacks = []
+
+    def done(self):
+        """Return True if a result or an exception has been set"""
+        return self._event.is_set()
+
+    def result(self, timeout=None):
+        """Wait for the command and return its value or raise its error"""
+        if not self._event.wait(timeout):
+            raise TMCLTimeoutError("Future", "no result within {} s".format(timeout))
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def exception(self, timeout=None):
+        """Wait for the command and return its error (or None)"""
+        if not self._event.wait(timeout):
+            raise TMCLTimeoutError("Future", "no result within {} s".format(timeout))
+        return self._exception
+
+    def set_result(self, result):
+        self._result = result
+        self._finish()
+
+    def set_exception(self, exception):
+        self._exception = exception
+        self._finish()
+
+    def add_done_callback(self, fn):
+        """Call fn(future) once done, immediately if already done"""
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(fn)
+                return
+        fn(self)
+
+    def _finish(self):
+        with self._lock:
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for fn in callbacks:
+            fn(self)
@@ -0,0 +1,390 @@
+#!/usr/bin/env python
+
+"""
+TCP gateway sharing a TMCL module with other hosts
+
+    python gateway.py /dev/ttyACM0 --bind 0.0.0.0 --rate 500    # next to the module
+
+    dev = RemoteDevice("rocker-host")                          # anywhere else
+    dev.mvp(0, 'ABS', 1000)
+    with dev.pipeline() as p:                                   # one message
+        pos = [p.gap(mn, 1) for mn in range(3)]
+
+Messages are a header (kind or result, payload length) followed by
+TMCL telegrams: a client sends request telegrams, the gateway answers
+with the reply telegrams of the module. Every write of a Device, so
+every pipeline, is one message.
+"""
+
+import argparse
+import socket
+import struct
+import sys
+import threading
+import time
+import SocketServer
+
+import codec
+from device import Device
+from error import *
+from shared import SharedDevice
+
+
+DEFAULT_PORT = 5310
+
+HEADER_STRUCT = struct.Struct('>BH')
+
+# reply telegram of a request whose reply was lost, its checksum is wrong
+LOST_REPLY = "\x00" * 8 + "\x01"
+
+REQUEST = 1
+
+# results of a request message
+OK, INVALID, BUSY, RATE_LIMITED, FAILED = range(5)
+RESULTS = {OK: "ok", INVALID: "invalid request", BUSY: "gateway busy",
+           RATE_LIMITED: "rate limit exceeded", FAILED: "device failed"}
+
+
+
+def receive(sock, size):
+    """Exactly size bytes from sock, less only at EOF"""
+    chunks = []
+    while size:
+        chunk = sock.recv(size)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        size -= len(chunk)
+    return "".join(chunks)
+
+
+def decodeRequests(frames):
+    """Request tuples of the request telegrams frames"""
+    n = codec.COMMAND_STRING_LENGTH
+    return [tuple(codec.unpackRequestCommand(frames[i:i+n]))[:5]
+            for i in xrange(0, len(frames), n)]
+
+
+def forward(device, requests):
+    """
+    Run requests on device (a SharedDevice) in one exchange, return the
+    reply telegrams. A reply lost or corrupted on the module link is
+    answered with LOST_REPLY, so the client fails just that request.
+    """
+    replies = device.submit(requests).result()
+    return "".join(LOST_REPLY if isinstance(rep, TMCLError) else codec.packReplyCommand(*rep[:5])
+                   for rep in replies)
+
+
+
+class RateLimiter(object):
+    """
+    Token bucket of rate telegrams per second holding up to burst
+
+    reserve(n) takes n tokens and returns the seconds to wait before
+    sending, or None (taking nothing) if that wait exceeds max_delay.
+    """
+
+    def __init__(self, rate, burst=None, clock=time.time):
+        self.rate = float(rate)
+        self.burst = burst if burst is not None else rate
+        self.clock = clock
+        self.tokens = self.burst
+        self.last = clock()
+
+    def reserve(self, n, max_delay=0.0):
+        now = self.clock()
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        delay = max(n - self.tokens, 0) / self.rate
+        if delay > max_delay:
+            return None
+        self.tokens -= n
+        return delay
+
+
+
+class _Client(object):
+    """Counters and rate limiter of one connection"""
+
+    def __init__(self, address, limiter):
+        self.address = address
+        self.limiter = limiter
+        self.connected = time.time()
+        self.messages = 0
+        self.telegrams = 0
+        self.refused = dict((result, 0) for result in (INVALID, BUSY, RATE_LIMITED, FAILED))
+
+    def as_dict(self):
+        return {'address': "{}:{}".format(*self.address[:2]), 'connected': self.connected,
+                'messages': self.messages, 'telegrams': self.telegrams,
+                'refused': dict((RESULTS[r], n) for r, n in self.refused.iteritems())}
+
+
+
+class _Server(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _Handler(SocketServer.BaseRequestHandler):
+    """One client connection, messages are answered in order until EOF"""
+
+    def handle(self):
+        sock = self.request
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        gateway = self.server.gateway
+        client = gateway._connect(self.client_address)
+        try:
+            while True:
+                header = receive(sock, HEADER_STRUCT.size)
+                if len(header) < HEADER_STRUCT.size:
+                    return
+                kind, length = HEADER_STRUCT.unpack(header)
+                frames = receive(sock, length)
+                if len(frames) < length:
+                    return
+                result, replies = gateway._serve(client, kind, frames)
+                sock.sendall(HEADER_STRUCT.pack(result, len(replies)) + replies)
+        except socket.error:
+            pass
+        finally:
+            gateway._disconnect(client)
+
+
+
+class Gateway(object):
+    """
+    Serve a SharedDevice to TCP clients (RemoteDevice)
+
+        gateway = Gateway(SharedDevice("/dev/ttyACM0", fair=True), rate=500)
+        gateway.serve_forever()
+
+    Every request message is one exchange on the module. Messages of
+    one connection are served in order, one at a time, so a client that
+    sends faster than the module answers is slowed down by TCP itself.
+    Beyond that:
+
+    * max_batch limits the telegrams per message (INVALID),
+    * with rate, every connection gets a token bucket of rate telegrams
+      per second and burst; a message is delayed up to max_delay for
+      tokens and refused (RATE_LIMITED) beyond,
+    * a message arriving while max_queue jobs wait for the module is
+      refused (BUSY), as is one the SharedDevice queue_timeout expires.
+
+    Refused messages are not sent to the module, RemoteDevice raises
+    them as TMCLGatewayError. Messages run as exchanges of the device,
+    so a stray or lost byte on the module link is resynchronized there
+    and costs only the replies it hit. With fair=True on the SharedDevice the
+    connections are served round-robin.
+    """
+
+    def __init__(self, device, host='127.0.0.1', port=DEFAULT_PORT, rate=None, burst=None,
+                 max_delay=0.1, max_batch=256, max_queue=64):
+        self.device = device
+        self.rate = rate
+        self.burst = burst
+        self.max_delay = max_delay
+        self.max_batch = max_batch
+        self.max_queue = max_queue
+        self._lock = threading.Lock()
+        self._clients = []
+        self._thread = None
+        self._server = _Server((host, port), _Handler)
+        self._server.gateway = self
+
+    @property
+    def address(self):
+        """(host, port) the gateway listens on"""
+        return self._server.server_address
+
+    def _connect(self, address):
+        limiter = RateLimiter(self.rate, self.burst) if self.rate else None
+        client = _Client(address, limiter)
+        with self._lock:
+            self._clients.append(client)
+        return client
+
+    def _disconnect(self, client):
+        with self._lock:
+            self._clients.remove(client)
+
+    def _serve(self, client, kind, frames):
+        """Run one request message for client, return (result, reply telegrams)"""
+        n = codec.COMMAND_STRING_LENGTH
+        count = len(frames) // n
+        result = OK
+        try:
+            requests = decodeRequests(frames)
+        except TMCLError:
+            requests = None
+        if kind != REQUEST or not requests or len(frames) % n or count > self.max_batch:
+            result = INVALID
+        elif self.device.queue_stats()['depth'] >= self.max_queue:
+            result = BUSY
+        elif client.limiter is not None:
+            delay = client.limiter.reserve(count, self.max_delay)
+            if delay is None:
+                result = RATE_LIMITED
+            elif delay:
+                time.sleep(delay)
+        if result == OK:
+            try:
+                replies = forward(self.device, requests)
+            except TMCLTimeoutError:
+                result = BUSY
+            except Exception:
+                result = FAILED
+        with self._lock:
+            if result == OK:
+                client.messages += 1
+                client.telegrams += count
+            else:
+                client.refused[result] += 1
+        return result, replies if result == OK else ""
+
+    def clients(self):
+        """Counters of the connected clients"""
+        with self._lock:
+            return [client.as_dict() for client in self._clients]
+
+    def stats(self):
+        """Link statistics of the device (see SharedDevice.stats) and the clients"""
+        stats = self.device.stats()
+        stats['clients'] = self.clients()
+        return stats
+
+    def serve_forever(self):
+        self._server.serve_forever()
+
+    def start(self):
+        """Serve in a background thread"""
+        self._thread = threading.Thread(target=self.serve_forever, name="TMCL-gateway")
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def close(self):
+        """Stop serving and close the device"""
+        if self._thread is not None:
+            self._server.shutdown()
+            self._thread.join()
+        self._server.server_close()
+        self.device.close()
+
+
+
+class GatewayPort(object):
+    """
+    Serial-like connection to a Gateway
+
+    Every write is sent as one request message, read returns the reply
+    telegrams. A refused message raises TMCLGatewayError, no reply
+    within timeout closes the connection and raises TMCLTimeoutError
+    (reopen with open(), or Device.reconnect()).
+    """
+
+    def __init__(self, host, port=DEFAULT_PORT, timeout=None):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self._sock = None
+        self.open()
+
+    @property
+    def is_open(self):
+        return self._sock is not None
+
+    def open(self):
+        if self._sock is None:
+            self._sock = socket.create_connection((self.host, self.port), self.timeout)
+            self._sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self._outstanding = 0
+            self._ready = ""
+
+    def close(self):
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+    def write(self, data):
+        if self._sock is None:
+            raise TMCLGatewayError("gateway", "connection is closed")
+        self._sock.sendall(HEADER_STRUCT.pack(REQUEST, len(data)) + data)
+        self._outstanding += 1
+        return len(data)
+
+    def read(self, size=1):
+        try:
+            while len(self._ready) < size and self._outstanding:
+                header = receive(self._sock, HEADER_STRUCT.size)
+                if len(header) < HEADER_STRUCT.size:
+                    self.close()
+                    raise TMCLGatewayError("gateway", "connection closed by the gateway")
+                result, length = HEADER_STRUCT.unpack(header)
+                self._outstanding -= 1
+                if result != OK:
+                    raise TMCLGatewayError("gateway", RESULTS.get(result, result))
+                self._ready += receive(self._sock, length)
+        except socket.timeout:
+            self.close()
+            raise TMCLTimeoutError("gateway", "no reply within {} s".format(self.timeout))
+        data, self._ready = self._ready[:size], self._ready[size:]
+        return data
+
+    def reset_input_buffer(self):
+        self._ready = ""
+
+    def flush(self):
+        pass
+
+
+
+class RemoteDevice(Device):
+    """
+    Device reached through a Gateway
+
+        dev = RemoteDevice("rocker-host", num_motors=3, cache=False)
+
+    Takes the keyword arguments of Device, every exchange (a command
+    or a pipeline) is one message to the gateway.
+    """
+
+    def __init__(self, host, port=DEFAULT_PORT, timeout=None, **kwargs):
+        super(RemoteDevice, self).__init__(port=GatewayPort(host, port, timeout), **kwargs)
+
+    def close(self):
+        self._ser.close()
+
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Share a TMCL module over TCP")
+    parser.add_argument('port', help="serial port or pyserial URL")
+    parser.add_argument('--bind', default='127.0.0.1', help="address to listen on")
+    parser.add_argument('--listen', type=int, default=DEFAULT_PORT, help="TCP port")
+    parser.add_argument('--rate', type=float, default=None, help="telegrams per second per client")
+    parser.add_argument('--burst', type=int, default=None, help="telegrams a client may send at once")
+    parser.add_argument('--max-batch', type=int, default=256, help="telegrams per message")
+    parser.add_argument('--max-queue', type=int, default=64, help="queued messages before BUSY")
+    parser.add_argument('--timeout', type=float, default=None,
+                        help="seconds to wait for a reply from the module")
+    parser.add_argument('--queue-timeout', type=float, default=None,
+                        help="refuse messages queued longer than this many seconds")
+    args = parser.parse_args(argv)
+
+    device = SharedDevice(args.port, timeout=args.timeout, queue_timeout=args.queue_timeout, fair=True)
+    gateway = Gateway(device, args.bind, args.listen, rate=args.rate, burst=args.burst,
+                      max_batch=args.max_batch, max_queue=args.max_queue)
+    sys.stderr.write("TMCL gateway on {} serving {}:{}\n".format(args.port, *gateway.address))
+    try:
+        gateway.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        gateway.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,173 @@
+
+import time
+from collections import namedtuple
+
+from consts import *
+from error import *
+
+
+# parameters read back to verify a link, their values do not change by themselves
+REFERENCE_PARAMETERS = [('global', 0, 64), ('global', 0, 66), ('global', 0, 76),
+                        ('axis', 0, 4), ('axis', 0, 5), ('axis', 0, 6)]
+
+# telegram pause times (ms) tried below the current one, largest first
+PAUSE_TIMES = [100, 50, 20, 10, 5, 2, 1, 0]
+
+LinkTrial = namedtuple('LinkTrial', ['baudrate', 'pause', 'rate', 'error'])
+
+
+
+def runCommand(device, name, *args):
+    """
+    Blocking device.name(*args) through a pipeline, so that it waits
+    for the reply on an AsyncDevice as well
+    """
+    with device.pipeline() as p:
+        future = getattr(p, name)(*args)
+    return future.result()
+
+
+def readReference(device, keys):
+    """{key: value} of keys, in one pipelined batch"""
+    with device.pipeline() as p:
+        futures = [p.gap(n, pn) if kind == 'axis' else p.ggp(n, pn) for kind, n, pn in keys]
+    return dict((key, future.result()) for key, future in zip(keys, futures))
+
+
+def verifyLink(device, reference, burst=20):
+    """
+    burst single round trips and one pipelined batch reading the
+    reference values, return round trips per second. A reply that is
+    missing, corrupt or not the reference value raises a TMCLError.
+    """
+    keys = sorted(reference)
+    start = time.time()
+    for i in xrange(burst):
+        kind, n, pn = key = keys[i % len(keys)]
+        value = runCommand(device, 'gap' if kind == 'axis' else 'ggp', n, pn)
+        if value != reference[key]:
+            raise TMCLError("verify", "{} read {}, expected {}".format(key, value, reference[key]))
+    if readReference(device, keys) != reference:
+        raise TMCLError("verify", "pipelined read differs from the reference")
+    return (burst + len(keys)) / max(time.time() - start, 1e-9)
+
+
+
+class TuningReport(object):
+    """
+    Outcome of tuneLink
+
+    trials lists a LinkTrial (baudrate, pause in ms, round trips per
+    second or error) for every setting tried, in order, the first one
+    is the initial setting. baudrate and pause are the settings the
+    module and host were left at, stored tells if they were written
+    to EEPROM.
+    """
+
+    def __init__(self):
+        self.trials = []
+        self.baudrate = None
+        self.pause = None
+        self.stored = False
+
+    def __str__(self):
+        lines = ["{:>8} baud {:>4} ms: {}".format(t.baudrate, t.pause, "{:.0f} round trips/s".format(t.rate)
+                                                   if t.error is None else "failed, {}".format(t.error))
+                 for t in self.trials]
+        lines.append("settled on {} baud, {} ms telegram pause{}".format(
+            self.baudrate, self.pause, ", stored" if self.stored else ""))
+        return "\n".join(lines)
+
+
+
+def restoreLink(device, index, pause, baudrates, reference):
+    """
+    Set module and host back to baud rate number index and pause,
+    the module may listen at any of baudrates
+    """
+    for baudrate in baudrates:
+        device.configure_link(baudrate=baudrate)
+        with device.pipeline() as p:
+            p.sgp(0, 75, pause)
+            p.sgp(0, 65, index)
+    device.configure_link(baudrate=BAUD_RATES[index])
+    device._ser.reset_input_buffer()
+    try:
+        verifyLink(device, reference, burst=len(reference))
+    except TMCLError as e:
+        raise TMCLError("tune", "lost the module restoring {} baud, {} ms: {}".format(
+            BAUD_RATES[index], pause, e))
+
+
+def tuneLink(device, baudrates=None, pauses=None, burst=20, timeout=0.5, store=False):
+    """
+    Find the fastest reliable link settings of an RS485/UART link
+
+    Starting from the current settings, the module's baud rate (global
+    parameter 0, 65) and then the host's are stepped up through
+    baudrates (default: all of BAUD_RATES), then the module's telegram
+    pause time (0, 75) is stepped down through pauses (PAUSE_TIMES).
+    Each setting must pass verifyLink with burst round trips. The
+    first that fails is undone (at either baud rate, the module may or
+    may not have switched) and ends that phase, so the link is always
+    left at the last verified setting. During tuning a read (a whole
+    batch) gives up after timeout seconds. With store the result is
+    written to EEPROM (STGP, for modules that do not store bank 0 on
+    SGP already).
+
+    The module must switch its baud rate right after replying to SGP,
+    one that only does so after a reset stays at its current rate.
+    Returns a TuningReport.
+    """
+    for baudrate in baudrates or []:
+        if baudrate not in BAUD_RATE_NUMBERS:
+            raise TMCLKeyError("tune", "baud rate", baudrate, BAUD_RATE_NUMBERS)
+    saved = device.link_settings()
+    cache, device.cache = device.cache, None
+    report = TuningReport()
+    try:
+        device.configure_link(timeout=timeout, pause=0.0)
+        reference = readReference(device, REFERENCE_PARAMETERS)
+        index, pause = runCommand(device, 'ggp', 0, 65), runCommand(device, 'ggp', 0, 75)
+        if BAUD_RATES.get(index) != saved['baudrate']:
+            raise TMCLError("tune", "host at {} baud, module at {} baud".format(
+                saved['baudrate'], BAUD_RATES.get(index, index)))
+        report.trials.append(LinkTrial(BAUD_RATES[index], pause,
+                                       verifyLink(device, reference, burst), None))
+
+        numbers = BAUD_RATES.keys() if baudrates is None else [BAUD_RATE_NUMBERS[b] for b in baudrates]
+        for n in sorted(n for n in numbers if BAUD_RATES[n] > BAUD_RATES[index]):
+            try:
+                runCommand(device, 'sgp', 0, 65, n)
+                device.configure_link(baudrate=BAUD_RATES[n])
+                rate = verifyLink(device, reference, burst)
+            except TMCLError as e:
+                report.trials.append(LinkTrial(BAUD_RATES[n], pause, None, e))
+                restoreLink(device, index, pause, [BAUD_RATES[n], BAUD_RATES[index]], reference)
+                break
+            report.trials.append(LinkTrial(BAUD_RATES[n], pause, rate, None))
+            index = n
+
+        for p in sorted((p for p in (PAUSE_TIMES if pauses is None else pauses) if p < pause),
+                        reverse=True):
+            try:
+                runCommand(device, 'sgp', 0, 75, p)
+                rate = verifyLink(device, reference, burst)
+            except TMCLError as e:
+                report.trials.append(LinkTrial(BAUD_RATES[index], p, None, e))
+                restoreLink(device, index, pause, [BAUD_RATES[index]], reference)
+                break
+            report.trials.append(LinkTrial(BAUD_RATES[index], p, rate, None))
+            pause = p
+
+        if store:
+            runCommand(device, 'stgp', 0, 65)
+            runCommand(device, 'stgp', 0, 75)
+            report.stored = True
+        report.baudrate, report.pause = BAUD_RATES[index], pause
+    finally:
+        device.cache = cache
+        if cache is not None:
+            cache.clear()
+        device.configure_link(timeout=saved['timeout'], pause=saved['pause'])
+    return report
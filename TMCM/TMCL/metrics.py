@@ -0,0 +1,142 @@
+
+import time
+from bisect import bisect_left
+
+from consts import *
+from error import *
+
+
+
+class Histogram(object):
+    """Latency histogram with logarithmic buckets from 100 us to 13 s"""
+
+    BOUNDS = [1e-4 * 2**i for i in range(18)]
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, seconds):
+        self.counts[bisect_left(self.BOUNDS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if self.min is None or seconds < self.min:
+            self.min = seconds
+        if self.max is None or seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, q):
+        """Upper bucket bound below which q percent of the samples lie"""
+        if not self.count:
+            return None
+        rank = q / 100.0 * self.count
+        seen = 0
+        for bound, n in zip(self.BOUNDS + [self.max], self.counts):
+            seen += n
+            if n and seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def as_dict(self):
+        return {'count': self.count,
+                'mean': self.total / self.count if self.count else None,
+                'min': self.min, 'max': self.max,
+                'p50': self.percentile(50), 'p99': self.percentile(99),
+                'buckets': zip(self.BOUNDS + [float('inf')], self.counts)}
+
+
+
+class Metrics(object):
+    """
+    Link statistics of a Device: round trip latency per command,
+    bytes and telegrams on the wire, checksum errors, timeouts (short
+    reads), non-OK statuses by code and resynchronizations of the
+    reply stream with the stray bytes they skipped
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.since = time.time()
+        self.latency = {}
+        self.bytes_written = 0
+        self.bytes_read = 0
+        self.telegrams = 0
+        self.checksum_errors = 0
+        self.timeouts = 0
+        self.statuses = {}
+        self.resyncs = 0
+        self.stray_bytes = 0
+        self.retries = {}
+        self.recovered_replies = 0
+        self.unrecovered_replies = 0
+        self.verified_replies = 0
+
+    def sent(self, nbytes, ntelegrams):
+        self.bytes_written += nbytes
+        self.telegrams += ntelegrams
+
+    def received(self, nbytes):
+        self.bytes_read += nbytes
+
+    def resynced(self, resyncs, stray_bytes):
+        self.resyncs += resyncs
+        self.stray_bytes += stray_bytes
+
+    def retried(self, n_command):
+        self.retries[n_command] = self.retries.get(n_command, 0) + 1
+
+    def recovered(self, ok):
+        """Account a failed reply that was (ok) or could not be recovered"""
+        if ok:
+            self.recovered_replies += 1
+        else:
+            self.unrecovered_replies += 1
+
+    def verified(self):
+        self.verified_replies += 1
+
+    def record(self, n_command, seconds, rep):
+        """
+        Account one reply (Reply record or TMCLError) of n_command that
+        took seconds, its share of the round trip of its batch
+        """
+        histogram = self.latency.get(n_command)
+        if histogram is None:
+            histogram = self.latency[n_command] = Histogram()
+        histogram.add(seconds)
+        if isinstance(rep, TMCLChecksumError):
+            self.checksum_errors += 1
+        elif isinstance(rep, (TMCLLengthError, TMCLTimeoutError)):
+            self.timeouts += 1
+        elif not isinstance(rep, TMCLError) and rep.status != STAT_OK:
+            self.statuses[rep.status] = self.statuses.get(rep.status, 0) + 1
+
+    def snapshot(self):
+        """
+        Plain dict of all counters, latency histograms and retries by
+        command name, non-OK statuses by STATUSCODES code
+        """
+        elapsed = max(time.time() - self.since, 1e-9)
+        return {'elapsed': elapsed,
+                'bytes_written': self.bytes_written,
+                'bytes_read': self.bytes_read,
+                'telegrams': self.telegrams,
+                'telegrams_per_second': self.telegrams / elapsed,
+                'checksum_errors': self.checksum_errors,
+                'timeouts': self.timeouts,
+                'resyncs': self.resyncs,
+                'stray_bytes': self.stray_bytes,
+                'retries': sum(self.retries.itervalues()),
+                'retries_by_command': dict((COMMAND_NUMBERS.get(cn, cn), n)
+                                           for cn, n in self.retries.iteritems()),
+                'recovered': self.recovered_replies,
+                'unrecovered': self.unrecovered_replies,
+                'verified': self.verified_replies,
+                'statuses': dict(self.statuses),
+                'latency': dict((COMMAND_NUMBERS.get(cn, cn), h.as_dict())
+                                for cn, h in self.latency.iteritems())}
@@ -0,0 +1,107 @@
+
+import time
+
+from consts import *
+from error import *
+from tracing import monotonic
+
+
+# target position, actual position, target pos reached (, target speed, actual speed)
+REACHED_PARAMETERS = [0, 1, 8]
+IDLE_PARAMETERS = [0, 1, 8, 2, 3]
+
+
+
+class MonotonicClock(object):
+    """Monotonic host clock"""
+
+    def time(self):
+        return monotonic()
+
+    def sleep(self, seconds):
+        if seconds > 0:
+            time.sleep(seconds)
+
+
+def motorList(device, motors):
+    """motors as list: None is all motors of device, a number one motor"""
+    if motors is None:
+        return range(device.num_motors)
+    if isinstance(motors, (int, long)):
+        return [motors]
+    return list(motors)
+
+
+def waitFor(device, motors, idle=False, timeout=None, clock=None,
+            min_interval=0.001, max_interval=0.1, timeline=None):
+    """
+    Poll motors of device until every one reached its target position
+    (or is idle: stands still with target speed 0 or target reached).
+
+    Each sweep reads REACHED_PARAMETERS (IDLE_PARAMETERS) of all
+    unfinished motors in one pipelined exchange. The next sweep is
+    scheduled at the earliest expected arrival, remaining distance /
+    speed measured between sweeps, within [min_interval, max_interval].
+    Without a speed estimate the interval doubles from min_interval.
+
+    Return {motor: actual position}, raise TMCLTimeoutError after
+    timeout seconds. A timeline list gets (time, unfinished motors)
+    appended for every sweep.
+    """
+    clock = clock or MonotonicClock()
+    command = "wait_until_idle" if idle else "wait_until_reached"
+    pending = motorList(device, motors)
+    parameters = IDLE_PARAMETERS if idle else REACHED_PARAMETERS
+    n = len(parameters)
+    requests = device.validate('GAP', [(pn, mn, 0) for mn in pending for pn in parameters])
+    queries = dict((mn, requests[i*n:i*n+n]) for i, mn in enumerate(pending))
+    start = clock.time()
+    deadline = None if timeout is None else start + timeout
+    positions = {}
+    last = {}
+    backoff = min_interval
+    while pending:
+        sweep = clock.time()
+        replies = device._exchange([q for mn in pending for q in queries[mn]])
+        now = clock.time()
+        etas = []
+        moving = []
+        for i, mn in enumerate(pending):
+            values = []
+            for rep in replies[i*n:i*n+n]:
+                if isinstance(rep, TMCLError):
+                    raise rep
+                if rep.status != STAT_OK:
+                    raise TMCLStatusError('GAP', STATUSCODES.get(rep.status, rep.status))
+                values.append(rep.value)
+            target, actual, reached = values[:3]
+            positions[mn] = actual
+            if idle:
+                target_speed, speed = values[3:]
+                done = speed == 0 and (reached or target_speed == 0)
+            else:
+                done = reached
+            if done:
+                continue
+            moving.append(mn)
+            previous = last.get(mn)
+            last[mn] = (now, actual)
+            if previous is not None and now > previous[0] and actual != previous[1]:
+                measured = abs(actual - previous[1]) / (now - previous[0])
+                etas.append(abs(target - actual) / measured)
+        pending = moving
+        if timeline is not None:
+            timeline.append((now, len(pending)))
+        if not pending:
+            break
+        if etas:
+            interval = backoff = max(min_interval, min(max_interval, min(etas)))
+        else:
+            interval = backoff = min(max_interval, backoff * 2)
+        wake = sweep + interval
+        if deadline is not None:
+            if now >= deadline:
+                raise TMCLTimeoutError(command, "motors {} not done after {} s".format(pending, timeout))
+            wake = min(wake, deadline)
+        clock.sleep(wake - clock.time())
+    return positions
@@ -0,0 +1,127 @@
+
+from error import *
+from motion import MonotonicClock, motorList, waitFor
+
+
+
+def summarize(values):
+    """count, mean, min and max of a list of seconds"""
+    if not values:
+        return {'count': 0, 'mean': 0.0, 'min': 0.0, 'max': 0.0}
+    return {'count': len(values), 'mean': sum(values) / len(values),
+            'min': min(values), 'max': max(values)}
+
+
+def checkFutures(c, futures):
+    """Raise a TMCLBatchError for all failed futures of a pipeline"""
+    errors = [(i, f.exception()) for i, f in enumerate(futures) if f.exception() is not None]
+    if errors:
+        raise TMCLBatchError(c, errors)
+
+
+
+class MoveQueue(object):
+    """
+    Run a list of point-to-point moves from the coordinate table
+
+        queue = MoveQueue(dev, motors=[0, 1])
+        queue.run([(1000, 0), (2000, 500), (0, 0)])
+        print queue.report()
+
+    A point is one position per motor (or a plain position for a
+    single motor). Before the first move, the upcoming points are
+    written into the coordinate slots (default 1 .. max_coordinate-1)
+    of every motor. A move is started with MVP COORD for all motors in
+    one write, the slot it frees is refilled with a later point behind
+    the trigger, so only the trigger is on the critical path. With
+    preload=False the moves are sent as MVP ABS for comparison.
+
+    report() gives the dead time between moves: from the last sweep
+    that saw a motor still moving to the next trigger, an upper bound
+    of the time the axes stood still.
+    """
+
+    def __init__(self, device, motors=0, slots=None, clock=None, preload=True,
+                 min_interval=0.001, max_interval=0.1):
+        self.device = device
+        self.single = isinstance(motors, (int, long))
+        self.motors = motorList(device, motors)
+        if slots is None:
+            slots = range(1, device.max_coordinate)
+        self.slots = list(slots)
+        if not self.slots:
+            raise TMCLError("MoveQueue", "no coordinate slots")
+        self.clock = clock or MonotonicClock()
+        self.preload = preload
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.dead_times = []
+        self.detection = []
+        self.elapsed = 0.0
+
+    def _positions(self, points):
+        if self.single:
+            return [(int(p),) for p in points]
+        positions = [tuple(int(v) for v in p) for p in points]
+        for i, p in enumerate(positions):
+            if len(p) != len(self.motors):
+                raise TMCLError("MoveQueue", "point #{} has {} positions for {} motors".format(
+                    i, len(p), len(self.motors)))
+        return positions
+
+    def _load(self, p, slot, point):
+        return [p.sco(mn, slot, v) for mn, v in zip(self.motors, point)]
+
+    def run(self, points):
+        """Move through points, return the final {motor: position}"""
+        points = self._positions(points)
+        device, clock, slots = self.device, self.clock, self.slots
+        n = len(slots)
+        self.device.validate('SCO', [(slots[0], mn, v) for point in points
+                                     for mn, v in zip(self.motors, point)])
+        if self.preload and points:
+            with device.pipeline() as p:
+                futures = []
+                for i, point in enumerate(points[:n]):
+                    futures += self._load(p, slots[i], point)
+            checkFutures('SCO', futures)
+
+        start = clock.time()
+        last_moving = None
+        positions = {}
+        for i, point in enumerate(points):
+            slot = slots[i % n]
+            trigger = clock.time()
+            refills = []
+            with device.pipeline() as p:
+                if self.preload:
+                    moves = [p.mvp(mn, 'COORD', slot) for mn in self.motors]
+                    if i + n < len(points):
+                        refills = self._load(p, slot, points[i + n])
+                else:
+                    moves = [p.mvp(mn, 'ABS', v) for mn, v in zip(self.motors, point)]
+            checkFutures('MVP', moves)
+            checkFutures('SCO', refills)
+            if last_moving is not None:
+                self.dead_times.append(trigger - last_moving)
+            timeline = []
+            positions = waitFor(device, self.motors, False, clock=clock,
+                                min_interval=self.min_interval,
+                                max_interval=self.max_interval, timeline=timeline)
+            moving = [t for t, pending in timeline if pending]
+            last_moving = moving[-1] if moving else trigger
+            self.detection.append(timeline[-1][0] - last_moving)
+        self.elapsed += clock.time() - start
+        return positions
+
+    def report(self):
+        """Dead time between moves and completion detection latency, in seconds"""
+        return {'moves': len(self.detection),
+                'elapsed': self.elapsed,
+                'dead_time': summarize(self.dead_times),
+                'detection': summarize(self.detection)}
+
+    def reset_report(self):
+        self.dead_times = []
+        self.detection = []
+        self.elapsed = 0.0
@@ -0,0 +1,194 @@
+
+from collections import namedtuple
+
+import codec
+from consts import *
+from error import *
+from motion import MonotonicClock
+
+
+GAP, MVP, RFS = NUMBER_COMMANDS['GAP'], NUMBER_COMMANDS['MVP'], NUMBER_COMMANDS['RFS']
+MVP_REL = CMD_MVP_TYPES['REL']
+RFS_START, RFS_STATUS = CMD_RFS_TYPES['START'], CMD_RFS_TYPES['STATUS']
+
+# commands that have the same effect sent once or twice, whatever their type
+IDEMPOTENT_COMMANDS = ('ROR', 'ROL', 'MST', 'SAP', 'GAP', 'STAP', 'RSAP', 'SGP', 'GGP',
+                       'STGP', 'RSGP', 'SIO', 'GIO', 'SCO', 'GCO', 'STOP_APP', 'APP_STATUS')
+
+# commands where it depends on the type: the idempotent types
+IDEMPOTENT_TYPES = {'MVP': (CMD_MVP_TYPES, ('ABS', 'COORD')),
+                    'RFS': (CMD_RFS_TYPES, ('STOP', 'STATUS'))}
+
+# the module rejected the request, it was not executed
+STAT_WRONG_CHECKSUM = 1
+
+# (command number, type) or command number -> idempotent
+IDEMPOTENT = dict((NUMBER_COMMANDS.get(name, NUMBER_CONTROL_COMMANDS.get(name)), True)
+                  for name in IDEMPOTENT_COMMANDS)
+for name, (types, idempotent) in IDEMPOTENT_TYPES.iteritems():
+    for t_name, t in types.iteritems():
+        IDEMPOTENT[(NUMBER_COMMANDS[name], t)] = t_name in idempotent
+
+ReadBack = namedtuple('ReadBack', ['before', 'after', 'executed'])
+
+
+
+def isIdempotent(request):
+    """True if sending request twice has the same effect as sending it once"""
+    _, cn, t, _, _ = request
+    return IDEMPOTENT.get((cn, t), IDEMPOTENT.get(cn, False))
+
+
+def isRejected(rep):
+    """True for a reply of status 1: the module did not execute the request"""
+    return not isinstance(rep, TMCLError) and rep.status == STAT_WRONG_CHECKSUM
+
+
+def isTransient(rep):
+    """True for a reply lost or corrupted on the link, or rejected as corrupted"""
+    if isinstance(rep, TMCLError):
+        return isinstance(rep, (TMCLChecksumError, TMCLLengthError, TMCLTimeoutError))
+    return isRejected(rep)
+
+
+def targetPosition(request):
+    """GAP request of the target position of the motor of request"""
+    return (request[0], GAP, 0, request[3], 0)
+
+
+def referenceStatus(request):
+    """RFS STATUS request of the motor of request"""
+    return (request[0], RFS, RFS_STATUS, request[3], 0)
+
+
+# non-idempotent requests that can be verified: before(request) is read
+# in front of it, after(request) once its reply is lost, executed(request,
+# before, after) tells from the values if it was executed (True), was
+# not (False) or can not tell (None)
+READ_BACKS = {
+    # MVP REL moved the target position by its offset
+    (MVP, MVP_REL): ReadBack(targetPosition, targetPosition,
+                             lambda request, before, after:
+                                 True if after == before + request[4] else
+                                 False if after == before else None),
+    # RFS START is running, a search that already ended counts as not started
+    (RFS, RFS_START): ReadBack(None, referenceStatus,
+                               lambda request, before, after: after != 0),
+}
+
+
+
+class RetryPolicy(object):
+    """
+    Resend requests whose reply was lost or corrupted
+
+        dev = Device("/dev/ttyACM0", retry=RetryPolicy(attempts=3, backoff=0.01))
+
+    A request is tried up to attempts times when its reply fails with
+    a TMCLChecksumError, TMCLLengthError or TMCLTimeoutError, or has
+    status 1 (wrong checksum). The nth retry waits backoff * factor**(n-1)
+    seconds, at most max_backoff. The requests after a failed one of
+    the same exchange (a pipeline) ran already, so they are resent with
+    it, in order: SAP 4 then STAP 4 must not become STAP then SAP.
+
+    Status 1 means the module rejected the request, so any request is
+    resent. After a lost reply only idempotent requests are (see
+    isIdempotent): GAP, SAP or MVP ABS, but not MVP REL or RFS START,
+    which may have been executed. With verify those are read back
+    (READ_BACKS) to find out: one that was executed succeeds, one that
+    was not is resent, otherwise the error is kept. MVP REL then reads
+    the target position in front of the move, in the same exchange.
+    A request after the failed one that can not be repeated and ran (or
+    may have) ends the retries, the failed requests keep their errors.
+
+    Blocking commands and pipelines are retried, the futures of an
+    AsyncDevice or SharedDevice.futures() are not.
+    """
+
+    def __init__(self, attempts=3, backoff=0.0, factor=2.0, max_backoff=1.0,
+                 verify=False, clock=None):
+        self.attempts = attempts
+        self.backoff = backoff
+        self.factor = factor
+        self.max_backoff = max_backoff
+        self.verify = verify
+        self.clock = clock or MonotonicClock()
+
+    def delay(self, retry):
+        """Seconds to wait before the retry-th retry"""
+        return min(self.backoff * self.factor ** (retry - 1), self.max_backoff)
+
+    def _read_back(self, request):
+        if not self.verify or isIdempotent(request):
+            return None
+        return READ_BACKS.get(tuple(request[1:3]))
+
+    def exchange(self, device, requests):
+        """device._exchange(requests) with retries, returns the replies"""
+        metrics = device._metrics
+        sent, positions, before = [], [], {}
+        for i, request in enumerate(requests):
+            read_back = self._read_back(request)
+            if read_back is not None and read_back.before is not None:
+                before[i] = len(sent)
+                sent.append(read_back.before(request))
+            positions.append(len(sent))
+            sent.append(request)
+        replies = device._exchange(sent)
+        before = dict((i, replies[j]) for i, j in before.iteritems())
+        replies = [replies[j] for j in positions]
+        failed = set(i for i, rep in enumerate(replies) if isTransient(rep))
+        undecided = set()
+
+        for retry in xrange(1, self.attempts):
+            first = next((i for i, rep in enumerate(replies) if isTransient(rep)), None)
+            if first is None:
+                break
+            # the later requests ran already, they are resent after the failed one
+            suffix = range(first, len(requests))
+            unsafe = [i for i in suffix if not isIdempotent(requests[i]) and not isRejected(replies[i])]
+            lost = [i for i in unsafe if isTransient(replies[i]) and i not in undecided
+                    and self._read_back(requests[i])]
+            if len(lost) < len(unsafe):
+                break  # a request that can not be repeated ran, or may have
+            if lost:
+                again = self._verify(device, requests, replies, before, lost)
+                if len(again) < len(lost):
+                    undecided.update(i for i in lost if i not in again and isTransient(replies[i]))
+                    continue  # some ran: look at the stream again
+            self.clock.sleep(self.delay(retry))
+            for i in suffix:
+                metrics.retried(requests[i][1])
+            for i, rep in zip(suffix, device._exchange([requests[i] for i in suffix])):
+                replies[i] = rep
+                if isTransient(rep):
+                    failed.add(i)
+
+        for i in failed:
+            metrics.recovered(not isTransient(replies[i]))
+        return replies
+
+    def _verify(self, device, requests, replies, before, indices):
+        """
+        Read back the requests at indices whose reply was lost, replace
+        the replies of those executed, return the indices to resend
+        """
+        metrics = device._metrics
+        read_backs = [self._read_back(requests[i]) for i in indices]
+        values = device._exchange([rb.after(requests[i]) for i, rb in zip(indices, read_backs)])
+        resend = []
+        for i, read_back, after in zip(indices, read_backs, values):
+            ahead = before.get(i)
+            if isinstance(after, TMCLError) or after.status != STAT_OK or \
+               isinstance(ahead, TMCLError) or (ahead is not None and ahead.status != STAT_OK):
+                continue
+            request = requests[i]
+            executed = read_back.executed(request, None if ahead is None else ahead.value, after.value)
+            if executed is None:
+                continue
+            metrics.verified()
+            if executed:
+                replies[i] = codec.Reply(None, request[0], STAT_OK, request[1], request[4], None)
+            else:
+                resend.append(i)
+        return resend
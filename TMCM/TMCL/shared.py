@@ -0,0 +1,199 @@
+
+import threading
+import time
+
+from bus import FairQueue
+from cache import MISS
+from device import Device, resolveReply
+from error import *
+from futures import Future
+from metrics import Histogram
+
+
+
+class SharedDevice(Device):
+    """
+    Device that can be shared between threads
+
+    One I/O thread owns the port and serves a request queue, every
+    exchange (a single command or a whole pipeline) is one job, so
+    replies can not be mixed up between threads:
+
+        dev = SharedDevice("/dev/ttyACM0", queue_timeout=1.0)
+        with dev.options(priority=-1):       # this thread goes first
+            dev.mst(0)
+        f = dev.futures().gap(0, 1)          # non-blocking, a Future
+        print dev.stats()['queue']
+
+    Lower priority values are served first. Jobs of equal priority are
+    served in submission order, or round-robin between threads with
+    fair=True. A job still queued after queue_timeout seconds fails
+    with TMCLTimeoutError without being sent (timeout is the read
+    timeout of the port, as for Device). priority and queue_timeout
+    are defaults, options(priority, timeout) overrides them for the
+    calling thread.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.priority = kwargs.pop('priority', 0)
+        self.queue_timeout = kwargs.pop('queue_timeout', None)
+        self.fair = kwargs.pop('fair', False)
+        super(SharedDevice, self).__init__(*args, **kwargs)
+        self._cond = threading.Condition()
+        self._queue = FairQueue()
+        self._local = threading.local()
+        self._closed = False
+        self.reset_queue_stats()
+        self._thread = threading.Thread(target=self._serve, name="TMCL-io")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def options(self, priority=None, timeout=None):
+        """Context manager setting priority / timeout for this thread"""
+        return _Options(self._local, priority, timeout)
+
+    def submit(self, requests, priority=None, timeout=None):
+        """Queue an exchange of requests, return a Future of the replies"""
+        return self.call(lambda: Device._exchange(self, requests), priority, timeout)
+
+    def call(self, fn, priority=None, timeout=None):
+        """Run fn() in the I/O thread, return a Future of its result"""
+        if priority is None:
+            priority = getattr(self._local, 'priority', None)
+        if priority is None:
+            priority = self.priority
+        if timeout is None:
+            timeout = getattr(self._local, 'timeout', None)
+        if timeout is None:
+            timeout = self.queue_timeout
+        future = Future()
+        now = time.time()
+        deadline = None if timeout is None else now + timeout
+        key = threading.current_thread().ident if self.fair else None
+        with self._cond:
+            if self._closed:
+                raise TMCLError("SharedDevice", "device is closed")
+            self._queue.put(key, (fn, future, now, deadline), priority)
+            self._max_depth = max(self._max_depth, len(self._queue))
+            self._cond.notify()
+        return future
+
+    def _serve(self):
+        """I/O thread: run one job at a time in queue order"""
+        while True:
+            with self._cond:
+                while not self._queue and not self._closed:
+                    self._cond.wait()
+                if not self._queue:
+                    return
+                _, (fn, future, queued, deadline) = self._queue.pop()
+                now = time.time()
+                self._wait.add(now - queued)
+                expired = deadline is not None and now > deadline
+                if expired:
+                    self._expired += 1
+                else:
+                    self._served += 1
+            if expired:
+                future.set_exception(TMCLTimeoutError(
+                    "SharedDevice", "request queued for {:.3f} s".format(now - queued)))
+                continue
+            try:
+                result = fn()
+            except Exception as e:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+
+    def _exchange(self, requests):
+        """Blocking exchange through the I/O thread"""
+        return self.submit(requests).result()
+
+    def futures(self):
+        """View of this device whose commands return Futures"""
+        return FutureView(self)
+
+    def reconnect(self):
+        """Reopen the port in the I/O thread, between two jobs"""
+        return self.call(lambda: Device.reconnect(self)).result()
+
+    def queue_stats(self):
+        """
+        Current and maximum queue depth, jobs served and expired, and
+        the histogram of the time jobs waited in the queue
+        """
+        with self._cond:
+            return {'depth': len(self._queue), 'max_depth': self._max_depth,
+                    'served': self._served, 'expired': self._expired,
+                    'wait': self._wait.as_dict()}
+
+    def reset_queue_stats(self):
+        with self._cond:
+            self._max_depth = len(self._queue)
+            self._served = 0
+            self._expired = 0
+            self._wait = Histogram()
+
+    def stats(self):
+        """Link statistics (see Device.stats) with the queue_stats as 'queue'"""
+        stats = super(SharedDevice, self).stats()
+        stats['queue'] = self.queue_stats()
+        return stats
+
+    def close(self):
+        """Finish the queued jobs, stop the I/O thread and close the port"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join()
+        self._ser.close()
+
+
+
+class _Options(object):
+    """Thread-local priority / timeout of a SharedDevice"""
+
+    def __init__(self, local, priority, timeout):
+        self._local = local
+        self._values = {'priority': priority, 'timeout': timeout}
+
+    def __enter__(self):
+        self._saved = dict((k, getattr(self._local, k, None)) for k in self._values)
+        for k, v in self._values.iteritems():
+            if v is not None:
+                setattr(self._local, k, v)
+        return self
+
+    def __exit__(self, *exc):
+        for k, v in self._saved.iteritems():
+            setattr(self._local, k, v)
+        return False
+
+
+
+class FutureView(Device):
+    """Commands of a SharedDevice that return a Future instead of blocking"""
+
+    def __init__(self, device):
+        self._device = device
+
+    def __getattr__(self, name):
+        return getattr(self._device, name)
+
+    def _command(self, c, request, returns=True):
+        future = Future()
+        cache = self.cache
+        if cache is not None:
+            value = cache.lookup(request)
+            if value is not MISS:
+                future.set_result(value if returns else None)
+                return future
+
+        def done(f):
+            rep = f.exception() or f.result()[0]
+            resolveReply(future, c, rep, returns)
+            if cache is not None and future.exception() is None:
+                cache.remember(request, rep.value)
+
+        self._device.submit([request]).add_done_callback(done)
+        return future
@@ -0,0 +1,762 @@
+
+import math
+import os
+import random
+import select
+import threading
+import time
+import tty
+from collections import deque
+
+import codec
+from consts import *
+from error import *
+
+
+DEFAULT_AXIS = {   4 : 1000,
+                   5 : 1000,
+                   6 : 128,
+                   7 : 8,
+                 140 : 4,
+                 153 : 7,
+                 154 : 3,
+                 193 : 1,
+                 194 : 100,
+                 195 : 50,
+                 214 : 200
+               }
+
+DEFAULT_GLOBAL = { (0, 64)  : 0xE4,
+                   (0, 66)  : 1,
+                   (0, 76)  : 2
+                 }
+
+FAULTS = ('checksum', 'drop', 'noise', 'silence', 'reject')
+
+TICK = 0.01                     # TMCL timer tick in seconds
+MAX_INSTRUCTIONS = 1000         # per motion step, bounds busy loops
+
+
+
+def inRanges(value, ranges):
+    """True if value lies in any of the (low, high) ranges"""
+    for low, high in ranges:
+        if low <= value < high:
+            return True
+    return False
+
+
+
+class RealClock(object):
+    """Wall clock"""
+
+    def time(self):
+        return time.time()
+
+    def sleep(self, seconds):
+        if seconds > 0:
+            time.sleep(seconds)
+
+
+class VirtualClock(object):
+    """Clock that advances instantly on sleep, for faster than real time runs"""
+
+    def __init__(self, start=0.0):
+        self._now = float(start)
+        self._lock = threading.Lock()
+
+    def time(self):
+        return self._now
+
+    def sleep(self, seconds):
+        if seconds > 0:
+            with self._lock:
+                self._now += seconds
+
+
+
+class Axis(object):
+    """Motion state of one simulated motor"""
+
+    __slots__ = ['position', 'velocity', 'mode', 'target', 'speed',
+                 'left_limit', 'right_limit', 'home']
+
+    def __init__(self):
+        self.position = 0.0
+        self.velocity = 0.0
+        self.mode = None      # None, 'velocity', 'position' or 'reference'
+        self.target = 0
+        self.speed = 0
+        self.left_limit = None
+        self.right_limit = None
+        self.home = 0
+
+
+
+class Simulator(object):
+    """
+    Simulated TMCL module (StepRocker)
+
+    Axis and global parameter storage is built from AXIS_PARAMETER and
+    GLOBAL_PARAMETER, the motion model ramps every axis with its max
+    acceleration (#5) towards its max positioning speed (#4) and
+    integrates the position in time steps of at most max_step seconds.
+    One velocity unit is one step per second here.
+
+    Limit switches are placed with axis(mn).left_limit / right_limit,
+    the reference switch with axis(mn).home.
+
+    TMCL programs can be downloaded and run (standalone mode): the
+    program executes between motion steps, with the accumulator, COMP
+    flags, jumps, subroutines, CALC/CALCX, AAP/AGP/ACO and WAIT TICKS/POS.
+    Interrupts are not simulated, EI/DI/VECT are ignored.
+    """
+
+    def __init__(self, num_motors=3, address=1, host_address=2,
+                 num_coordinates=21, clock=None, max_step=0.001):
+        self.num_motors = num_motors
+        self.address = address
+        self.host_address = host_address
+        self.clock = clock or RealClock()
+        self.max_step = max_step
+        self.axes = [Axis() for _ in xrange(num_motors)]
+        self.axis_parameter = [dict((pn, DEFAULT_AXIS.get(pn, 0)) for pn in AXIS_PARAMETER)
+                               for _ in xrange(num_motors)]
+        self.global_parameter = dict((key, DEFAULT_GLOBAL.get(key, 0)) for key in GLOBAL_PARAMETER)
+        self.global_parameter[(0, 66)] = address
+        self.global_parameter[(0, 76)] = host_address
+        self.axis_eeprom = [dict(p) for p in self.axis_parameter]
+        self.global_eeprom = dict(self.global_parameter)
+        self.coordinates = [[0] * num_coordinates for _ in xrange(num_motors)]
+        self.inputs = {0: [0, 0, 0, 0], 1: [0, 0, 0], 2: [0, 0, 0, 0, 0]}
+        self.requests = 0
+        self.program = {}
+        self.accumulator = 0
+        self.x_register = 0
+        self._comparison = 0
+        self._stack = []
+        self._wait_start = None
+        self._download = None
+        self._lock = threading.RLock()
+        self._last = self.clock.time()
+        self._handlers = { 'ROR'  : self._ror,  'ROL'  : self._rol,
+                           'MST'  : self._mst,  'MVP'  : self._mvp,
+                           'SAP'  : self._sap,  'GAP'  : self._gap,
+                           'STAP' : self._stap, 'RSAP' : self._rsap,
+                           'SGP'  : self._sgp,  'GGP'  : self._ggp,
+                           'STGP' : self._stgp, 'RSGP' : self._rsgp,
+                           'RFS'  : self._rfs,  'SIO'  : self._sio,
+                           'GIO'  : self._gio,  'SCO'  : self._sco,
+                           'GCO'  : self._gco,  'CCO'  : self._cco,
+                           'STOP_APP'       : self._stop_app,
+                           'RUN_APP'        : self._run_app,
+                           'STEP_APP'       : self._step_app,
+                           'RESET_APP'      : self._reset_app,
+                           'DOWNLOAD_START' : self._download_start,
+                           'DOWNLOAD_END'   : self._download_end,
+                           'APP_STATUS'     : self._app_status
+                         }
+        self._instructions = { 'CALC'  : self._calc,  'COMP' : self._comp,
+                               'JC'    : self._jc,    'JA'   : self._ja,
+                               'CSUB'  : self._csub,  'RSUB' : self._rsub,
+                               'WAIT'  : self._wait,  'STOP' : self._stop,
+                               'CALCX' : self._calcx, 'AAP'  : self._aap,
+                               'AGP'   : self._agp,   'ACO'  : self._aco,
+                               'EI'    : self._ignore, 'DI'  : self._ignore,
+                               'VECT'  : self._ignore, 'RETI' : self._rsub
+                             }
+
+    def axis(self, motor_number):
+        return self.axes[motor_number]
+
+    def process(self, frame):
+        """Handle one 9-byte request frame, return the 9-byte reply frame"""
+        with self._lock:
+            self.requests += 1
+            self.advance()
+            try:
+                req = codec.unpackRequestCommand(frame)
+            except TMCLError:
+                cn = bytearray(frame[1:2] or "\x00")[0]
+                return codec.packReplyCommand(self.host_address, self.address, 1, cn, 0)
+            status, value = self.execute(req.command_number, req.type_number,
+                                         req.motor_number, req.value)
+            return codec.packReplyCommand(self.host_address, self.address,
+                                          status, req.command_number, value)
+
+    def execute(self, n_command, n_type, n_motor, value):
+        """Execute a decoded command, return (status, value)"""
+        if self._download is not None and n_command in COMMAND_NUMBERS:
+            self.program[self._download] = (n_command, n_type, n_motor, value)
+            self._download += 1
+            return STAT_LOADED, value
+        name = COMMAND_NUMBERS.get(n_command) or CONTROL_COMMAND_NUMBERS.get(n_command)
+        handler = self._handlers.get(name)
+        if handler is None:
+            return 2, 0
+        try:
+            result = handler(n_type, n_motor, value)
+        except (IndexError, KeyError):
+            return 3, 0
+        if isinstance(result, tuple):
+            return result
+        return STAT_OK, value if result is None else result
+
+    # --- motion model ------------------------------------------------------
+
+    def advance(self):
+        """Integrate the motion model up to the current clock time"""
+        with self._lock:
+            now = self.clock.time()
+            dt, self._last = now - self._last, now
+            while dt > 0:
+                step = min(dt, self.max_step)
+                self.step(step)
+                dt -= step
+                if self.global_parameter[(0, 128)] == 1:
+                    for mn, axis in enumerate(self.axes):
+                        self._publish(mn, axis)
+                    self.run_program(now - dt)
+            for mn, axis in enumerate(self.axes):
+                self._publish(mn, axis)
+
+    def step(self, dt):
+        """Advance all axes by dt seconds"""
+        for mn, axis in enumerate(self.axes):
+            if axis.velocity == 0 and (axis.mode is None or
+                                       (axis.mode == 'velocity' and axis.speed == 0) or
+                                       (axis.mode == 'position' and axis.position == axis.target)):
+                continue
+            p = self.axis_parameter[mn]
+            accel = max(p[5], 1)
+            if axis.mode == 'velocity':
+                wanted = axis.speed
+            elif axis.mode in ('position', 'reference'):
+                limit = p[194] if axis.mode == 'reference' else p[4]
+                distance = axis.target - axis.position
+                wanted = math.copysign(min(limit, math.sqrt(2 * accel * abs(distance))), distance)
+            else:
+                wanted = 0
+            dv = max(-accel * dt, min(accel * dt, wanted - axis.velocity))
+            before = axis.position
+            axis.velocity += dv
+            axis.position += axis.velocity * dt
+            if axis.mode in ('position', 'reference'):
+                if (before - axis.target) * (axis.position - axis.target) <= 0:
+                    axis.position = float(axis.target)
+                    axis.velocity = 0.0
+                    if axis.mode == 'reference':
+                        axis.position = axis.target = 0
+                        axis.home = 0
+                    axis.mode = 'position'
+            if (axis.right_limit is not None and not p[12] and
+                    axis.position >= axis.right_limit and axis.velocity > 0):
+                axis.position, axis.velocity, axis.mode = float(axis.right_limit), 0.0, None
+            if (axis.left_limit is not None and not p[13] and
+                    axis.position <= axis.left_limit and axis.velocity < 0):
+                axis.position, axis.velocity, axis.mode = float(axis.left_limit), 0.0, None
+            if axis.mode is None and abs(axis.velocity) < accel * dt:
+                axis.velocity = 0.0
+
+    def _publish(self, mn, axis):
+        """Mirror the motion state into the readable axis parameters"""
+        p = self.axis_parameter[mn]
+        p[0] = int(axis.target)
+        p[1] = int(round(axis.position))
+        p[2] = int(axis.speed)
+        p[3] = int(round(axis.velocity))
+        p[8] = int(axis.mode == 'position' and axis.velocity == 0 and
+                   axis.position == axis.target)
+        p[9] = int(axis.position <= axis.home)
+        p[10] = int(axis.right_limit is not None and axis.position >= axis.right_limit)
+        p[11] = int(axis.left_limit is not None and axis.position <= axis.left_limit)
+        p[135] = p[5] if axis.velocity and axis.mode is not None else 0
+
+    def _rotate(self, mn, speed):
+        axis = self.axes[mn]
+        axis.mode, axis.speed = 'velocity', speed
+
+    # --- command handlers --------------------------------------------------
+
+    def _ror(self, t, mn, value):
+        self._rotate(mn, value)
+
+    def _rol(self, t, mn, value):
+        self._rotate(mn, -value)
+
+    def _mst(self, t, mn, value):
+        self._rotate(mn, 0)
+
+    def _mvp(self, t, mn, value):
+        axis = self.axes[mn]
+        if t == CMD_MVP_TYPES['ABS']:
+            target = value
+        elif t == CMD_MVP_TYPES['REL']:
+            target = axis.target + value
+        elif t == CMD_MVP_TYPES['COORD']:
+            target = self.coordinates[mn][value]
+        else:
+            return 3, 0
+        if not inRanges(target, TR_24s):
+            return 4, 0
+        axis.mode, axis.target = 'position', target
+        self._publish(mn, axis)
+
+    def _sap(self, t, mn, value):
+        name, ranges, access = AXIS_PARAMETER[t]
+        p = self.axis_parameter[mn]
+        if not access & T_W:
+            return 3, 0
+        if not inRanges(value, ranges):
+            return 4, 0
+        axis = self.axes[mn]
+        if t == 0:
+            axis.mode, axis.target = 'position', value
+        elif t == 1:
+            axis.position = float(value)
+        elif t == 2:
+            self._rotate(mn, value)
+        p[t] = value
+        self._publish(mn, axis)
+
+    def _gap(self, t, mn, value):
+        return self.axis_parameter[mn][t]
+
+    def _stap(self, t, mn, value):
+        if self.global_parameter[(0, 73)]:
+            return 5, 0
+        if t not in AXIS_PARAMETER:
+            return 3, 0
+        self.axis_eeprom[mn][t] = self.axis_parameter[mn][t]
+
+    def _rsap(self, t, mn, value):
+        if t not in AXIS_PARAMETER:
+            return 3, 0
+        self.axis_parameter[mn][t] = self.axis_eeprom[mn][t]
+
+    def _sgp(self, t, bank, value):
+        name, ranges, access = GLOBAL_PARAMETER[(bank, t)]
+        if not access & T_W:
+            return 3, 0
+        if not inRanges(value, ranges):
+            return 4, 0
+        self.global_parameter[(bank, t)] = value
+        if access & T_E and bank != 2:
+            self.global_eeprom[(bank, t)] = value
+
+    def _ggp(self, t, bank, value):
+        return self.global_parameter[(bank, t)]
+
+    def _stgp(self, t, bank, value):
+        if self.global_parameter[(0, 73)]:
+            return 5, 0
+        self.global_eeprom[(bank, t)] = self.global_parameter[(bank, t)]
+
+    def _rsgp(self, t, bank, value):
+        self.global_parameter[(bank, t)] = self.global_eeprom[(bank, t)]
+
+    def _rfs(self, t, mn, value):
+        axis = self.axes[mn]
+        if t == CMD_RFS_TYPES['START']:
+            axis.mode = 'reference'
+            axis.target = axis.home
+        elif t == CMD_RFS_TYPES['STOP']:
+            self._rotate(mn, 0)
+        elif t == CMD_RFS_TYPES['STATUS']:
+            return int(axis.mode == 'reference')
+        else:
+            return 3, 0
+        return 0
+
+    def _sio(self, t, bank, value):
+        self.inputs[bank][t] = int(bool(value))
+
+    def _gio(self, t, bank, value):
+        return self.inputs[bank][t]
+
+    def _sco(self, t, mn, value):
+        self.coordinates[mn][t] = value
+
+    def _gco(self, t, mn, value):
+        return self.coordinates[mn][t]
+
+    def _cco(self, t, mn, value):
+        self.coordinates[mn][t] = self.axis_parameter[mn][1]
+
+
+
+    # --- TMCL program ------------------------------------------------------
+
+    def run_program(self, now, limit=MAX_INSTRUCTIONS):
+        """Execute program instructions until a WAIT blocks or it stops"""
+        for _ in xrange(limit):
+            if not self.step_program(now):
+                break
+
+    def step_program(self, now):
+        """Execute one instruction, False if the program waits or stopped"""
+        pc = self.global_parameter[(0, 130)]
+        if pc not in self.program:
+            self.global_parameter[(0, 128)] = 0
+            return False
+        n_command, t, mn, value = self.program[pc]
+        self.global_parameter[(0, 130)] = pc + 1
+        name = COMMAND_NUMBERS[n_command]
+        if name in self._instructions:
+            try:
+                result = self._instructions[name](t, mn, value, now)
+            except (IndexError, KeyError, ZeroDivisionError):
+                result = False
+            if result is False:
+                self.global_parameter[(0, 130)] = pc
+                if name != 'WAIT':
+                    self.global_parameter[(0, 128)] = 0
+                return False
+            return True
+        status, result = self.execute(n_command, t, mn, value)
+        if status != STAT_OK:
+            self.global_parameter[(0, 128)] = 0
+            return False
+        if name in ('GAP', 'GGP', 'GIO', 'GCO'):
+            self.accumulator = result
+        return True
+
+    @staticmethod
+    def _operate(op, a, b):
+        """CALC/CALCX operation op on a with operand b, as int32"""
+        if op == 3:
+            result = int(float(a) / b)
+        elif op == 4:
+            result = a - b * int(float(a) / b)
+        else:
+            result = [a + b, a - b, a * b, None, None, a & b, a | b, a ^ b, ~a][op]
+        return (result + 2**31) % 2**32 - 2**31
+
+    def _calc(self, t, mn, value, now):
+        if t == CMD_CALC_TYPES['LOAD']:
+            self.accumulator = value
+        else:
+            self.accumulator = self._operate(t, self.accumulator, value)
+        self._comparison = cmp(self.accumulator, 0)
+
+    def _calcx(self, t, mn, value, now):
+        if t == CMD_CALCX_TYPES['LOAD']:
+            self.accumulator = self.x_register
+        elif t == CMD_CALCX_TYPES['SWAP']:
+            self.accumulator, self.x_register = self.x_register, self.accumulator
+        else:
+            self.accumulator = self._operate(t, self.accumulator, self.x_register)
+        self._comparison = cmp(self.accumulator, 0)
+
+    def _comp(self, t, mn, value, now):
+        self._comparison = cmp(self.accumulator, value)
+
+    def _jc(self, t, mn, value, now):
+        c = self._comparison
+        taken = [c == 0, c != 0, c == 0, c != 0, c > 0, c >= 0, c < 0, c <= 0]
+        if t < len(taken) and taken[t]:
+            self.global_parameter[(0, 130)] = value
+
+    def _ja(self, t, mn, value, now):
+        self.global_parameter[(0, 130)] = value
+
+    def _csub(self, t, mn, value, now):
+        self._stack.append(self.global_parameter[(0, 130)])
+        self.global_parameter[(0, 130)] = value
+
+    def _rsub(self, t, mn, value, now):
+        self.global_parameter[(0, 130)] = self._stack.pop()
+
+    def _wait(self, t, mn, value, now):
+        if self._wait_start is None:
+            self._wait_start = now
+        if t == CMD_WAIT_TYPES['TICKS']:
+            done = now - self._wait_start >= value * TICK - 1e-9
+        elif t == CMD_WAIT_TYPES['POS']:
+            done = bool(self.axis_parameter[mn][8])
+            if not done and value:
+                done = now - self._wait_start >= value * TICK
+        elif t == CMD_WAIT_TYPES['RFS']:
+            done = self.axes[mn].mode != 'reference'
+        else:
+            done = True
+        if done:
+            self._wait_start = None
+            return True
+        return False
+
+    def _stop(self, t, mn, value, now):
+        self.global_parameter[(0, 128)] = 0
+
+    def _aap(self, t, mn, value, now):
+        return self.execute(NUMBER_COMMANDS['SAP'], t, mn, self.accumulator)[0] == STAT_OK
+
+    def _agp(self, t, bank, value, now):
+        return self.execute(NUMBER_COMMANDS['SGP'], t, bank, self.accumulator)[0] == STAT_OK
+
+    def _aco(self, t, mn, value, now):
+        self.coordinates[mn][t] = self.accumulator
+
+    def _ignore(self, t, mn, value, now):
+        pass
+
+    def _stop_app(self, t, mn, value):
+        self.global_parameter[(0, 128)] = 0
+
+    def _run_app(self, t, mn, value):
+        if t:
+            self.global_parameter[(0, 130)] = value
+        self._wait_start = None
+        self.global_parameter[(0, 128)] = 1
+
+    def _step_app(self, t, mn, value):
+        self.global_parameter[(0, 128)] = 2
+        self.step_program(self.clock.time())
+
+    def _reset_app(self, t, mn, value):
+        self.global_parameter[(0, 128)] = 0
+        self.global_parameter[(0, 130)] = 0
+        self.accumulator = self.x_register = self._comparison = 0
+        self._stack = []
+        self._wait_start = None
+
+    def _download_start(self, t, mn, value):
+        self.global_parameter[(0, 128)] = 0
+        self.global_parameter[(0, 129)] = 1
+        self._download = value
+
+    def _download_end(self, t, mn, value):
+        self.global_parameter[(0, 129)] = 0
+        self._download = None
+
+    def _app_status(self, t, mn, value):
+        return self.global_parameter[(0, 128)]
+
+
+
+class SimulatedSerial(object):
+    """
+    In-process serial port connected to a Simulator
+
+    Passed as port to a Device it behaves like a pyserial port:
+
+        sim = Simulator(clock=VirtualClock())
+        dev = Device(port=SimulatedSerial(sim, baudrate=115200))
+
+    Each frame occupies the link for 10 bits per byte at the given
+    baudrate, the module answers after the turnaround latency. Reads
+    wait on the simulator clock, so with a VirtualClock long scenarios
+    run faster than real time. Faults are injected either randomly
+    (corrupt_rate, drop_rate) or one-shot with inject(fault):
+        'checksum' - reply with a wrong checksum
+        'drop'     - reply with one byte missing
+        'noise'    - a stray byte before the reply
+        'silence'  - no reply at all
+        'reject'   - the request arrives corrupted, it is not executed
+                     and answered with status 1 (wrong checksum)
+    A blocking read (timeout=None) that can not be satisfied returns
+    short instead of hanging forever.
+
+    With rs485 the link settings of the module count: requests sent at
+    another baudrate than its RS485 baud rate (global parameter 0, 65)
+    are not understood, replies are delayed by its telegram pause time
+    (0, 75), corrupted above max_baudrate and lost with a pause shorter
+    than min_pause seconds (the bus is not turned around in time). The
+    module switches its baud rate after replying.
+    """
+
+    def __init__(self, simulator=None, baudrate=9600, turnaround=0.0, timeout=None,
+                 corrupt_rate=0.0, drop_rate=0.0, seed=None,
+                 rs485=False, max_baudrate=None, min_pause=0.0):
+        self.simulator = simulator or Simulator()
+        self.clock = self.simulator.clock
+        self.baudrate = baudrate
+        self.turnaround = turnaround
+        self.timeout = timeout
+        self.corrupt_rate = corrupt_rate
+        self.drop_rate = drop_rate
+        self.rs485 = rs485
+        self.max_baudrate = max_baudrate
+        self.min_pause = min_pause
+        self.is_open = True
+        self._random = random.Random(seed)
+        self._faults = deque()
+        self._lock = threading.Lock()
+        self._incoming = ""
+        self._pending = deque()
+        self._ready = ""
+        self._busy_until = 0.0
+
+    @property
+    def frame_time(self):
+        """Seconds one 9-byte frame occupies the link"""
+        return codec.COMMAND_STRING_LENGTH * 10.0 / self.baudrate
+
+    def inject(self, fault, count=1, skip=0):
+        """Apply fault to the next count requests, after skip good ones"""
+        if fault not in FAULTS:
+            raise ValueError("fault needs to be one of {}".format(FAULTS))
+        self._faults.extend([None] * skip + [fault] * count)
+
+    def _next_fault(self):
+        """Fault of the next request, None for none"""
+        if self._faults:
+            return self._faults.popleft()
+        if self._random.random() < self.corrupt_rate:
+            return 'checksum'
+        if self._random.random() < self.drop_rate:
+            return 'drop'
+        return None
+
+    def _process(self, frame, fault):
+        """Reply of the module to frame, with fault applied"""
+        if fault == 'reject':
+            frame = frame[:8] + chr((ord(frame[8]) + 1) % 256)
+        reply = self.simulator.process(frame)
+        if fault in (None, 'reject'):
+            return reply
+        if fault == 'checksum':
+            return reply[:8] + chr((ord(reply[8]) + 1) % 256)
+        if fault == 'drop':
+            i = self._random.randrange(len(reply))
+            return reply[:i] + reply[i+1:]
+        if fault == 'noise':
+            return chr(self._random.randrange(256)) + reply
+        return ""
+
+    def _rs485(self, frame):
+        """Reply to frame as the module's RS485 settings allow"""
+        parameters = self.simulator.global_parameter
+        if BAUD_RATES.get(parameters[(0, 65)]) != self.baudrate:
+            return ""
+        pause = parameters[(0, 75)] / 1000.0
+        reply = self._process(frame, self._next_fault())
+        if pause < self.min_pause:
+            return ""
+        if self.max_baudrate is not None and self.baudrate > self.max_baudrate:
+            return reply[:8] + chr((ord(reply[8]) + 1) % 256)
+        return reply
+
+    def write(self, data):
+        with self._lock:
+            self._incoming += str(data)
+            t = max(self.clock.time(), self._busy_until)
+            n = codec.COMMAND_STRING_LENGTH
+            while len(self._incoming) >= n:
+                frame, self._incoming = self._incoming[:n], self._incoming[n:]
+                t += self.turnaround + 2 * self.frame_time
+                if self.rs485:
+                    reply = self._rs485(frame)
+                    t += self.simulator.global_parameter[(0, 75)] / 1000.0
+                else:
+                    reply = self._process(frame, self._next_fault())
+                if reply:
+                    self._pending.append((t, reply))
+            self._busy_until = t
+        return len(data)
+
+    def _collect(self):
+        now = self.clock.time()
+        while self._pending and self._pending[0][0] <= now:
+            self._ready += self._pending.popleft()[1]
+
+    def next_reply(self):
+        """Seconds until the next pending reply is on the wire, or None"""
+        with self._lock:
+            if not self._pending:
+                return None
+            return max(self._pending[0][0] - self.clock.time(), 0.0)
+
+    def read(self, size=1):
+        deadline = None if self.timeout is None else self.clock.time() + self.timeout
+        while True:
+            with self._lock:
+                self._collect()
+                if len(self._ready) >= size or (not self._pending and self.timeout is None):
+                    break
+                wake = self._pending[0][0] if self._pending else deadline
+            if deadline is not None:
+                wake = min(wake, deadline)
+                if self.clock.time() >= deadline:
+                    break
+            self.clock.sleep(wake - self.clock.time())
+        with self._lock:
+            self._collect()
+            data, self._ready = self._ready[:size], self._ready[size:]
+        return data
+
+    @property
+    def in_waiting(self):
+        with self._lock:
+            self._collect()
+            return len(self._ready)
+
+    def reset_input_buffer(self):
+        with self._lock:
+            self._pending.clear()
+            self._ready = ""
+
+    def reset_output_buffer(self):
+        with self._lock:
+            self._incoming = ""
+
+    def flush(self):
+        pass
+
+    def open(self):
+        self.reset_input_buffer()
+        self.reset_output_buffer()
+        self.is_open = True
+
+    def close(self):
+        self.is_open = False
+
+
+
+class PtySimulator(object):
+    """
+    Serve a Simulator on a pseudo-terminal
+
+        server = PtySimulator()
+        dev = Device(server.port)
+
+    Link timing and faults are those of the SimulatedSerial created from
+    the keyword arguments. The simulator has to run on a RealClock.
+    """
+
+    def __init__(self, simulator=None, **kwargs):
+        self.link = SimulatedSerial(simulator or Simulator(), timeout=0, **kwargs)
+        self.simulator = self.link.simulator
+        self._master, self._slave = os.openpty()
+        tty.setraw(self._slave)
+        self.port = os.ttyname(self._slave)
+        self._closed = False
+        self._thread = threading.Thread(target=self._serve, name="TMCL-pty")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _serve(self):
+        while not self._closed:
+            wait = self.link.next_reply()
+            readable, _, _ = select.select([self._master], [], [], 0.05 if wait is None else wait)
+            if readable:
+                try:
+                    self.link.write(os.read(self._master, 4096))
+                except OSError:
+                    return
+            data = self.link.read(4096)
+            if data:
+                os.write(self._master, data)
+
+    def close(self):
+        self._closed = True
+        self._thread.join()
+        os.close(self._master)
+        os.close(self._slave)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
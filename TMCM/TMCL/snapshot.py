@@ -0,0 +1,133 @@
+
+import time
+
+from cache import defaultVolatility
+from consts import *
+from error import *
+
+
+
+class Snapshot(object):
+    """
+    Parameter values of a module at one point in time
+
+    Values are keyed ('axis', motor, parameter) and
+    ('global', bank, parameter), reads that failed are kept in errors.
+    """
+
+    __slots__ = ['values', 'errors', 'time']
+
+    def __init__(self, values=None, errors=None, timestamp=None):
+        self.values = values if values is not None else {}
+        self.errors = errors if errors is not None else {}
+        self.time = time.time() if timestamp is None else timestamp
+
+    def __getitem__(self, key):
+        return self.values[key]
+
+    def __contains__(self, key):
+        return key in self.values
+
+    def __len__(self):
+        return len(self.values)
+
+    def get(self, key, default=None):
+        return self.values.get(key, default)
+
+    def diff(self, previous):
+        """Return {key: (previous value, value)} for every changed key"""
+        changed = {}
+        for key, value in self.values.iteritems():
+            old = previous.values.get(key)
+            if old != value:
+                changed[key] = (old, value)
+        for key, old in previous.values.iteritems():
+            if key not in self.values:
+                changed[key] = (old, None)
+        return changed
+
+    def check(self):
+        """Raise the error of the first failed read, if any"""
+        if self.errors:
+            raise self.errors[min(self.errors)]
+
+    def named_axis(self, motors):
+        """Axis values by name, as StepRocker.get_parameters returns them"""
+        retmotor = [{} for _ in motors]
+        retsingle = {}
+        for (kind, mn, pn), value in self.values.iteritems():
+            if kind != 'axis':
+                continue
+            name = AXIS_PARAMETER[pn][0]
+            if pn in SINGLE_AXIS_PARAMETERS:
+                retsingle[name] = value
+            else:
+                retmotor[list(motors).index(mn)][name] = value
+        return retmotor, retsingle
+
+    def named_globals(self):
+        """Global values by name, as StepRocker.get_globals returns them"""
+        return dict((GLOBAL_PARAMETER[(bank, pn)][0], value)
+                    for (kind, bank, pn), value in self.values.iteritems()
+                    if kind == 'global')
+
+
+
+class SnapshotEngine(object):
+    """
+    Read parameter sets of a Device in pipelined batches
+
+        engine = SnapshotEngine(dev, banks=[0, 3])    # skip bank 2
+        before = engine.take()
+        ...
+        after = engine.refresh(before)                # live values only
+        print after.diff(before)
+
+    axis_parameters / global_parameters select parameter numbers
+    (default: all of AXIS_PARAMETER / GLOBAL_PARAMETER), banks limits
+    the global ones to some banks. SINGLE_AXIS_PARAMETERS are only read
+    for the first motor. refresh() re-reads the V_LIVE parameters (see
+    cache.defaultVolatility, overridable with volatility) and copies
+    everything else from the previous snapshot.
+    """
+
+    def __init__(self, device, motors=None, axis_parameters=None,
+                 global_parameters=None, banks=None, batch=32, volatility=None):
+        self.device = device
+        self.batch = batch
+        motors = range(device.num_motors) if motors is None else list(motors)
+        if axis_parameters is None:
+            axis_parameters = AXIS_PARAMETER.keys()
+        if global_parameters is None:
+            global_parameters = GLOBAL_PARAMETER.keys()
+        self.keys = [('axis', mn, pn) for mn in motors for pn in sorted(axis_parameters)
+                     if pn not in SINGLE_AXIS_PARAMETERS or mn == motors[0]]
+        self.keys += [('global', bank, pn) for bank, pn in sorted(global_parameters)
+                      if banks is None or bank in banks]
+        classes = defaultVolatility()
+        classes.update(volatility or {})
+        self.live_keys = [key for key in self.keys
+                          if classes[key[2] if key[0] == 'axis' else key[1:]] == V_LIVE]
+
+    def take(self):
+        """Read all selected parameters"""
+        return self._read(self.keys, {})
+
+    def refresh(self, previous):
+        """Re-read the live parameters, keep the rest of previous"""
+        return self._read(self.live_keys, dict(previous.values))
+
+    def _read(self, keys, values):
+        futures = []
+        with self.device.pipeline(max_pending=self.batch) as p:
+            for kind, n, pn in keys:
+                futures.append(p.gap(n, pn) if kind == 'axis' else p.ggp(n, pn))
+        errors = {}
+        for key, future in zip(keys, futures):
+            error = future.exception()
+            if error is None:
+                values[key] = future.result()
+            else:
+                values.pop(key, None)
+                errors[key] = error
+        return Snapshot(values, errors)
@@ -0,0 +1,179 @@
+
+import threading
+
+import numpy as np
+
+from consts import *
+from error import *
+from tracing import monotonic
+
+
+# actual position, actual speed, actual load value, smartEnergy actual current
+DEFAULT_TELEMETRY = [1, 3, 206, 180]
+
+
+
+class RingBuffer(object):
+    """
+    Preallocated buffer of the last capacity timestamped samples
+
+    Every sample is one row of width int32 values, the memory footprint
+    is fixed at construction. When full, the oldest samples are
+    overwritten and counted in overwritten.
+    """
+
+    def __init__(self, capacity, width):
+        self.capacity = capacity
+        self.width = width
+        self.times = np.zeros(capacity, dtype=np.float64)
+        self.values = np.zeros((capacity, width), dtype=np.int32)
+        self.written = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return min(self.written, self.capacity)
+
+    @property
+    def overwritten(self):
+        return max(self.written - self.capacity, 0)
+
+    def append(self, timestamp, row):
+        with self._lock:
+            i = self.written % self.capacity
+            self.times[i] = timestamp
+            self.values[i] = row
+            self.written += 1
+
+    def latest(self, n=None):
+        """Copies (times, values) of the last n samples, oldest first"""
+        with self._lock:
+            count = len(self)
+            n = count if n is None else min(n, count)
+            end = self.written % self.capacity
+            idx = np.arange(end - n, end) % self.capacity
+            return self.times[idx], self.values[idx]
+
+    def clear(self):
+        with self._lock:
+            self.written = 0
+
+
+
+class Sampler(object):
+    """
+    Poll a parameter set of a Device into a RingBuffer
+
+        sampler = dev.stream([1, 3], motors=[0, 1], rate=200, background=True)
+        ...
+        times, values = sampler.buffer.latest(100)
+        print sampler.stats()
+        sampler.stop()
+
+    Every sample reads all (parameter, motor) pairs of columns in one
+    pipelined exchange. rate is in samples per second, None polls as
+    fast as the link allows. A tick that can not be kept because the
+    previous sample took too long, or a sample whose replies failed,
+    is counted as dropped.
+    """
+
+    def __init__(self, device, params=DEFAULT_TELEMETRY, motors=None, rate=None, capacity=4096):
+        motors = range(device.num_motors) if motors is None else list(motors)
+        self.device = device
+        self.columns = [(pn, mn) for mn in motors for pn in params]
+        self.requests = device.validate('GAP', [(pn, mn, 0) for pn, mn in self.columns])
+        self.rate = rate
+        self.buffer = RingBuffer(capacity, len(self.columns))
+        self.samples = 0
+        self.dropped = 0
+        self.errors = 0
+        self.last_error = None
+        self._started = None
+        self._stopped = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def column(self, pn, mn):
+        """Index of parameter pn of motor mn in a sample row"""
+        return self.columns.index((pn, mn))
+
+    def sample(self):
+        """Read one sample and append it to the buffer, return (time, row)"""
+        replies = self.device._exchange(self.requests)
+        timestamp = monotonic()
+        row = []
+        for rep in replies:
+            if isinstance(rep, TMCLError):
+                raise rep
+            if rep.status != STAT_OK:
+                raise TMCLStatusError('GAP', STATUSCODES.get(rep.status, rep.status))
+            row.append(rep.value)
+        self.buffer.append(timestamp, row)
+        self.samples += 1
+        return timestamp, row
+
+    def __iter__(self):
+        """Yield (time, row) for every sample until stop() is called"""
+        period = 1.0 / self.rate if self.rate else 0.0
+        self._stop.clear()
+        self._started = next_tick = monotonic()
+        self._stopped = None
+        try:
+            while not self._stop.is_set():
+                try:
+                    yield self.sample()
+                except TMCLError as e:
+                    self.errors += 1
+                    self.dropped += 1
+                    self.last_error = e
+                if not period:
+                    continue
+                next_tick += period
+                now = monotonic()
+                if now > next_tick:
+                    missed = int((now - next_tick) / period)
+                    self.dropped += missed
+                    next_tick += missed * period
+                else:
+                    self._stop.wait(next_tick - now)
+        finally:
+            self._stopped = monotonic()
+
+    def start(self):
+        """Sample in a background thread"""
+        if self._thread is not None and self._thread.is_alive():
+            raise TMCLError("Sampler", "already running")
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="TMCL-sampler")
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def _run(self):
+        for _ in self:
+            pass
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+            self._thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def stats(self):
+        """Requested and achieved sample rate, samples, dropped and failed ones"""
+        if self._started is None:
+            elapsed = 0.0
+        else:
+            elapsed = (self._stopped or monotonic()) - self._started
+        return {'requested_rate': self.rate,
+                'achieved_rate': self.samples / elapsed if elapsed > 0 else 0.0,
+                'samples': self.samples,
+                'dropped': self.dropped,
+                'errors': self.errors,
+                'overwritten': self.buffer.overwritten,
+                'elapsed': elapsed}
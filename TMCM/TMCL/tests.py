@@ -1,10 +1,46 @@
 #!/usr/bin/env python
 
 import unittest
+import os
+import shutil
+import StringIO
+import sys
+import tempfile
+import threading
+import time
 import codec
+import device
+import asyncdevice
+import bus
+import simulator
+import cache
+import snapshot
+import metrics
+import tracing
+import commands
+import motion
+import movequeue
+import assembler
+import capture
+import shared
+import fleet
+import config
+import daemon
+import gateway
+import framing
+import retry
+import tmcl
+from consts import *
 
 import random as rnd
 
+try:
+    import numpy as np
+    import batch
+    import telemetry
+except ImportError:
+    batch = telemetry = None
+
 
 MAXITER = 200
 REQUEST_KEYS = codec.REQUEST_KEYS + ['value']
@@ -246,6 +282,1632 @@ class CodecTestCase(unittest.TestCase):
 
 
 
+    def test_packCommand(self):
+        for _ in xrange(MAXITER):
+            params = self._gen_bytes(length=4)
+            value = rnd.randint(-2**31, 2**31-1)
+            self.assertEqual(codec.encodeCommand(params, value),
+                             codec.packCommand(*(params + [value])))
+
+
+    def test_unpackReplyCommand(self):
+        for _ in xrange(MAXITER):
+            string = self._gen_cmd_string()
+            decoded = codec.decodeReplyCommand(string)
+            record = codec.unpackReplyCommand(string)
+
+            self.assertEqual(decoded.values(), list(record))
+
+
+    def test_unpackCommandChecksum(self):
+        self.assertRaises(codec.TMCLError, codec.unpackReplyCommand, "ABCD\x00\x00\x00EP")
+        self.assertRaises(codec.TMCLError, codec.unpackReplyCommand, "ABCD\x00\x00\x00E")
+
+
+    def test_encodeMany(self):
+        requests = [self._gen_bytes(length=5) for _ in xrange(MAXITER)]
+        string = codec.encodeMany(requests)
+
+        self.assertEqual("".join(codec.encodeRequestCommand(*r) for r in requests), string)
+
+
+
+
+@unittest.skipIf(batch is None, "numpy not available")
+class BatchTestCase(unittest.TestCase):
+
+
+    def _gen_requests(self, n=MAXITER):
+        return [[rnd.randint(0, 255) for _ in xrange(4)] + [rnd.randint(-2**31, 2**31-1)]
+                for _ in xrange(n)]
+
+
+    def test_encodeRequestFrames(self):
+        requests = self._gen_requests()
+        columns = [np.array(c) for c in zip(*requests)]
+        frames = batch.encodeRequestFrames(*columns)
+
+        self.assertEqual(codec.encodeMany(requests), frames.tostring())
+
+
+    def test_encodeFramesBroadcast(self):
+        frames = batch.encodeRequestFrames(1, 6, 1, np.arange(3), -5)
+
+        self.assertEqual("".join(codec.encodeRequestCommand(1, 6, 1, mn, -5) for mn in xrange(3)),
+                         frames.tostring())
+
+
+    def test_decodeReplyFrames(self):
+        requests = self._gen_requests()
+        string = codec.encodeMany(requests)
+        result, bad = batch.decodeReplyFrames(string)
+
+        self.assertFalse(bad.any())
+        for record, request in zip(result, requests):
+            self.assertEqual(list(record)[:5], request)
+
+
+    def test_decodeFramesChecksum(self):
+        frames = batch.encodeRequestFrames(1, 6, np.arange(10), 0, np.arange(10) - 5)
+        frames[[2, 7], 8] += 1
+        _, bad = batch.decodeRequestFrames(frames)
+
+        self.assertEqual([2, 7], list(np.flatnonzero(bad)))
+        self.assertRaises(codec.TMCLError, batch.asFrames, "ABCD")
+
+
+
+
+class EchoSerial(object):
+    """Serial port stand-in answering value = 1000 * type + motor"""
+
+    def __init__(self, statuses=None, timeout=0.05):
+        self.statuses = statuses or {}
+        self.timeout = timeout
+        self.writes = 0
+        self._buffer = ""
+        self._cond = threading.Condition()
+
+    def write(self, data):
+        with self._cond:
+            self.writes += 1
+            for i in xrange(0, len(data), codec.COMMAND_STRING_LENGTH):
+                r = codec.unpackRequestCommand(data[i:i+codec.COMMAND_STRING_LENGTH])
+                status = self.statuses.get(r.type_number, STAT_OK)
+                self._buffer += codec.packReplyCommand(2, r.module_address, status, r.command_number,
+                                                       1000 * r.type_number + r.motor_number)
+            self._cond.notify_all()
+
+    def read(self, size):
+        with self._cond:
+            if len(self._buffer) < size:
+                self._cond.wait(self.timeout)
+            data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+    def close(self):
+        pass
+
+
+
+def simulatedLink(clock=None, **options):
+    """A Simulator on clock (a VirtualClock by default) and a SimulatedSerial with options to it"""
+    sim = simulator.Simulator(clock=clock or simulator.VirtualClock())
+    return sim, simulator.SimulatedSerial(sim, **options)
+
+
+
+class SimulatedModuleTestCase(unittest.TestCase):
+    """
+    Base of the tests against a simulated module: self.clock (virtual),
+    self.sim, self.link made with link_options and self.dev, a
+    device_class made with device_options (none if device_class is None)
+    """
+
+    link_options = {}
+    device_class = device.Device
+    device_options = {}
+
+    def setUp(self):
+        self.clock = simulator.VirtualClock()
+        self.sim, self.link = simulatedLink(self.clock, **self.link_options)
+        self.dev = None
+        if self.device_class is not None:
+            self.dev = self.device_class(port=self.link, **self.device_options)
+
+
+
+class PipelineTestCase(unittest.TestCase):
+
+
+    def setUp(self):
+        self.dev = device.Device(port=EchoSerial(statuses={5: 4}))
+
+
+    def test_pipeline(self):
+        with self.dev.pipeline() as p:
+            futures = [p.gap(mn, pn) for mn in xrange(3) for pn in (1, 3, 140)]
+            wrote = p.sap(0, 4, 100)
+            self.assertFalse(futures[0].done())
+
+        self.assertEqual(1, self.dev._ser.writes)
+        self.assertEqual([1000 * pn + mn for mn in xrange(3) for pn in (1, 3, 140)],
+                         [f.result() for f in futures])
+        self.assertIsNone(wrote.result())
+
+
+    def test_pipelineStatusError(self):
+        with self.dev.pipeline() as p:
+            ok = p.gap(0, 1)
+            bad = p.gap(0, 5)
+
+        self.assertEqual(1000, ok.result())
+        self.assertRaises(codec.TMCLStatusError, bad.result)
+
+
+    def test_pipelineMaxPending(self):
+        with self.dev.pipeline(max_pending=2) as p:
+            futures = [p.gap(0, 1) for _ in xrange(5)]
+            self.assertEqual(1, len(p))
+
+        self.assertEqual(3, self.dev._ser.writes)
+        self.assertTrue(all(f.done() for f in futures))
+
+
+    def test_pipelineCancel(self):
+        try:
+            with self.dev.pipeline() as p:
+                f = p.gap(0, 1)
+                raise KeyboardInterrupt
+        except KeyboardInterrupt:
+            pass
+
+        self.assertEqual(0, self.dev._ser.writes)
+        self.assertRaises(codec.TMCLError, f.result)
+        self.assertEqual(1000 + 2, self.dev.gap(2, 1))
+
+
+
+
+class AsyncDeviceTestCase(unittest.TestCase):
+
+
+    def setUp(self):
+        self.dev = asyncdevice.AsyncDevice(port=EchoSerial(statuses={5: 4}))
+
+    def tearDown(self):
+        self.dev.close()
+
+
+    def test_commands(self):
+        futures = [self.dev.gap(mn, 1) for mn in xrange(3)]
+        futures.append(self.dev.ggp(0, 66))
+        futures.append(self.dev.sap(0, 4, 100))
+
+        self.assertEqual([1000, 1001, 1002, 66000, None],
+                         asyncdevice.gather(futures, timeout=1.0))
+        self.assertRaises(codec.TMCLStatusError, self.dev.gap(0, 5).result, 1.0)
+
+
+    def test_writeError(self):
+        def fail(data):
+            raise IOError("port gone")
+        self.dev._ser.write = fail
+        self.assertRaises(IOError, self.dev.gap, 0, 1)
+        del self.dev._ser.write
+        self.assertEqual(0, len(self.dev._waiting))
+        self.assertEqual(1001, self.dev.gap(1, 1).result(1.0))
+
+
+    def test_idle(self):
+        # reads of a SimulatedSerial without timeout return at once
+        sim, port = simulatedLink()
+        sim.axis_parameter[0][4] = 100
+        dev = asyncdevice.AsyncDevice(port=port)
+        try:
+            self.assertEqual(100, dev.gap(0, 4).result(1.0))
+            start = time.clock()
+            threading.Event().wait(0.5)
+            self.assertLess(time.clock() - start, 0.1)
+            self.assertEqual(100, dev.gap(0, 4).result(1.0))
+        finally:
+            dev.close()
+
+
+    def test_close(self):
+        self.dev.close()
+        self.assertRaises(codec.TMCLError, self.dev.gap, 0, 1)
+
+
+
+
+class BusTestCase(unittest.TestCase):
+
+
+    def setUp(self):
+        self.bus = bus.Bus(port=EchoSerial())
+
+    def tearDown(self):
+        self.bus.close()
+
+
+    def test_fairQueue(self):
+        q = bus.FairQueue()
+        for i in xrange(3):
+            q.put('a', i)
+        q.put('b', 0)
+        q.put('c', 0, priority=-1)
+
+        self.assertEqual([('c', 0), ('a', 0), ('b', 0), ('a', 1), ('a', 2)],
+                         [q.pop() for _ in xrange(len(q))])
+        self.assertRaises(IndexError, q.pop)
+
+
+    def test_devices(self):
+        x, y = self.bus.device(1), self.bus.device(3)
+        self.assertEqual(1001, x.gap(1, 1))
+        self.assertEqual(2, y.gap(2, 0))
+        with y.pipeline() as p:
+            futures = [p.gap(mn, 1) for mn in xrange(3)]
+        self.assertEqual([1000, 1001, 1002], [f.result() for f in futures])
+
+        occupancy = self.bus.occupancy()
+        self.assertEqual(1, occupancy[1]['telegrams'])
+        self.assertEqual(4, occupancy[3]['telegrams'])
+
+
+    def test_replyAddress(self):
+        self.bus.host_address = 3
+        self.assertRaises(codec.TMCLError, self.bus.device(1).gap, 0, 1)
+
+
+
+
+class SimulatorTestCase(SimulatedModuleTestCase):
+
+    link_options = {'baudrate': 9600, 'turnaround': 0.001}
+
+
+    def test_parameters(self):
+        self.dev.sap(1, 4, 1500)
+        self.sim.global_parameter[(2, 10)] = -7
+        self.assertEqual(1500, self.dev.gap(1, 4))
+        self.assertEqual(-7, self.dev.ggp(2, 10))
+        self.assertEqual(self.sim.address, self.dev.ggp(0, 66))
+        self.assertRaises(codec.TMCLStatusError, self.dev.sap, 0, 8, 1)
+
+
+    def test_linkTiming(self):
+        for _ in xrange(100):
+            self.dev.gap(0, 1)
+        self.assertAlmostEqual(100 * (0.001 + 2 * 90 / 9600.), self.sim.clock.time())
+
+
+    def test_positionMove(self):
+        self.dev.mvp(0, 'ABS', 5000)
+        self.assertEqual(0, self.dev.gap(0, 8))
+        self.sim.clock.sleep(2)
+        self.assertEqual(1000, self.dev.gap(0, 3))
+        self.sim.clock.sleep(10)
+        self.assertEqual(1, self.dev.gap(0, 8))
+        self.assertEqual(5000, self.dev.gap(0, 1))
+
+        self.dev.mvp(0, 'REL', -1000)
+        self.sim.clock.sleep(10)
+        self.assertEqual(4000, self.dev.gap(0, 1))
+
+
+    def test_limitSwitch(self):
+        self.sim.axis(1).right_limit = 300
+        self.dev.ror(1, 200)
+        self.sim.clock.sleep(5)
+        self.assertEqual(300, self.dev.gap(1, 1))
+        self.assertEqual(0, self.dev.gap(1, 3))
+        self.assertEqual(1, self.dev.gap(1, 10))
+
+
+    def test_referenceSearch(self):
+        self.dev.sap(2, 1, 500)
+        self.dev.rfs(2, 'START')
+        self.assertNotEqual(0, self.dev.rfs(2, 'STATUS'))
+        self.sim.clock.sleep(20)
+        self.assertEqual(0, self.dev.rfs(2, 'STATUS'))
+        self.assertEqual(0, self.dev.gap(2, 1))
+
+
+    def test_faults(self):
+        self.link.inject('checksum')
+        self.assertRaises(codec.TMCLError, self.dev.gap, 0, 4)
+        self.link.inject('silence')
+        self.assertRaises(codec.TMCLError, self.dev.gap, 0, 4)
+        self.assertEqual(1000, self.dev.gap(0, 4))
+
+
+    def test_pty(self):
+        with simulator.PtySimulator(baudrate=115200) as server:
+            dev = device.Device(server.port)
+            dev.sap(0, 140, 6)
+            self.assertEqual(6, dev.gap(0, 140))
+            dev._ser.close()
+
+
+
+
+class CacheTestCase(SimulatedModuleTestCase):
+
+    device_options = {'cache': True}
+
+    def setUp(self):
+        super(CacheTestCase, self).setUp()
+        self.cache = self.dev.cache
+
+
+    def test_static(self):
+        self.assertEqual(4, self.dev.gap(0, 140))
+        self.assertEqual(4, self.dev.gap(0, 140))
+        self.assertEqual(1, self.sim.requests)
+        self.assertEqual({'hits': 1, 'misses': 1, 'passes': 0, 'size': 1}, self.cache.stats())
+
+
+    def test_live(self):
+        self.dev.gap(0, 1)
+        self.dev.gap(0, 1)
+        self.dev.ggp(0, 132)
+        self.assertEqual(3, self.sim.requests)
+        self.assertEqual(3, self.cache.passes)
+
+
+    def test_writeThrough(self):
+        self.dev.sap(1, 4, 1234)
+        self.assertEqual(1234, self.dev.gap(1, 4))
+        self.assertEqual(1, self.sim.requests)
+
+        self.dev.rsap(1, 4)
+        self.assertEqual(1000, self.dev.gap(1, 4))
+        self.assertEqual(3, self.sim.requests)
+
+
+    def test_volatility(self):
+        self.dev.cache = cache.ParameterCache(volatility={140: V_LIVE})
+        self.dev.gap(0, 140)
+        self.dev.gap(0, 140)
+        self.assertEqual(2, self.sim.requests)
+
+
+    def test_pipeline(self):
+        self.dev.gap(2, 4)
+        with self.dev.pipeline() as p:
+            cached, read = p.gap(2, 4), p.gap(2, 5)
+            self.assertTrue(cached.done())
+        self.assertEqual(1000, read.result())
+        self.assertEqual(2, self.sim.requests)
+        self.assertEqual(1000, self.dev.gap(2, 5))
+
+
+    def test_reconnect(self):
+        self.dev.gap(0, 140)
+        self.dev.reconnect()
+        self.dev.gap(0, 140)
+        self.assertEqual(2, self.sim.requests)
+
+
+
+
+class SnapshotTestCase(SimulatedModuleTestCase):
+
+    link_options = {'baudrate': 115200}
+
+
+    def test_take(self):
+        engine = snapshot.SnapshotEngine(self.dev, banks=[0, 3], batch=16)
+        snap = engine.take()
+
+        self.assertEqual(len(engine.keys), len(snap))
+        self.assertEqual(len(engine.keys), self.sim.requests)
+        self.assertEqual({}, snap.errors)
+        self.assertFalse(any(key[:2] == ('global', 2) for key in snap.values))
+        self.assertEqual(4, snap[('axis', 0, 140)])
+        self.assertNotIn(('axis', 1, 140), snap)
+        motors, single = snap.named_axis(range(3))
+        self.assertEqual(1000, motors[2]['max positioning speed'])
+        self.assertEqual(4, single['microstep resolution'])
+
+
+    def test_refresh(self):
+        engine = snapshot.SnapshotEngine(self.dev, global_parameters=[])
+        before = engine.take()
+        self.dev.mvp(1, 'ABS', 3000)
+        self.sim.clock.sleep(10)
+        requests = self.sim.requests
+        after = engine.refresh(before)
+
+        self.assertEqual(len(engine.live_keys), self.sim.requests - requests)
+        self.assertEqual(len(before), len(after))
+        self.assertEqual({('axis', 1, 0): (0, 3000), ('axis', 1, 1): (0, 3000),
+                          ('axis', 1, 8): (0, 1), ('axis', 1, 9): (1, 0)}, after.diff(before))
+
+
+    def test_errors(self):
+        self.link.inject('checksum')
+        snap = snapshot.SnapshotEngine(self.dev, axis_parameters=[1, 4]).take()
+        self.assertEqual([('axis', 0, 1)], snap.errors.keys())
+        self.assertRaises(codec.TMCLError, snap.check)
+
+
+
+
+class MetricsTestCase(SimulatedModuleTestCase):
+
+
+    def test_histogram(self):
+        h = metrics.Histogram()
+        for ms in xrange(1, 101):
+            h.add(ms / 1000.)
+        self.assertEqual(100, h.count)
+        self.assertAlmostEqual(0.0505, h.as_dict()['mean'])
+        self.assertTrue(0.05 <= h.percentile(50) <= 0.1)
+        self.assertEqual(0.1, h.percentile(100))
+
+
+    def test_stats(self):
+        for _ in xrange(5):
+            self.dev.gap(0, 1)
+        self.dev.sap(0, 4, 10)
+        self.link.inject('checksum')
+        self.assertRaises(codec.TMCLError, self.dev.gap, 0, 1)
+        self.link.inject('silence')
+        self.assertRaises(codec.TMCLError, self.dev.gap, 0, 1)
+        self.assertRaises(codec.TMCLStatusError, self.dev.sap, 0, 8, 1)
+
+        stats = self.dev.stats()
+        self.assertEqual(9, stats['telegrams'])
+        self.assertEqual(81, stats['bytes_written'])
+        self.assertEqual(72, stats['bytes_read'])
+        self.assertEqual(1, stats['checksum_errors'])
+        self.assertEqual(1, stats['timeouts'])
+        self.assertEqual({3: 1}, stats['statuses'])
+        self.assertEqual(7, stats['latency']['GAP']['count'])
+        self.assertEqual(2, stats['latency']['SAP']['count'])
+
+        self.dev.reset_stats()
+        self.assertEqual(0, self.dev.stats()['telegrams'])
+
+
+    def test_batchLatency(self):
+        _, port = simulatedLink(simulator.RealClock(), baudrate=9600)
+        dev = device.Device(port=port)
+        with dev.pipeline() as p:
+            [p.gap(0, 1) for _ in xrange(8)]
+        latency = dev.stats()['latency']['GAP']
+        # 8 telegrams of 2 * 9.4 ms on the wire, each counts 1/8 of the batch
+        self.assertEqual(8, latency['count'])
+        self.assertTrue(0.018 < latency['mean'] < 0.05)
+
+
+
+
+class BenchTestCase(unittest.TestCase):
+
+
+    def test_compare(self):
+        import bench
+        baseline = {'results': {'a': {'ops_per_second': 100.0}, 'b': {'ops_per_second': 100.0},
+                                'gone': {'ops_per_second': 1.0}}}
+        results = {'results': {'a': {'ops_per_second': 95.0}, 'b': {'ops_per_second': 80.0}}}
+
+        self.assertEqual([('a', 100.0, 95.0, 0.95, False), ('b', 100.0, 80.0, 0.8, True)],
+                         bench.compare(results, baseline, tolerance=0.1))
+
+
+    def test_run(self):
+        import bench
+        results = bench.run(['codec.pack', 'device.gap'], repeat=1)
+        self.assertEqual(['codec.packRequestCommand', 'device.gap'], sorted(results['results']))
+
+
+
+
+class TracingTestCase(SimulatedModuleTestCase):
+
+    device_class = None
+
+
+    def test_disabled(self):
+        self.assertIsNone(device.Device(port=self.link).tracer)
+        self.assertIsInstance(device.Device(port=self.link, debug=True).tracer, tracing.StderrTracer)
+
+
+    def test_ringBuffer(self):
+        tracer = tracing.RingBufferTracer(size=3)
+        dev = device.Device(port=self.link, tracer=tracer)
+        dev.sap(0, 1, -5)
+        dev.gap(0, 1)
+
+        events = tracer.events()
+        self.assertEqual([tracing.RECV, tracing.SEND, tracing.RECV], [e.direction for e in events])
+        self.assertEqual(codec.encodeRequestCommand(1, 6, 1, 0, 0), events[1].frame)
+        self.assertEqual((1, 6, 1, 0, 0), events[1].fields[:5])
+        self.assertEqual(-5, events[2].fields.value)
+        self.assertEqual(STAT_OK, events[2].fields.status)
+        self.assertTrue(events[1].timestamp <= events[2].timestamp)
+        dev.sio(1, True)
+        fields = tracer.events()[1].fields
+        self.assertEqual((1, 14, 1, 2, 1), fields[:5])
+        self.assertIs(int, type(fields.value))
+
+
+    def test_fileTracer(self):
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            tracer = tracing.FileTracer(path)
+            dev = device.Device(port=self.link, tracer=tracer)
+            self.link.inject('checksum')
+            self.assertRaises(codec.TMCLError, dev.gap, 0, 1)
+            tracer.close()
+            lines = open(path).read().splitlines()
+        finally:
+            os.remove(path)
+        self.assertEqual(2, len(lines))
+        self.assertIn("send to TMCL:", lines[0])
+        self.assertIn("Checksum error", lines[1])
+
+
+
+
+class CommandsTestCase(SimulatedModuleTestCase):
+
+
+    def test_compileRanges(self):
+        self.assertIsInstance(commands.compileRanges(TR_32s), commands.Interval)
+        valid = commands.compileRanges(TR_xCHP1)
+        self.assertIsInstance(valid, commands.AllowedSet)
+        self.assertEqual([0] + range(2, 16), [v for v in xrange(-1, 17) if v in valid])
+        self.assertNotIn(1, valid)
+        self.assertNotIn(16, valid)
+
+
+    def test_multiRange(self):
+        self.dev.sap(0, 167, 5)
+        self.assertEqual(5, self.dev.gap(0, 167))
+        self.assertRaises(codec.TMCLMissingElement, self.dev.sap, 0, 167, 1)
+
+
+    def test_globals(self):
+        self.dev.sgp(2, 10, -7)
+        self.assertEqual(-7, self.dev.ggp(2, 10))
+        self.assertRaises(codec.TMCLKeyError, self.dev.sgp, 1, 10, 0)
+        self.assertRaises(codec.TMCLMissingElement, self.dev.sgp, 0, 66, 256)
+
+
+    def test_errors(self):
+        self.assertRaises(codec.TMCLRangeError, self.dev.ror, 3, 10)
+        self.assertRaises(codec.TMCLRangeError, self.dev.ror, 0, 2048)
+        self.assertRaises(codec.TMCLKeyError, self.dev.mvp, 0, 'FOO', 0)
+        self.assertRaises(codec.TMCLRangeError, self.dev.mvp, 0, 'COORD', 21)
+        self.assertRaises(codec.TMCLError, self.dev.sco, 0xFF, 1, 10)
+        self.assertRaises(codec.TMCLRangeError, self.dev.gio, 3, 1)
+        self.assertEqual(0, self.sim.requests)
+
+
+    def test_coordinates(self):
+        self.dev.sco(1, 3, -1234)
+        self.assertEqual(-1234, self.dev.gco(1, 3))
+        self.dev.sio(1, True)
+        self.assertEqual(1, self.dev.gio(1, 2))
+
+
+    def test_validate(self):
+        requests = self.dev.validate('SAP', [(4, 0, 1000), (140, 2, 8)])
+        self.assertEqual([(1, 5, 4, 0, 1000), (1, 5, 140, 2, 8)], requests)
+        try:
+            self.dev.validate('SAP', [(4, 0, 1000), (4, 5, 1), (140, 0, 9), (9999, 0, 0)])
+        except codec.TMCLBatchError as e:
+            self.assertEqual([1, 2, 3], [i for i, _ in e.errors])
+        else:
+            self.fail("no TMCLBatchError")
+
+
+    def test_dispatchMany(self):
+        self.assertEqual([None, None], self.dev.dispatch_many('SAP', [(4, 0, 1500), (4, 1, 1600)]))
+        self.assertEqual([1500, 1600, 1000], self.dev.dispatch_many('GAP', [(4, mn, 0) for mn in xrange(3)]))
+        self.assertRaises(codec.TMCLBatchError, self.dev.dispatch_many, 'SAP', [(8, 0, 1)])
+
+
+
+class MotionTestCase(SimulatedModuleTestCase):
+
+
+    def test_reached(self):
+        self.dev.mvp(0, 'ABS', 5000)
+        self.dev.mvp(1, 'ABS', -200)
+        start = self.clock.time()
+        positions = self.dev.wait_until_reached([0, 1], clock=self.clock)
+        self.assertEqual({0: 5000, 1: -200}, positions)
+        self.assertEqual(1, self.dev.gap(0, 8))
+        # 1000 pps, 1000 pps^2: 6 s of motion, detected within a few sweeps
+        self.assertAlmostEqual(6.0, self.clock.time() - start, delta=0.2)
+        self.assertLess(self.sim.requests, 250)
+
+
+    def test_timeout(self):
+        self.dev.ror(0, 100)
+        self.assertRaises(codec.TMCLTimeoutError, self.dev.wait_until_reached, 0,
+                          timeout=0.5, clock=self.clock)
+        self.assertAlmostEqual(0.5, self.clock.time(), delta=0.11)
+
+
+    def test_idle(self):
+        self.dev.ror(2, 500)
+        self.dev.mvp(1, 'REL', 300)
+        self.clock.sleep(1.0)
+        self.dev.mst(2)
+        positions = self.dev.wait_until_idle(clock=self.clock)
+        self.assertEqual(300, positions[1])
+        self.assertEqual(0, self.dev.gap(2, 3))
+        self.assertEqual(positions[2], self.dev.gap(2, 1))
+
+
+    def test_motorList(self):
+        self.assertEqual([0, 1, 2], motion.motorList(self.dev, None))
+        self.assertEqual([1], motion.motorList(self.dev, 1))
+        self.assertEqual([2, 0], motion.motorList(self.dev, (2, 0)))
+        self.assertRaises(codec.TMCLBatchError, self.dev.wait_until_reached, 3)
+
+
+
+class MoveQueueTestCase(SimulatedModuleTestCase):
+
+    link_options = {'baudrate': 115200}
+
+
+    def test_run(self):
+        queue = movequeue.MoveQueue(self.dev, motors=[0, 2], slots=[1, 2, 3], clock=self.clock)
+        points = [(100 * i, -50 * i) for i in xrange(1, 8)]
+        self.assertEqual({0: 700, 2: -350}, queue.run(points))
+        # slot of point 5 was refilled behind the trigger of point 2
+        self.assertEqual(500, self.dev.gco(0, 2))
+        report = queue.report()
+        self.assertEqual(7, report['moves'])
+        self.assertEqual(6, report['dead_time']['count'])
+        self.assertLess(report['dead_time']['max'], 0.1)
+        self.assertGreater(report['elapsed'], 0)
+
+
+    def test_single(self):
+        queue = movequeue.MoveQueue(self.dev, motors=1, clock=self.clock, preload=False)
+        self.assertEqual({1: -20}, queue.run([40, -20]))
+        self.assertEqual(0, self.dev.gco(1, 1))
+
+
+    def test_invalid(self):
+        queue = movequeue.MoveQueue(self.dev, motors=[0, 1], clock=self.clock)
+        self.assertRaises(codec.TMCLError, queue.run, [(1, 2), (3,)])
+        self.assertRaises(codec.TMCLBatchError, queue.run, [(1, 2), (2**24, 0)])
+        self.assertEqual(0, self.sim.requests)
+
+
+    def test_refillError(self):
+        queue = movequeue.MoveQueue(self.dev, motors=[0], slots=[1, 2], clock=self.clock)
+        # two slots loaded, then the refill behind the first trigger is rejected
+        self.dev._ser.inject('reject', skip=3)
+        with self.assertRaises(codec.TMCLBatchError) as context:
+            queue.run([(10,), (20,), (30,)])
+        self.assertEqual('SCO', context.exception.command)
+
+
+
+OSCILLATE = """
+// oscillate motor 0 three times
+        SGP 0, 2, 3             // counter in user variable #0
+loop:   MVP ABS, 0, 1000
+        WAIT POS, 0, 0
+        MVP ABS, 0, 0
+        WAIT POS, 0, 0
+        GGP 0, 2
+        CALC SUB, 1
+        AGP 0, 2
+        JC NZ, loop
+        STOP
+"""
+
+
+class AssemblerTestCase(SimulatedModuleTestCase):
+
+    link_options = {'baudrate': 115200}
+
+
+    def test_parse(self):
+        prog = assembler.Program.parse(OSCILLATE)
+        self.assertEqual(10, len(prog))
+        self.assertEqual({'loop': 1}, prog.labels)
+        requests = prog.assemble(address=1, origin=100)
+        self.assertEqual((1, 9, 0, 2, 3), requests[0])
+        self.assertEqual((1, 4, 0, 0, 1000), requests[1])
+        self.assertEqual((1, 27, 1, 0, 0), requests[2])
+        self.assertEqual((1, 19, 1, 0, 1), requests[6])
+        self.assertEqual((1, 21, 1, 0, 101), requests[8])
+        self.assertEqual((1, 28, 0, 0, 0), requests[9])
+        self.assertEqual(90, len(prog.telegrams()))
+
+
+    def test_builder(self):
+        prog = assembler.Program()
+        prog.label('start').ROR(0, 0x200).WAIT('TICKS', 0, 10).MST(0).JA('start')
+        self.assertEqual([(1, 1, 0, 0, 512), (1, 27, 0, 0, 10), (1, 3, 0, 0, 0), (1, 22, 0, 0, 0)],
+                         prog.assemble())
+        self.assertEqual(prog.assemble(), assembler.assemble(
+            "start: ROR 0, $200\n WAIT TICKS, 0, 10\n MST 0\n JA start"))
+
+
+    def test_errors(self):
+        E = codec.TMCLAssemblerError
+        self.assertRaises(E, assembler.assemble, "FOO 1")
+        self.assertRaises(E, assembler.assemble, "MVP ABS, 0")
+        self.assertRaises(E, assembler.assemble, "MVP SIDEWAYS, 0, 1")
+        self.assertRaises(E, assembler.assemble, "SAP 4, 256, 1")
+        self.assertRaises(E, assembler.assemble, "SAP 4, 0, speed")
+        self.assertRaises(E, assembler.assemble, "a: STOP\na: STOP")
+        try:
+            assembler.assemble("STOP\n\n  JA nowhere")
+        except E as e:
+            self.assertEqual(3, e.line)
+        else:
+            self.fail("no TMCLAssemblerError")
+
+
+    def test_download(self):
+        self.assertEqual(10, self.dev.download(OSCILLATE))
+        self.assertEqual((4, 0, 0, 1000), self.sim.program[1])
+        self.assertEqual(('STOP', 0), self.dev.program_status())
+        self.dev.run_program(0)
+        self.assertEqual('RUN', self.dev.program_status()[0])
+        requests = self.sim.requests
+        self.clock.sleep(20.0)
+        self.sim.advance()
+        self.assertEqual(requests, self.sim.requests)
+        self.assertEqual(('STOP', 10), self.dev.program_status())
+        self.assertEqual(0, self.dev.ggp(2, 0))
+        self.assertEqual(0, self.dev.gap(0, 1))
+
+
+    def test_downloadError(self):
+        # stop, DOWNLOAD_START, 4 instructions of which the first is
+        # rejected, then DOWNLOAD_END gets no reply either
+        self.dev._ser.inject('reject', skip=2)
+        self.dev._ser.inject('silence', skip=3)
+        with self.assertRaises(codec.TMCLStatusError) as context:
+            self.dev.download("CALC LOAD, 7\nCALC MUL, 6\nAAP 4, 1\nSTOP")
+        self.assertEqual('CALC', context.exception.command)
+        self.assertEqual(('STOP', 0), self.dev.program_status())
+
+
+    def test_asyncDownload(self):
+        dev = asyncdevice.AsyncDevice(port=simulator.SimulatedSerial(self.sim, timeout=0.05))
+        try:
+            dev._ser.inject('reject', skip=1)
+            with self.assertRaises(codec.TMCLStatusError) as context:
+                dev.download("CALC LOAD, 7\nSTOP")
+            self.assertEqual('DOWNLOAD_START', context.exception.command)
+            self.assertEqual({}, self.sim.program)
+            self.assertEqual(2, dev.download("CALC LOAD, 7\nSTOP"))
+            self.assertEqual(2, len(self.sim.program))
+        finally:
+            dev.close()
+
+
+    def test_step(self):
+        self.dev.download("CALC LOAD, 7\nCALC MUL, 6\nAAP 4, 1\nSTOP")
+        self.dev.reset_program()
+        for _ in xrange(3):
+            self.dev.step_program()
+        self.assertEqual(('STEP', 3), self.dev.program_status())
+        self.assertEqual(42, self.dev.gap(1, 4))
+        self.dev.step_program()
+        self.assertEqual('STOP', self.dev.program_status()[0])
+
+
+
+class CaptureTestCase(unittest.TestCase):
+
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix='.tmclcap')
+        os.close(fd)
+        os.remove(self.path)
+
+
+    def tearDown(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+    def _record(self):
+        _, port = simulatedLink()
+        writer = capture.CaptureWriter(self.path, buffer_records=4)
+        dev = device.Device(port=port, tracer=writer)
+        dev.sap(0, 4, 1234)
+        with dev.pipeline() as p:
+            values = [p.gap(mn, 4) for mn in xrange(3)]
+        dev._ser.inject('drop')
+        self.assertRaises(codec.TMCLError, dev.gap, 1, 1)
+        writer.close()
+        return [f.result() for f in values]
+
+
+    def test_file(self):
+        self._record()
+        cap = capture.CaptureFile(self.path)
+        self.assertEqual(10, len(cap))
+        directions = [r.direction for r in cap]
+        self.assertEqual(['send', 'recv', 'send', 'send', 'send', 'recv', 'recv', 'recv', 'send', 'recv'],
+                         directions)
+        self.assertEqual(codec.encodeRequestCommand(1, 5, 4, 0, 1234), cap[0].frame)
+        self.assertEqual(8, len(cap[-1].frame))
+        self.assertTrue(all(a.timestamp <= b.timestamp for a, b in zip(list(cap), list(cap)[1:])))
+        # appending keeps one header
+        capture.CaptureWriter(self.path).close()
+        self.assertEqual(10, len(capture.CaptureFile(self.path)))
+
+
+    @unittest.skipIf(batch is None, "numpy not available")
+    def test_array(self):
+        self._record()
+        cap = capture.CaptureFile(self.path)
+        arr = cap.array()
+        self.assertEqual(10, len(arr))
+        self.assertEqual([9] * 9 + [8], list(arr['length']))
+        replies = batch.decodeReplyFrames(cap.frames('recv'))[0]
+        self.assertEqual([100, 1234, 1000, 1000], [replies['status'][0]] + list(replies['value'][1:]))
+
+
+    def test_replay(self):
+        values = self._record()
+        dev = device.Device(port=capture.ReplaySerial(self.path, speed=None))
+        self.assertEqual(None, dev.sap(0, 4, 1234))
+        with dev.pipeline() as p:
+            replayed = [p.gap(mn, 4) for mn in xrange(3)]
+        self.assertEqual(values, [f.result() for f in replayed])
+        self.assertRaises(codec.TMCLError, dev.gap, 1, 1)
+        self.assertEqual(0, dev._ser.remaining)
+
+
+    def test_strict(self):
+        self._record()
+        dev = device.Device(port=capture.ReplaySerial(self.path, speed=None))
+        self.assertRaises(codec.TMCLError, dev.sap, 0, 4, 1235)
+        dev = device.Device(port=capture.ReplaySerial(self.path, speed=None, strict=False))
+        self.assertEqual(None, dev.sap(0, 4, 1235))
+
+
+    def test_speed(self):
+        writer = capture.CaptureWriter(self.path)
+        frame = codec.encodeRequestCommand(1, 6, 1, 0, 0)
+        writer(tracing.TraceEvent(tracing.SEND, 10.0, frame, None))
+        writer(tracing.TraceEvent(tracing.RECV, 10.2, codec.encodeReplyCommand(2, 1, 100, 6, 7), None))
+        writer.close()
+        dev = device.Device(port=capture.ReplaySerial(self.path, speed=4.0))
+        start = tracing.monotonic()
+        self.assertEqual(7, dev.gap(0, 1))
+        self.assertAlmostEqual(0.05, tracing.monotonic() - start, delta=0.03)
+
+
+    def test_invalid(self):
+        with open(self.path, 'wb') as f:
+            f.write("not a capture")
+        self.assertRaises(codec.TMCLError, capture.CaptureFile, self.path)
+
+
+
+class SharedDeviceTestCase(SimulatedModuleTestCase):
+
+    link_options = {'baudrate': 115200}
+    device_class = shared.SharedDevice
+
+    def tearDown(self):
+        self.dev.close()
+
+
+    def _block(self):
+        """Occupy the I/O thread until the returned event is set"""
+        started, release = threading.Event(), threading.Event()
+        self.dev.call(lambda: started.set() or release.wait())
+        started.wait()
+        return release
+
+
+    def test_threads(self):
+        for mn in xrange(3):
+            self.dev.sap(mn, 4, 100 + mn)
+        errors = []
+
+        def worker():
+            try:
+                for i in xrange(30):
+                    mn = i % 3
+                    assert self.dev.gap(mn, 4) == 100 + mn
+                    with self.dev.pipeline() as p:
+                        values = [p.gap(m, 4) for m in xrange(3)]
+                    assert [f.result() for f in values] == [100, 101, 102]
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=worker) for _ in xrange(6)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual([], errors)
+        stats = self.dev.stats()
+        self.assertEqual(3 + 6 * 60, stats['queue']['served'])
+        self.assertEqual(0, stats['queue']['depth'])
+        self.assertEqual(3 + 6 * 120, stats['telegrams'])
+
+
+    def test_priority(self):
+        order = []
+        release = self._block()
+        futures = [self.dev.call(lambda: order.append('low'), priority=1),
+                   self.dev.call(lambda: order.append('default'))]
+        with self.dev.options(priority=-1):
+            futures.append(self.dev.call(lambda: order.append('high')))
+        self.assertEqual(3, self.dev.queue_stats()['depth'])
+        release.set()
+        for f in futures:
+            f.result(1.0)
+        self.assertEqual(['high', 'default', 'low'], order)
+        self.assertEqual(3, self.dev.queue_stats()['max_depth'])
+
+
+    def test_fair(self):
+        self.dev.fair = True
+        order = []
+        release = self._block()
+        futures = [self.dev.call(lambda i=i: order.append(('a', i))) for i in xrange(3)]
+        other = threading.Thread(target=lambda: futures.append(self.dev.call(lambda: order.append(('b', 0)))))
+        other.start()
+        other.join()
+        release.set()
+        for f in futures:
+            f.result(1.0)
+        self.assertEqual([('a', 0), ('b', 0), ('a', 1), ('a', 2)], order)
+
+
+    def test_timeout(self):
+        release = self._block()
+        future = self.dev.submit([(1, 6, 4, 0, 0)], timeout=0.01)
+        threading.Event().wait(0.03)
+        release.set()
+        self.assertRaises(codec.TMCLTimeoutError, future.result, 1.0)
+        stats = self.dev.queue_stats()
+        self.assertEqual(1, stats['expired'])
+        self.assertGreaterEqual(stats['wait']['max'], 0.01)
+        self.assertEqual(0, self.sim.requests)
+
+
+    def test_queueTimeout(self):
+        dev = shared.SharedDevice(port=simulator.SimulatedSerial(self.sim), timeout=0.05, queue_timeout=0.01)
+        try:
+            self.assertEqual(0.05, dev.link_settings()['timeout'])
+            self.assertEqual(0.01, dev.queue_timeout)
+        finally:
+            dev.close()
+
+
+    def test_futures(self):
+        view = self.dev.futures()
+        future = view.sap(1, 4, 321)
+        self.assertEqual(None, future.result(1.0))
+        self.assertEqual(321, view.gap(1, 4).result(1.0))
+        self.assertRaises(codec.TMCLStatusError, view.sap(0, 8, 0).result, 1.0)  # read only
+        self.assertRaises(codec.TMCLError, self.dev.futures().gap, 5, 4)
+
+
+    def test_closed(self):
+        self.dev.close()
+        self.assertRaises(codec.TMCLError, self.dev.gap, 0, 4)
+        self.dev = shared.SharedDevice(port=simulator.SimulatedSerial(self.sim))
+
+
+
+class FleetTestCase(unittest.TestCase):
+
+
+    def setUp(self):
+        self.sims = {}
+
+
+    def _open(self, port, **kwargs):
+        if port == 'broken':
+            raise codec.TMCLError("open", "no such port")
+        sim = self.sims[port] = simulator.Simulator()
+        sim.axis_parameter[0][4] = 100 * int(port[-1])
+        return device.Device(port=simulator.SimulatedSerial(sim, baudrate=10**6, turnaround=0.05),
+                             **kwargs)
+
+
+    def test_parallel(self):
+        ports = ['sim0', 'sim1', 'sim2', 'sim3']
+        progress = []
+        with fleet.Fleet(ports, factory=self._open, num_motors=2,
+                         progress=lambda r, done, total: progress.append((r.port, done, total))) as f:
+            f.run(lambda dev: None)  # open all devices
+            report = f.run(lambda dev: [dev.gap(0, 4), dev.num_motors])
+        self.assertEqual(ports, [r.port for r in report])
+        self.assertEqual({'sim0': [0, 2], 'sim1': [100, 2], 'sim2': [200, 2], 'sim3': [300, 2]},
+                         dict(report.values()))
+        self.assertEqual([1, 2, 3, 4], [done for _, done, _ in progress[4:]])
+        summary = report.summary()
+        self.assertEqual(4, summary['ok'])
+        # four 50 ms round trips take about one
+        self.assertLess(report.elapsed, 0.15)
+        self.assertGreater(summary['device_seconds'], 0.19)
+
+
+    def test_errors(self):
+        with fleet.Fleet(['sim1', 'broken', 'sim2'], factory=self._open) as f:
+            report = f.run(lambda dev, mn: dev.gap(mn, 4), 0)
+            self.assertEqual(['sim1', 'sim2'], report.ok)
+            self.assertEqual(['broken'], report.failed)
+            self.assertEqual(100, report['sim1'].value)
+            self.assertRaises(codec.TMCLBatchError, report.check)
+            report = f.run(lambda dev: dev.gap(5, 4), ports=['sim2'])
+            self.assertEqual(1, len(report))
+            self.assertIsInstance(report['sim2'].error, codec.TMCLRangeError)
+
+
+    def test_concurrency(self):
+        sleep = lambda dev: threading.Event().wait(0.1)
+        with fleet.Fleet(['a', 'b'], factory=lambda port: port, concurrency={'a': 2}) as f:
+            futures = [f.submit(sleep) for _ in xrange(2)]
+            start = tracing.monotonic()
+            for port in ('a', 'b'):
+                for fs in futures:
+                    fs[port].result(1.0)
+                elapsed = tracing.monotonic() - start
+                self.assertAlmostEqual(0.1 if port == 'a' else 0.2, elapsed, delta=0.05)
+
+
+
+class ConfigTestCase(SimulatedModuleTestCase):
+
+    link_options = {'baudrate': 115200}
+
+
+    def test_apply(self):
+        desired = config.axisConfig([0, 1], {4: 1000, 5: 500})
+        desired[('global', 'auto start mode')] = 1
+        report = self.dev.apply_config(desired, store=True)
+        self.assertEqual({('axis', 0, 5): (1000, 500), ('axis', 1, 5): (1000, 500),
+                          ('global', 0, 77): (0, 1)}, report.changes)
+        self.assertEqual([('axis', 0, 4), ('axis', 1, 4)], report.unchanged)
+        self.assertEqual(sorted(report.changes), sorted(report.stored))
+        self.assertEqual(500, self.sim.axis_eeprom[1][5])
+        self.assertEqual(1, self.sim.global_eeprom[(0, 77)])
+        requests = self.sim.requests
+        report = self.dev.apply_config(desired, store=True)
+        self.assertEqual(0, len(report))
+        self.assertEqual([], report.stored)
+        self.assertEqual(requests + 5, self.sim.requests)
+
+
+    def test_dryRun(self):
+        report = self.dev.apply_config({('axis', 2, 'abs max current'): 100}, store=True, dry_run=True)
+        self.assertEqual({('axis', 2, 6): (128, 100)}, report.changes)
+        self.assertEqual(128, self.dev.gap(2, 6))
+        self.assertIn("abs max current: 128 -> 100", str(report))
+        self.assertIn("(dry run)", str(report))
+
+
+    def test_errors(self):
+        self.assertRaises(codec.TMCLBatchError, self.dev.apply_config, {('axis', 0, 4): 2**12})
+        self.assertRaises(codec.TMCLKeyError, self.dev.apply_config, {('axis', 0, 'warp'): 1})
+        self.assertRaises(codec.TMCLError, self.dev.apply_config, {('motor', 0, 4): 1})
+        self.assertEqual(0, self.sim.requests)
+        self.sim.global_parameter[(0, 73)] = 1  # EEPROM locked
+        report = self.dev.apply_config({('axis', 0, 4): 10}, store=True)
+        self.assertEqual([('axis', 0, 4)], report.changes.keys())
+        self.assertEqual([], report.stored)
+        self.assertRaises(codec.TMCLStatusError, report.check)
+
+
+
+
+class DaemonTestCase(SimulatedModuleTestCase):
+
+    link_options = {'baudrate': 115200}
+    device_class = shared.SharedDevice
+
+    def setUp(self):
+        super(DaemonTestCase, self).setUp()
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "tmcl.sock")
+        self.daemon = daemon.Daemon(self.dev, self.path).start()
+
+
+    def tearDown(self):
+        if self.daemon is not None:
+            self.daemon.close()
+        shutil.rmtree(self.dir)
+
+
+    def _cli(self, *argv):
+        stdout, stderr = sys.stdout, sys.stderr
+        sys.stdout, sys.stderr = StringIO.StringIO(), StringIO.StringIO()
+        try:
+            status = tmcl.main(['--socket', self.path] + list(argv))
+            return status, sys.stdout.getvalue(), sys.stderr.getvalue()
+        finally:
+            sys.stdout, sys.stderr = stdout, stderr
+
+
+    def test_client(self):
+        with tmcl.Client(self.path) as client:
+            client.sap(0, 4, 1234)
+            self.assertEqual(1234, client.gap(0, 4))
+            self.assertEqual(1234, self.sim.axis_parameter[0][4])
+            client.mvp(1, 'REL', -50)
+            self.assertEqual(-50, self.sim.axes[1].target)
+            self.assertEqual(4, client.ping()['requests'])
+            with self.assertRaises(codec.TMCLRemoteError) as cm:
+                client.sap(0, 4, 2**12)
+            self.assertEqual('TMCLMissingElement', cm.exception.kind)
+            self.assertRaises(codec.TMCLRemoteError, client.warp, 9)
+            self.assertEqual(1234, client.gap(0, 4))
+
+
+    def test_cli(self):
+        self.assertEqual((0, "", ""), self._cli('mvp', '0', 'ABS', '0x100'))
+        self.assertEqual(256, self.sim.axes[0].target)
+        self.assertEqual((0, "1000\n", ""), self._cli('gap', '2', '4'))
+        status, out, err = self._cli('snapshot')
+        self.assertEqual(0, status)
+        self.assertIn("max positioning speed", out)
+        status, out, err = self._cli('sgp', '0', '64', 'x')
+        self.assertEqual(1, status)
+        self.assertIn("sgp", err)
+
+
+    def test_socket(self):
+        self.assertRaises(codec.TMCLError, daemon.Daemon, None, self.path)
+        self.daemon.close()
+        self.daemon = None
+        status, out, err = self._cli('ping')
+        self.assertEqual(2, status)
+        _, stale = simulatedLink()
+        sock = tmcl.socket.socket(tmcl.socket.AF_UNIX, tmcl.socket.SOCK_STREAM)
+        sock.bind(self.path)
+        sock.close()
+        dev = shared.SharedDevice(port=stale)
+        self.daemon = daemon.Daemon(dev, self.path).start()
+        self.assertEqual(0, self._cli('ping')[0])
+
+
+
+
+class GatewayTestCase(SimulatedModuleTestCase):
+
+    link_options = {'baudrate': 10**6}
+    device_class = shared.SharedDevice
+    device_options = {'fair': True}
+
+    def setUp(self):
+        super(GatewayTestCase, self).setUp()
+        self.gateway = None
+
+
+    def tearDown(self):
+        self.gateway.close()
+
+
+    def _start(self, **kwargs):
+        self.gateway = gateway.Gateway(self.dev, port=0, **kwargs).start()
+        return gateway.RemoteDevice(*self.gateway.address, timeout=5.0)
+
+
+    def test_device(self):
+        dev = self._start()
+        dev.sap(0, 4, 1234)
+        self.assertEqual(1234, dev.gap(0, 4))
+        self.assertEqual(1234, self.sim.axis_parameter[0][4])
+        self.assertRaises(codec.TMCLStatusError, dev.sap, 0, 8, 1)
+        with dev.pipeline() as p:
+            values = [p.gap(mn, 4) for mn in xrange(3)] + [p.ggp(0, 64)]
+        self.assertEqual([1234, 1000, 1000, 0xE4], [f.result() for f in values])
+        client, = self.gateway.clients()
+        self.assertEqual(4, client['messages'])
+        self.assertEqual(7, client['telegrams'])
+        self.assertEqual(7, dev.stats()['telegrams'])
+        dev.reconnect()
+        self.assertEqual(1234, dev.gap(0, 4))
+        dev.close()
+
+
+    def test_clients(self):
+        dev = self._start()
+        errors = []
+
+        def worker(mn):
+            try:
+                remote = gateway.RemoteDevice(*self.gateway.address, timeout=5.0)
+                for i in xrange(20):
+                    remote.sap(mn, 4, i)
+                    assert remote.gap(mn, 4) == i
+                remote.close()
+            except Exception as e:
+                errors.append(e)
+        threads = [threading.Thread(target=worker, args=(mn,)) for mn in xrange(3)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual([], errors)
+        self.assertEqual(120, self.dev.queue_stats()['served'])
+        dev.close()
+
+
+    def test_rateLimit(self):
+        dev = self._start(rate=100, burst=10, max_delay=0.0)
+        with dev.pipeline() as p:
+            values = [p.gap(0, 4) for _ in xrange(10)]
+        self.assertRaises(codec.TMCLGatewayError, dev.gap, 0, 4)
+        self.assertEqual(10, self.sim.requests)
+        self.assertEqual(1, self.gateway.clients()[0]['refused']['rate limit exceeded'])
+        limiter = gateway.RateLimiter(100, 10, clock=lambda: 0.0)
+        self.assertEqual(0.0, limiter.reserve(10))
+        self.assertEqual(None, limiter.reserve(5, max_delay=0.01))
+        self.assertAlmostEqual(0.05, limiter.reserve(5, max_delay=0.1))
+        dev.close()
+
+
+    def test_backPressure(self):
+        dev = self._start(max_queue=1, max_batch=4)
+        started, release = threading.Event(), threading.Event()
+        self.dev.call(lambda: started.set() or release.wait())
+        started.wait()
+        self.dev.call(lambda: None)
+        self.assertRaises(codec.TMCLGatewayError, dev.gap, 0, 4)
+        release.set()
+        time.sleep(0.05)
+        self.assertEqual(1000, dev.gap(0, 4))
+        with self.assertRaises(codec.TMCLGatewayError):
+            with dev.pipeline() as p:
+                [p.gap(0, 4) for _ in xrange(5)]
+        refused = self.gateway.clients()[0]['refused']
+        self.assertEqual((1, 1), (refused['gateway busy'], refused['invalid request']))
+        dev.close()
+
+
+    def test_faults(self):
+        dev = self._start()
+        port = self.dev._ser
+        port.inject('noise')
+        self.assertEqual(1000, dev.gap(0, 4))
+        port.inject('silence', skip=1)
+        with dev.pipeline() as p:
+            values = [p.gap(0, 4), p.ggp(0, 64), p.gap(1, 4)]
+        self.assertEqual(1000, values[0].result())
+        self.assertRaises(codec.TMCLChecksumError, values[1].result)
+        self.assertEqual(1000, values[2].result())
+        self.assertEqual([1000, 1000], [dev.gap(mn, 4) for mn in xrange(2)])
+        self.assertEqual(1, self.dev.stats()['resyncs'])
+        dev.close()
+
+
+
+
+class LinkTestCase(SimulatedModuleTestCase):
+
+    link_options = {'rs485': True, 'max_baudrate': 250000, 'min_pause': 0.002}
+    device_class = None
+
+    def setUp(self):
+        super(LinkTestCase, self).setUp()
+        self.sim.global_parameter[(0, 75)] = 20
+
+
+    def test_settings(self):
+        dev = device.Device(port=self.link, baudrate=115200, timeout=0.5)
+        self.assertEqual({'baudrate': 115200, 'timeout': 0.5, 'write_timeout': None, 'pause': 0.0},
+                         dev.link_settings())
+        self.assertEqual("", dev._ser.read(9))
+        self.assertRaises(codec.TMCLLengthError, dev.gap, 0, 4)
+        dev.configure_link(baudrate=9600, pause=0.02)
+        self.assertEqual(1000, dev.gap(0, 4))
+        start = time.time()
+        dev.gap(0, 4)
+        self.assertGreaterEqual(time.time() - start, 0.015)
+        self.assertRaises(codec.TMCLKeyError, dev.configure_link, parity='E')
+
+
+    def test_tune(self):
+        dev = device.Device(port=self.link, baudrate=9600, cache=True)
+        report = dev.tune_link(burst=10)
+        self.assertEqual((250000, 2), (report.baudrate, report.pause))
+        self.assertEqual([9600, 14400, 19200, 28800, 38400, 57600, 76800, 115200, 230400, 250000,
+                          500000, 250000, 250000, 250000, 250000],
+                         [t.baudrate for t in report.trials])
+        failed = [(t.baudrate, t.pause) for t in report.trials if t.error is not None]
+        self.assertEqual([(500000, 20), (250000, 1)], failed)
+        self.assertEqual((9, 2), (self.sim.global_parameter[(0, 65)], self.sim.global_parameter[(0, 75)]))
+        self.assertEqual({'baudrate': 250000, 'timeout': None, 'write_timeout': None, 'pause': 0.0},
+                         dev.link_settings())
+        self.assertEqual(1000, dev.gap(0, 4))
+        self.assertIsNotNone(dev.cache)
+        self.assertFalse(report.stored)
+        self.assertIn("settled on 250000 baud, 2 ms", str(report))
+        report = dev.tune_link(baudrates=[250000, 500000], pauses=[], store=True)
+        self.assertEqual([250000, 500000], [t.baudrate for t in report.trials])
+        self.assertTrue(report.stored)
+        self.assertEqual((9, 2), (self.sim.global_eeprom[(0, 65)], self.sim.global_eeprom[(0, 75)]))
+
+
+    def test_mismatch(self):
+        self.sim.global_parameter[(0, 65)] = 7
+        dev = device.Device(port=self.link, baudrate=9600, timeout=0.1)
+        self.assertRaises(codec.TMCLError, dev.tune_link)
+        self.assertRaises(codec.TMCLKeyError, dev.tune_link, baudrates=[12345])
+        dev.configure_link(baudrate=115200)
+        report = dev.tune_link(pauses=[])
+        self.assertEqual(250000, report.baudrate)
+        self.assertEqual(0.1, dev.link_settings()['timeout'])
+
+
+    def test_async(self):
+        # the reader thread reads all the time, on a virtual clock the simulation would race ahead
+        sim, port = simulatedLink(simulator.RealClock(), **self.link_options)
+        sim.global_parameter[(0, 75)] = 20
+        dev = asyncdevice.AsyncDevice(port=port, baudrate=9600)
+        try:
+            report = dev.tune_link(baudrates=[250000, 500000], pauses=[10], burst=2, timeout=0.1)
+            self.assertEqual([(9600, 20), (250000, 20), (500000, 20), (250000, 10)],
+                             [(t.baudrate, t.pause) for t in report.trials])
+            self.assertIsInstance(report.trials[2].error, codec.TMCLTimeoutError)
+            self.assertEqual((250000, 10), (report.baudrate, report.pause))
+            self.assertEqual(1000, dev.gap(0, 4).result(1.0))
+        finally:
+            dev.close()
+
+
+
+
+class FramingTestCase(SimulatedModuleTestCase):
+
+
+    def setUp(self):
+        super(FramingTestCase, self).setUp()
+        for mn in xrange(3):
+            self.sim.axis_parameter[mn][4] = 100 + mn
+
+
+    def _pipeline(self):
+        with self.dev.pipeline() as p:
+            futures = [p.gap(mn, 4) for mn in xrange(3)] + [p.ggp(0, 66), p.gap(0, 4)]
+        return [f.exception() or f.result() for f in futures]
+
+
+    def test_parser(self):
+        replies = [codec.packReplyCommand(2, 1, STAT_OK, 6, v) for v in (7, -8, 9)]
+        parser = framing.FrameParser()
+        parser.feed("\x00\xff" + replies[0][:5])
+        self.assertIsNone(parser.next())
+        parser.feed(replies[0][5:] + replies[1][1:] + replies[2])
+        rep, frame, skipped = parser.next()
+        self.assertEqual((7, replies[0], 2), (rep.value, frame, skipped))
+        rep, frame, skipped = parser.next()
+        self.assertEqual((9, replies[2], 8), (rep.value, frame, skipped))
+        self.assertIsNone(parser.next())
+        self.assertEqual((2, 2, 10, 0), (parser.frames, parser.resyncs, parser.stray, len(parser)))
+        bad = codec.packReplyCommand(2, 1, 42, 6, 0)
+        parser.feed(bad + replies[1] + "\x01")
+        self.assertEqual(-8, parser.next()[0].value)
+        self.assertEqual(1, parser.drop())
+
+
+    def test_resync(self):
+        for fault in ('noise', 'checksum', 'drop'):
+            self.link.inject(fault)
+            values = self._pipeline()
+            if fault == 'noise':
+                self.assertEqual([100, 101, 102, 1, 100], values)
+            else:
+                self.assertIsInstance(values[0], codec.TMCLError)
+                self.assertEqual([101, 102, 1, 100], values[1:])
+            self.assertEqual([100, 101, 102, 1, 100], self._pipeline())
+        stats = self.dev.stats()
+        self.assertEqual(3, stats['resyncs'])
+        self.assertEqual(1 + 9 + 8, stats['stray_bytes'])
+
+
+    def test_lost(self):
+        self.link.inject('silence')
+        values = self._pipeline()
+        self.assertTrue(all(isinstance(v, codec.TMCLLengthError) for v in values[:3]))
+        self.assertEqual([1, 100], values[3:])
+        self.link.inject('silence')
+        self.assertRaises(codec.TMCLLengthError, self.dev.gap, 0, 4)
+        self.assertEqual(100, self.dev.gap(0, 4))
+        self.assertEqual(4, self.dev.stats()['timeouts'])
+
+
+    def test_async(self):
+        dev = asyncdevice.AsyncDevice(port=simulator.SimulatedSerial(self.sim, timeout=0.05))
+        try:
+            dev._ser.inject('drop')
+            futures = [dev.gap(mn, 4) for mn in xrange(3)]
+            self.assertRaises(codec.TMCLLengthError, futures[0].result, 1.0)
+            self.assertEqual([101, 102], asyncdevice.gather(futures[1:], timeout=1.0))
+            dev._ser.inject('silence')
+            self.assertRaises(codec.TMCLTimeoutError, dev.gap(0, 4).result, 5.0)
+            self.assertEqual(100, dev.gap(0, 4).result(5.0))
+            self.assertEqual(1, dev.stats()['resyncs'])
+        finally:
+            dev.close()
+
+
+    def test_asyncLost(self):
+        dev = asyncdevice.AsyncDevice(port=simulator.SimulatedSerial(self.sim, timeout=0.05))
+        try:
+            dev._ser.inject('silence')
+            futures = [dev.gap(mn, 4) for mn in xrange(3)] + [dev.ggp(0, 66)]
+            for f in futures[:3]:
+                self.assertRaises(codec.TMCLLengthError, f.result, 5.0)
+            self.assertEqual(1, futures[3].result(5.0))
+            self.assertEqual([100, 101, 102],
+                             asyncdevice.gather([dev.gap(mn, 4) for mn in xrange(3)], timeout=5.0))
+        finally:
+            dev.close()
+
+
+
+
+class RetryTestCase(SimulatedModuleTestCase):
+
+
+    def setUp(self):
+        super(RetryTestCase, self).setUp()
+        self.policy = self.dev.retry = retry.RetryPolicy(attempts=3, backoff=0.01, clock=self.clock)
+        for mn in xrange(3):
+            self.sim.axis_parameter[mn][4] = 100 + mn
+
+
+    def test_idempotent(self):
+        self.assertTrue(retry.isIdempotent((1, 6, 4, 0, 0)))             # GAP
+        self.assertTrue(retry.isIdempotent((1, 5, 4, 0, 100)))           # SAP
+        self.assertTrue(retry.isIdempotent((1, 4, CMD_MVP_TYPES['ABS'], 0, 100)))
+        self.assertFalse(retry.isIdempotent((1, 4, CMD_MVP_TYPES['REL'], 0, 100)))
+        self.assertFalse(retry.isIdempotent((1, 13, CMD_RFS_TYPES['START'], 0, 0)))
+        self.assertTrue(retry.isIdempotent((1, 13, CMD_RFS_TYPES['STATUS'], 0, 0)))
+        self.assertFalse(retry.isIdempotent((1, 32, 0, 0, 0)))           # CCO
+        self.assertEqual([0.01, 0.02, 0.04, 1.0], [self.policy.delay(n) for n in (1, 2, 3, 10)])
+
+
+    def test_retry(self):
+        self.link.inject('checksum')
+        self.assertEqual(100, self.dev.gap(0, 4))
+        with self.dev.pipeline() as p:
+            futures = [p.gap(mn, 4) for mn in xrange(3)]
+            self.link.inject('checksum', skip=1)
+        self.assertEqual([100, 101, 102], [f.result() for f in futures])
+        self.link.inject('silence', count=3)
+        self.assertRaises(codec.TMCLError, self.dev.gap, 0, 4)
+        stats = self.dev.stats()
+        self.assertEqual(5, stats['retries'])
+        self.assertEqual({'GAP': 5}, stats['retries_by_command'])
+        self.assertEqual((2, 1), (stats['recovered'], stats['unrecovered']))
+
+
+    def test_order(self):
+        with self.dev.pipeline() as p:
+            first, second = p.sap(0, 4, 100), p.sap(0, 4, 200)
+            self.link.inject('reject')
+        self.assertEqual((None, None), (first.result(), second.result()))
+        self.assertEqual(200, self.sim.axis_parameter[0][4])
+        with self.dev.pipeline() as p:
+            p.sap(0, 6, 77)
+            p.stap(0, 6)
+            self.link.inject('reject')
+        self.assertEqual((77, 77), (self.sim.axis_parameter[0][6], self.sim.axis_eeprom[0][6]))
+        # MVP REL after the failed SAP ran already, it can not be resent
+        with self.dev.pipeline() as p:
+            sap, mvp = p.sap(0, 4, 300), p.mvp(0, 'REL', 100)
+            self.link.inject('reject')
+        self.assertRaises(codec.TMCLStatusError, sap.result)
+        self.assertIsNone(mvp.result())
+        self.assertEqual((200, 100), (self.sim.axis_parameter[0][4], self.sim.axis(0).target))
+        self.assertEqual(4, self.dev.stats()['retries'])
+
+
+    def test_not_idempotent(self):
+        self.link.inject('reject')
+        self.dev.mvp(0, 'REL', 100)
+        self.assertEqual(100, self.sim.axis(0).target)
+        self.link.inject('silence')
+        self.assertRaises(codec.TMCLError, self.dev.mvp, 0, 'REL', 100)
+        self.assertEqual(200, self.sim.axis(0).target)
+        stats = self.dev.stats()
+        self.assertEqual({'MVP': 1}, stats['retries_by_command'])
+        self.assertEqual((1, 1), (stats['recovered'], stats['unrecovered']))
+
+
+    def test_verify(self):
+        self.policy.verify = True
+        self.link.inject('silence', skip=1)
+        self.dev.mvp(0, 'REL', 100)
+        self.assertEqual(100, self.sim.axis(0).target)
+        self.link.inject('silence')
+        self.dev.rfs(1, 'START')
+        self.assertEqual('reference', self.sim.axis(1).mode)
+        stats = self.dev.stats()
+        self.assertEqual((0, 2, 2), (stats['retries'], stats['verified'], stats['recovered']))
+
+
+
+
+@unittest.skipIf(telemetry is None, "numpy not available")
+class TelemetryTestCase(SimulatedModuleTestCase):
+
+
+    def test_ringBuffer(self):
+        buf = telemetry.RingBuffer(4, 2)
+        for i in xrange(6):
+            buf.append(float(i), [i, -i])
+        self.assertEqual(4, len(buf))
+        self.assertEqual(2, buf.overwritten)
+        times, values = buf.latest()
+        self.assertEqual([2.0, 3.0, 4.0, 5.0], list(times))
+        self.assertEqual([5, -5], list(values[-1]))
+        times, values = buf.latest(2)
+        self.assertEqual([4.0, 5.0], list(times))
+        times[0] = -1
+        self.assertEqual(4.0, buf.latest(2)[0][0])
+
+
+    def test_stream(self):
+        self.dev.sap(0, 1, 123)
+        self.dev.sap(2, 1, -9)
+        sampler = self.dev.stream([1, 3], capacity=8)
+        self.assertEqual(6, len(sampler.columns))
+        for i, (timestamp, row) in enumerate(sampler):
+            if i == 9:
+                sampler.stop()
+        self.assertEqual(10, sampler.samples)
+        self.assertEqual(8, len(sampler.buffer))
+        times, values = sampler.buffer.latest()
+        self.assertEqual(123, values[-1][sampler.column(1, 0)])
+        self.assertEqual(-9, values[-1][sampler.column(1, 2)])
+        self.assertTrue(all(times[1:] >= times[:-1]))
+        stats = sampler.stats()
+        self.assertEqual(10, stats['samples'])
+        self.assertEqual(2, stats['overwritten'])
+        self.assertEqual(0, stats['dropped'])
+
+
+    def test_background(self):
+        sampler = self.dev.stream(motors=[0], rate=200, background=True)
+        try:
+            while sampler.samples < 5:
+                threading.Event().wait(0.01)
+        finally:
+            sampler.stop()
+        stats = sampler.stats()
+        self.assertEqual(200, stats['requested_rate'])
+        self.assertTrue(0 < stats['achieved_rate'] <= 250)
+        self.assertRaises(codec.TMCLBatchError, self.dev.stream, [9999])
+
+
+    def test_dropped(self):
+        sampler = self.dev.stream([1], motors=[0])
+        self.dev._ser.inject('silence')
+        for i, _ in enumerate(sampler):
+            if i == 2:
+                sampler.stop()
+        self.assertEqual(1, sampler.errors)
+        self.assertEqual(1, sampler.dropped)
+        self.assertEqual(3, sampler.samples)
+
+
+
 
 
 
@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+
+"""
+Command-line client of the TMCL daemon
+
+    python daemon.py /dev/ttyACM0 &        # once, keeps the port open
+    tmcl gap 0 1
+    tmcl mvp 0 ABS 1000
+    tmcl snapshot
+    tmcl stats
+
+(with tmcl an alias of "python /path/to/tmcl.py"). Every invocation
+sends one request over the UNIX socket of the daemon and prints the
+reply. Only the standard library and error are imported, neither
+serial nor the parameter tables, so a command takes milliseconds.
+The socket is --socket, $TMCL_SOCKET or /tmp/tmcl-<uid>.sock. The
+exit status is 1 for a failed command, 2 if no daemon is running.
+"""
+
+import argparse
+import json
+import os
+import socket
+import sys
+
+from error import TMCLError, TMCLRemoteError
+
+
+SOCKET_ENVIRONMENT = 'TMCL_SOCKET'
+
+
+
+def defaultSocket():
+    """Socket path of the daemon of this user"""
+    return os.environ.get(SOCKET_ENVIRONMENT) or "/tmp/tmcl-{}.sock".format(os.getuid())
+
+
+def parseArgument(token):
+    """Decimal or 0x.. hex integer, or the token itself (e.g. ABS)"""
+    try:
+        if token.lower().lstrip('+-').startswith('0x'):
+            return int(token, 16)
+        return int(token, 10)
+    except ValueError:
+        return token
+
+
+
+class Client(object):
+    """
+    Connection to the TMCL daemon, requests are answered in order
+
+        with Client() as tmcl:
+            tmcl.sap(0, 4, 1000)
+            print tmcl.gap(0, 4)
+
+    Device methods are called by name, errors raised in the daemon are
+    raised as TMCLRemoteError with the name of the original exception
+    as kind.
+    """
+
+    def __init__(self, path=None, timeout=None):
+        self.path = path or defaultSocket()
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.settimeout(timeout)
+        try:
+            self._sock.connect(self.path)
+        except socket.error:
+            self._sock.close()
+            raise
+        self._file = self._sock.makefile('rb')
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return lambda *args, **kwargs: self.call(name, *args, **kwargs)
+
+    def call(self, method, *args, **kwargs):
+        """Run method(*args, **kwargs) in the daemon, return its result"""
+        request = {'method': method, 'args': args, 'kwargs': kwargs}
+        self._sock.sendall(json.dumps(request) + "\n")
+        line = self._file.readline()
+        if not line:
+            raise TMCLError(method, "daemon closed the connection")
+        reply = json.loads(line)
+        if 'error' in reply:
+            raise TMCLRemoteError(method, reply['error'], reply['message'])
+        return reply['result']
+
+    def close(self):
+        self._file.close()
+        self._sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+
+def formatResult(method, result):
+    """Lines to print for the result of method"""
+    if result is None:
+        return []
+    if method == 'snapshot':
+        lines = ["{:<6} {:>3} {:>3} {:<32} {}".format(*row) for row in result['values']]
+        lines += ["{:<6} {:>3} {:>3} {:<32} error: {}".format(*row) for row in result['errors']]
+        return lines
+    if isinstance(result, (dict, list)):
+        return [json.dumps(result, indent=2, sort_keys=True)]
+    return [str(result)]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Send a command to the TMCL daemon")
+    parser.add_argument('--socket', help="daemon socket (default: $TMCL_SOCKET or /tmp/tmcl-<uid>.sock)")
+    parser.add_argument('--timeout', type=float, default=None, help="seconds to wait for the reply")
+    parser.add_argument('--json', action='store_true', help="print the raw JSON result")
+    parser.add_argument('method', help="device method, e.g. gap, mvp, snapshot, stats, ping")
+    parser.add_argument('args', nargs='*', help="arguments, integers or names like ABS")
+    args = parser.parse_args(argv)
+
+    try:
+        client = Client(args.socket, timeout=args.timeout)
+    except socket.error as e:
+        sys.stderr.write("tmcl: no daemon on {}: {}\n".format(args.socket or defaultSocket(), e))
+        return 2
+    try:
+        result = client.call(args.method, *[parseArgument(a) for a in args.args])
+    except TMCLError as e:
+        sys.stderr.write("tmcl: {}\n".format(e))
+        return 1
+    except socket.error as e:
+        sys.stderr.write("tmcl: {}\n".format(e))
+        return 2
+    finally:
+        client.close()
+    lines = [json.dumps(result, sort_keys=True)] if args.json else formatResult(args.method, result)
+    for line in lines:
+        print line
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
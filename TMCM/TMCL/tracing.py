@@ -0,0 +1,96 @@
+
+import ctypes
+import ctypes.util
+import sys
+import threading
+import time
+from collections import deque, namedtuple
+
+import codec
+
+
+TraceEvent = namedtuple('TraceEvent', ['direction', 'timestamp', 'frame', 'fields'])
+SEND = 'send'
+RECV = 'recv'
+
+
+
+def _monotonic_clock():
+    """Best monotonic clock available: CLOCK_MONOTONIC via libc, else time.time"""
+    if hasattr(time, 'monotonic'):
+        return time.monotonic
+    try:
+        librt = ctypes.CDLL(ctypes.util.find_library('rt') or 'librt.so.1', use_errno=True)
+        clock_gettime = librt.clock_gettime
+    except (OSError, AttributeError):
+        return time.time
+
+    class timespec(ctypes.Structure):
+        _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+    CLOCK_MONOTONIC = 1
+    clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+
+    def monotonic():
+        ts = timespec()  # one per call, the clock is read from many threads
+        if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(ts)) != 0:
+            return time.time()
+        return ts.tv_sec + ts.tv_nsec * 1e-9
+    return monotonic
+
+monotonic = _monotonic_clock()
+
+
+
+def formatEvent(event):
+    """One human-readable line for a TraceEvent"""
+    prefix = "send to TMCL: " if event.direction == SEND else "got from TMCL:"
+    return "{:.6f} {} {} {}".format(event.timestamp, prefix, codec.hexString(event.frame), event.fields)
+
+
+
+class StderrTracer(object):
+    """Print every telegram to a stream, stderr by default"""
+
+    def __init__(self, stream=None):
+        self.stream = stream
+
+    def __call__(self, event):
+        stream = self.stream or sys.stderr
+        stream.write(formatEvent(event) + "\n")
+
+
+class RingBufferTracer(object):
+    """Keep the last size telegrams in memory"""
+
+    def __init__(self, size=1024):
+        self.buffer = deque(maxlen=size)
+
+    def __call__(self, event):
+        self.buffer.append(event)
+
+    def events(self):
+        return list(self.buffer)
+
+    def clear(self):
+        self.buffer.clear()
+
+
+class FileTracer(object):
+    """Append every telegram as a text line to a file"""
+
+    def __init__(self, path, flush=False):
+        self.path = path
+        self.flush = flush
+        self._file = open(path, 'a')
+        self._lock = threading.Lock()
+
+    def __call__(self, event):
+        with self._lock:
+            self._file.write(formatEvent(event) + "\n")
+            if self.flush:
+                self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
@@ -6,55 +6,118 @@ class StepRocker(object):
         self.TMCL = TMCL.Device(*args, **kwargs)
         self.motors = range(self.TMCL.num_motors)
 
-    def get_globals(self):
-        ret = {}
-        for key, value in TMCL.GLOBAL_PARAMETER.iteritems():
-#            print "GGP:", key + value
-            bank, par, name, _, _ = key + value
-            ret[name] = self.TMCL.ggp(bank, par)
-        return ret
+    def get_globals(self, banks=None):
+        snapshot = TMCL.SnapshotEngine(self.TMCL, axis_parameters=[], banks=banks).take()
+        snapshot.check()
+        return snapshot.named_globals()
 
     def get_parameters(self):
-        retmotor = [{} for _ in self.motors]
-        retsingle = {}
-        for mn in self.motors:
-            for key, value in TMCL.AXIS_PARAMETER.iteritems():
-#                print "GAP:", mn, (key,) + value
-                par, name, _, _ = (key,) + value
-                if par not in TMCL.SINGLE_AXIS_PARAMETERS:
-                    retmotor[mn][name] = self.TMCL.gap(mn, par)
-                elif mn == 0:
-                    retsingle[name] = self.TMCL.gap(mn, par)
-        return retmotor, retsingle
+        snapshot = TMCL.SnapshotEngine(self.TMCL, motors=self.motors, global_parameters=[]).take()
+        snapshot.check()
+        return snapshot.named_axis(self.motors)
+
+    def snapshot(self, **kwargs):
+        """Pipelined TMCL.Snapshot of all axis and global parameters"""
+        return TMCL.SnapshotEngine(self.TMCL, motors=self.motors, **kwargs).take()
 
     def set_important_parameters(self,
                                  max_speed=2000, max_accel=2000,
                                  max_current=72, standbycurrent=32,
-                                 microstep_resolution=1, store=False):
-        for mn in self.motors:
-            self.TMCL.sap(mn, 4, max_speed)
-            self.TMCL.sap(mn, 5, max_accel)
-            self.TMCL.sap(mn, 6, max_current)
-            self.TMCL.sap(mn, 7, standbycurrent)
-            self.TMCL.sap(mn, 140, microstep_resolution)
-            if store:
-                self.TMCL.stap(mn, 4)
-                self.TMCL.stap(mn, 5)
-                self.TMCL.stap(mn, 6)
-                self.TMCL.stap(mn, 7)
-                self.TMCL.stap(mn, 140)
+                                 microstep_resolution=1, store=False, dry_run=False):
+        """Write (and store) only the parameters that differ, return the TMCL.ConfigReport"""
+        desired = TMCL.axisConfig(self.motors, {4: max_speed, 5: max_accel,
+                                                6: max_current, 7: standbycurrent,
+                                                140: microstep_resolution})
+        return self.TMCL.apply_config(desired, store=store, dry_run=dry_run)
+
+    def _result(self, value):
+        """Value of a command of self.TMCL"""
+        return value
 
     def rotate(self, frequency, motor=0, steps=1, direction='cw'):
-        microstep_resolution = self.TMCL.gap(motor, 140)
+        microstep_resolution = self._result(self.TMCL.gap(motor, 140))
         vel = frequency * steps * microstep_resolution
         if direction == 'cw':
-            self.TMCL.ror(motor, vel)
+            self._result(self.TMCL.ror(motor, vel))
         elif direction == 'ccw':
-            self.TMCL.rol(motor, vel)
+            self._result(self.TMCL.rol(motor, vel))
         else:
             raise ValueError('direction needs to be either "cw" or "ccw"')
 
     def stop(self, motor=0):
-        self.TMCL.mst(motor)
+        self._result(self.TMCL.mst(motor))
+
+    def close(self):
+        self.TMCL._ser.close()
+
+
+
+
+class AsyncStepRocker(StepRocker):
+    """
+    StepRocker on a TMCL.AsyncDevice: commands wait for their futures,
+    parameter dumps are pipelined as with StepRocker
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.TMCL = TMCL.AsyncDevice(*args, **kwargs)
+        self.motors = range(self.TMCL.num_motors)
+
+    def _result(self, future):
+        return future.result()
+
+    def close(self):
+        self.TMCL.close()
+
+
+
+
+class StepRockerFleet(object):
+    """
+    Many StepRockers, one per port, driven in parallel by a TMCL.Fleet
+
+        fleet = StepRockerFleet(["/dev/ttyACM0", "/dev/ttyACM1"])
+        report = fleet.set_important_parameters(max_speed=1000)
+        report.check()
+        print fleet.get_parameters().values()
+
+    Every method returns a TMCL.FleetReport with the per-port results
+    and errors. rocker is the class opened per port, further arguments
+    go to TMCL.Fleet (concurrency, progress) or the rocker.
+    """
+
+    def __init__(self, ports, rocker=StepRocker, concurrency=1, progress=None, **kwargs):
+        self.fleet = TMCL.Fleet(ports, factory=rocker, concurrency=concurrency,
+                                progress=progress, **kwargs)
+
+    def run(self, fn, *args, **kwargs):
+        """fn(rocker, *args, **kwargs) on every StepRocker"""
+        return self.fleet.run(fn, *args, **kwargs)
+
+    def set_important_parameters(self, **kwargs):
+        return self.fleet.run(lambda rocker: rocker.set_important_parameters(**kwargs))
+
+    def get_parameters(self):
+        return self.fleet.run(lambda rocker: rocker.get_parameters())
+
+    def get_globals(self, banks=None):
+        return self.fleet.run(lambda rocker: rocker.get_globals(banks))
+
+    def stop(self):
+        return self.fleet.run(lambda rocker: [rocker.stop(mn) for mn in rocker.motors])
+
+    def health(self):
+        """Live values (position, speed, target reached, load) and link errors per port"""
+        return self.fleet.run(rockerHealth)
+
+    def close(self):
+        self.fleet.close()
 
 
+def rockerHealth(rocker):
+    snapshot = rocker.snapshot(axis_parameters=[1, 3, 8, 206], global_parameters=[])
+    snapshot.check()
+    stats = rocker.TMCL.stats()
+    return {'axis': snapshot.named_axis(rocker.motors)[0],
+            'checksum_errors': stats['checksum_errors'],
+            'timeouts': stats['timeouts']}
@@ -14,8 +14,12 @@ rocker.set_important_parameters(max_speed=1000,
 rocker.get_globals()
 rocker.get_parameters()
 
+rocker.TMCL.mvp(0, 'REL', 24 * 4)    # 24 full steps at 4 microsteps
+rocker.TMCL.wait_until_reached(0)   # returns once there, no fixed sleep
+
 rocker.rotate(10., steps=24)
-time.sleep(10)
+time.sleep(10)                      # spin for 10 s, a rotation has no target
 rocker.stop()
+rocker.TMCL.wait_until_idle()
 
 